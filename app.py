@@ -1,16 +1,242 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, abort, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 import sqlite3
 import os
-from datetime import datetime, date
-from functools import wraps
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import queue
+import re
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+from datetime import datetime, date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial, wraps
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import escape
+import click
+
+from repositories import (APPOINTMENT_STATUSES, BROADCAST_COHORTS, SLOT_RELEASING_STATUSES, AppointmentRepo,
+                          CatalogRepo, InvalidCursor, JobRepo, MedicalRecordRepo, MedicationMatch,
+                          NotificationRepo, REMINDER_STATUSES, ReminderRepo, UserRepo)
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this-in-production'
+app.config['DATABASE'] = os.environ.get('HOSPITAL_DB', 'hospital.db')
+app.config['DB_POOL_MAX_IDLE'] = 8
+app.config['DB_STATEMENT_CACHE'] = 256
+app.config['PAGE_SIZE'] = 25
+app.config['MAX_PAGE_SIZE'] = 100
+app.config['MAX_BATCH_UPDATE'] = 500
+app.config['BROADCAST_CHUNK'] = 10000
+app.config['MEDICATION_CACHE'] = True
+app.config['SSE_KEEPALIVE'] = 15
+app.config['SLOT_MINUTES'] = 60
+app.config['DEFAULT_WORKING_HOURS'] = (('09:00', '12:00'), ('14:00', '17:00'))
+app.config['MAX_SLOT_RANGE_DAYS'] = 92
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('HOSPITAL_TEMPLATE_CACHE', os.path.join(app.instance_path, 'jinja_cache'))
+app.config['PRECOMPILE_TEMPLATES'] = os.environ.get('HOSPITAL_PRECOMPILE_TEMPLATES') == '1'
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('HOSPITAL_PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('HOSPITAL_PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_HASH_MAX_PENDING'] = 32
+app.config['PAGE_CACHE_BYTES'] = 32 * 1024 * 1024
+app.config['METRICS_ENABLED'] = True
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('HOSPITAL_SLOW_QUERY_MS', 100))
+app.config['ARCHIVE_DIR'] = os.environ.get('HOSPITAL_ARCHIVE_DIR')
+app.config['ARCHIVE_HOT_YEARS'] = 2
+app.config['JOB_WORKERS'] = int(os.environ.get('HOSPITAL_JOB_WORKERS', 2))
+app.config['JOB_LEASE_SECONDS'] = 60
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 10
+app.config['JOB_POLL_SECONDS'] = 2
+app.config['REMINDERS_ENABLED'] = os.environ.get('HOSPITAL_REMINDERS', '1') != '0'
+app.config['REMINDER_LEAD_HOURS'] = 24
+app.config['REMINDER_WINDOW_HOURS'] = 24
+app.config['REMINDER_BATCH'] = 500
+app.config['REMINDER_TICK_SECONDS'] = 30
+app.config['NOTIFICATION_RETENTION_DAYS'] = 90
+app.config['NOTIFICATION_HISTORY_CAP'] = 500
+app.config['RETENTION_CHUNK'] = 1000
+app.config['RETENTION_PAUSE'] = 0.05
+app.config['RETENTION_INTERVAL_HOURS'] = 24
+app.config['VACUUM_PAGES'] = 2000
+
+# Templates are the files under templates/. Compiled template code is cached on
+# disk, so a restart loads it instead of parsing and compiling every template.
+os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_options = {**app.jinja_options,
+                     'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])}
+
+# Applied to every connection when it is opened. journal_mode=WAL is persistent
+# in the database file, the rest are per-connection settings. auto_vacuum only
+# takes effect on a new database, so it comes before anything writes to the
+# file; an existing one is converted by ``flask enable-incremental-vacuum``.
+DB_PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -20000),
+    ('temp_store', 'MEMORY'),
+)
+
+# Every connection counts its statements and the time spent in them, for the
+# per-request SQL metrics and the slow query log. The counters are plain
+# attributes, so this costs two clock reads per statement.
+slow_query_log = logging.getLogger('hospital.slow_queries')
+job_log = logging.getLogger('hospital.jobs')
+reminder_log = logging.getLogger('hospital.reminders')
+
+class TimedCursor(sqlite3.Cursor):
+    """Counts statements and adds their time to the connection's totals.
+
+    execute() steps a statement to its first row; the fetch methods step the
+    rest, so their time is added too. Rows read by iterating the cursor
+    directly are not timed.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record_sql(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.record_sql(sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.sql_seconds += time.perf_counter() - started
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self.connection.sql_seconds += time.perf_counter() - started
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.sql_seconds += time.perf_counter() - started
+
+class TimedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def record_sql(self, sql, seconds):
+        self.statements += 1
+        self.sql_seconds += seconds
+        if seconds * 1000 >= app.config['SLOW_QUERY_MS']:
+            metrics.slow_query()
+            slow_query_log.warning('slow query (%.1f ms): %s', seconds * 1000, ' '.join(sql.split()))
+
+# Database connections. Prepared statements are cached per connection by SQL
+# text; DB_STATEMENT_CACHE is sized to hold every statement in repositories.py,
+# so a pooled connection compiles each of them once.
+def connect_db(database=None):
+    database = database or app.config['DATABASE']
+    conn = sqlite3.connect(database, check_same_thread=False,
+                           factory=TimedConnection, cached_statements=app.config['DB_STATEMENT_CACHE'])
+    conn.database = database
+    for name, value in DB_PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+class ConnectionPool:
+    """Keeps opened, configured connections around between requests.
+
+    A connection is checked out for the lifetime of one app context and is only
+    ever used by the thread that owns that context. Up to ``max_idle``
+    connections are kept warm; any extra ones opened under load are closed
+    when they are released.
+    """
+
+    def __init__(self, database, max_idle=8):
+        self.database = database
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return connect_db(self.database)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+_pool_lock = threading.Lock()
+
+def get_pool():
+    with _pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is None or pool.database != app.config['DATABASE']:
+            init_db(app.config['DATABASE'])
+            pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_MAX_IDLE'])
+            app.extensions['db_pool'] = pool
+        return pool
+
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+        g.db.statements, g.db.sql_seconds = 0, 0.0
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
 
 # Database setup
-def init_db():
-    conn = sqlite3.connect('hospital.db')
+def init_db(database=None):
+    conn = connect_db(database)
     cursor = conn.cursor()
     
     # Users table
@@ -136,7 +362,686 @@ def init_db():
         ''', sample_medications)
     
     conn.commit()
+    
+    applied = migrate_db(conn)
+    conn.close()
+    return applied
+
+# Schema migrations. Each step runs exactly once, in order, inside its own
+# transaction and is recorded in schema_version, so existing databases are
+# upgraded in place. Only ever append new steps; never edit applied ones.
+# A step is either a list of SQL statements or a callable taking a cursor.
+# Live department figures, matched on users.specialization = departments.name.
+# Appointments count toward a day unless their status releases the slot
+# (SLOT_RELEASING_STATUSES, repeated literally because triggers are plain SQL).
+DEPARTMENT_DOCTOR_COUNTS_SQL = '''
+    SELECT specialization, COUNT(*) FROM users
+    WHERE user_type = 'doctor' AND specialization IS NOT NULL
+    GROUP BY specialization
+'''
+DEPARTMENT_APPOINTMENT_DAYS_SQL = '''
+    SELECT u.specialization, a.appointment_date, COUNT(*)
+    FROM appointments a
+    JOIN users u ON u.id = a.doctor_id
+    WHERE u.user_type = 'doctor' AND u.specialization IS NOT NULL
+      AND a.status NOT IN ('rejected', 'cancelled')
+    GROUP BY u.specialization, a.appointment_date
+'''
+
+MIGRATIONS = [
+    (1, 'Indexes for dashboard, notification and doctor list queries', [
+        # doctor_dashboard / patient_dashboard: WHERE x_id = ? ORDER BY date, time
+        'CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date ON appointments (doctor_id, appointment_date, appointment_time)',
+        'CREATE INDEX IF NOT EXISTS idx_appointments_patient_date ON appointments (patient_id, appointment_date, appointment_time)',
+        # Medical record history, newest first
+        'CREATE INDEX IF NOT EXISTS idx_medical_records_doctor_created ON medical_records (doctor_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_medical_records_patient_created ON medical_records (patient_id, created_at)',
+        # get_notifications and the unread badge count
+        'CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_user_unread ON notifications (user_id, is_read)',
+        # Doctor list on the patient dashboard. Lookups by email already use the
+        # index behind the UNIQUE constraint on users.email.
+        'CREATE INDEX IF NOT EXISTS idx_users_type ON users (user_type)',
+    ]),
+    (2, 'Full-text index for medication search', [
+        # External-content FTS5 table over medications, kept in sync by triggers.
+        # prefix='2 3' keeps short typeahead prefixes out of a full term scan.
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS medications_fts USING fts5(
+            name, generic_name, description,
+            content='medications', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS medications_fts_insert AFTER INSERT ON medications BEGIN
+            INSERT INTO medications_fts (rowid, name, generic_name, description)
+            VALUES (new.id, new.name, new.generic_name, new.description);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS medications_fts_delete AFTER DELETE ON medications BEGIN
+            INSERT INTO medications_fts (medications_fts, rowid, name, generic_name, description)
+            VALUES ('delete', old.id, old.name, old.generic_name, old.description);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS medications_fts_update AFTER UPDATE OF name, generic_name, description ON medications BEGIN
+            INSERT INTO medications_fts (medications_fts, rowid, name, generic_name, description)
+            VALUES ('delete', old.id, old.name, old.generic_name, old.description);
+            INSERT INTO medications_fts (rowid, name, generic_name, description)
+            VALUES (new.id, new.name, new.generic_name, new.description);
+        END''',
+        "INSERT INTO medications_fts (medications_fts) VALUES ('rebuild')",
+        # view_medications lists the catalogue ORDER BY name
+        'CREATE INDEX IF NOT EXISTS idx_medications_name ON medications (name)',
+    ]),
+    (3, 'Per-table write version counters', [
+        # Bumped by triggers on every write so in-process caches can tell
+        # whether a table changed without re-reading it.
+        '''CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )''',
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('medications')",
+        '''CREATE TRIGGER IF NOT EXISTS medications_version_insert AFTER INSERT ON medications BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'medications';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS medications_version_update AFTER UPDATE ON medications BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'medications';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS medications_version_delete AFTER DELETE ON medications BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'medications';
+        END''',
+    ]),
+    (4, 'Trigger-maintained unread notification counters', [
+        '''CREATE TABLE IF NOT EXISTS notification_counters (
+            user_id INTEGER PRIMARY KEY,
+            unread INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS notifications_unread_insert AFTER INSERT ON notifications
+        WHEN NEW.is_read = 0 BEGIN
+            INSERT INTO notification_counters (user_id, unread) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS notifications_unread_delete AFTER DELETE ON notifications
+        WHEN OLD.is_read = 0 BEGIN
+            UPDATE notification_counters SET unread = unread - 1 WHERE user_id = OLD.user_id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS notifications_unread_update AFTER UPDATE OF is_read, user_id ON notifications
+        WHEN OLD.is_read IS NOT NEW.is_read OR OLD.user_id IS NOT NEW.user_id BEGIN
+            UPDATE notification_counters SET unread = unread - 1
+            WHERE user_id = OLD.user_id AND OLD.is_read = 0;
+            INSERT INTO notification_counters (user_id, unread) SELECT NEW.user_id, 1 WHERE NEW.is_read = 0
+            ON CONFLICT (user_id) DO UPDATE SET unread = unread + 1;
+        END''',
+        '''INSERT INTO notification_counters (user_id, unread)
+        SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id''',
+    ]),
+    (5, 'Doctor working hours and covering index for slot lookups', [
+        # Weekly schedule; a doctor without rows works DEFAULT_WORKING_HOURS
+        '''CREATE TABLE IF NOT EXISTS doctor_working_hours (
+            doctor_id INTEGER NOT NULL,
+            weekday INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            PRIMARY KEY (doctor_id, weekday, start_time),
+            FOREIGN KEY (doctor_id) REFERENCES users (id)
+        ) WITHOUT ROWID''',
+        # Covers availability and conflict checks including the status filter.
+        # idx_appointments_doctor_date stays for the dashboard, which orders
+        # by (date, time, id) and would need a sort step with status in between.
+        'CREATE INDEX IF NOT EXISTS idx_appointments_doctor_slot ON appointments (doctor_id, appointment_date, appointment_time, status)',
+    ]),
+    (6, 'Trigger-maintained department statistics', [
+        # Keyed by specialization rather than department id, so a department
+        # created after its doctors registered starts with the right numbers.
+        '''CREATE TABLE IF NOT EXISTS department_stats (
+            name TEXT PRIMARY KEY,
+            doctor_count INTEGER NOT NULL DEFAULT 0
+        )''',
+        # Slot-holding appointments per department and day; "today" and
+        # "upcoming" are read from it with a primary key range.
+        '''CREATE TABLE IF NOT EXISTS department_appointment_days (
+            name TEXT NOT NULL,
+            appointment_date DATE NOT NULL,
+            appointments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, appointment_date)
+        ) WITHOUT ROWID''',
+        '''CREATE TRIGGER IF NOT EXISTS users_department_insert AFTER INSERT ON users
+        WHEN NEW.user_type = 'doctor' AND NEW.specialization IS NOT NULL BEGIN
+            INSERT INTO department_stats (name, doctor_count) VALUES (NEW.specialization, 1)
+            ON CONFLICT (name) DO UPDATE SET doctor_count = doctor_count + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_department_delete AFTER DELETE ON users
+        WHEN OLD.user_type = 'doctor' AND OLD.specialization IS NOT NULL BEGIN
+            UPDATE department_stats SET doctor_count = doctor_count - 1 WHERE name = OLD.specialization;
+            UPDATE department_appointment_days SET appointments = appointments - (
+                SELECT COUNT(*) FROM appointments
+                WHERE doctor_id = OLD.id AND appointment_date = department_appointment_days.appointment_date
+                  AND status NOT IN ('rejected', 'cancelled')
+            ) WHERE name = OLD.specialization;
+        END''',
+        # A doctor changing specialization takes their appointments along
+        '''CREATE TRIGGER IF NOT EXISTS users_department_update AFTER UPDATE OF specialization, user_type ON users
+        WHEN OLD.specialization IS NOT NEW.specialization OR OLD.user_type IS NOT NEW.user_type BEGIN
+            UPDATE department_stats SET doctor_count = doctor_count - 1
+            WHERE name = OLD.specialization AND OLD.user_type = 'doctor';
+            INSERT INTO department_stats (name, doctor_count)
+            SELECT NEW.specialization, 1 WHERE NEW.user_type = 'doctor' AND NEW.specialization IS NOT NULL
+            ON CONFLICT (name) DO UPDATE SET doctor_count = doctor_count + 1;
+            UPDATE department_appointment_days SET appointments = appointments - (
+                SELECT COUNT(*) FROM appointments
+                WHERE doctor_id = OLD.id AND appointment_date = department_appointment_days.appointment_date
+                  AND status NOT IN ('rejected', 'cancelled')
+            ) WHERE name = OLD.specialization AND OLD.user_type = 'doctor';
+            INSERT INTO department_appointment_days (name, appointment_date, appointments)
+            SELECT NEW.specialization, appointment_date, COUNT(*) FROM appointments
+            WHERE doctor_id = NEW.id AND status NOT IN ('rejected', 'cancelled')
+              AND NEW.user_type = 'doctor' AND NEW.specialization IS NOT NULL
+            GROUP BY appointment_date
+            ON CONFLICT (name, appointment_date) DO UPDATE SET appointments = appointments + excluded.appointments;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS appointments_department_insert AFTER INSERT ON appointments
+        WHEN NEW.status NOT IN ('rejected', 'cancelled') BEGIN
+            INSERT INTO department_appointment_days (name, appointment_date, appointments)
+            SELECT specialization, NEW.appointment_date, 1 FROM users
+            WHERE id = NEW.doctor_id AND user_type = 'doctor' AND specialization IS NOT NULL
+            ON CONFLICT (name, appointment_date) DO UPDATE SET appointments = appointments + 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS appointments_department_delete AFTER DELETE ON appointments
+        WHEN OLD.status NOT IN ('rejected', 'cancelled') BEGIN
+            UPDATE department_appointment_days SET appointments = appointments - 1
+            WHERE appointment_date = OLD.appointment_date AND name = (
+                SELECT specialization FROM users WHERE id = OLD.doctor_id AND user_type = 'doctor'
+            );
+        END''',
+        # Status changes between two slot-holding states (pending -> accepted)
+        # leave the counts alone and skip the trigger body entirely
+        '''CREATE TRIGGER IF NOT EXISTS appointments_department_update
+        AFTER UPDATE OF doctor_id, appointment_date, status ON appointments
+        WHEN OLD.doctor_id IS NOT NEW.doctor_id OR OLD.appointment_date IS NOT NEW.appointment_date
+          OR (OLD.status NOT IN ('rejected', 'cancelled')) IS NOT (NEW.status NOT IN ('rejected', 'cancelled')) BEGIN
+            UPDATE department_appointment_days SET appointments = appointments - 1
+            WHERE OLD.status NOT IN ('rejected', 'cancelled')
+              AND appointment_date = OLD.appointment_date AND name = (
+                SELECT specialization FROM users WHERE id = OLD.doctor_id AND user_type = 'doctor'
+            );
+            INSERT INTO department_appointment_days (name, appointment_date, appointments)
+            SELECT specialization, NEW.appointment_date, 1 FROM users
+            WHERE id = NEW.doctor_id AND user_type = 'doctor' AND specialization IS NOT NULL
+              AND NEW.status NOT IN ('rejected', 'cancelled')
+            ON CONFLICT (name, appointment_date) DO UPDATE SET appointments = appointments + 1;
+        END''',
+        'INSERT INTO department_stats (name, doctor_count) ' + DEPARTMENT_DOCTOR_COUNTS_SQL,
+        'INSERT INTO department_appointment_days (name, appointment_date, appointments) '
+        + DEPARTMENT_APPOINTMENT_DAYS_SQL,
+    ]),
+    (7, 'Version counters for the departments page', [
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('departments'), ('department_stats')",
+        '''CREATE TRIGGER IF NOT EXISTS departments_version_insert AFTER INSERT ON departments BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'departments';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS departments_version_update AFTER UPDATE ON departments BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'departments';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS departments_version_delete AFTER DELETE ON departments BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'departments';
+        END''',
+        # The page shows the head doctor's name
+        '''CREATE TRIGGER IF NOT EXISTS departments_version_head_rename AFTER UPDATE OF name ON users
+        WHEN OLD.name IS NOT NEW.name AND EXISTS (SELECT 1 FROM departments WHERE head_doctor_id = NEW.id) BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'departments';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS departments_version_head_delete AFTER DELETE ON users
+        WHEN EXISTS (SELECT 1 FROM departments WHERE head_doctor_id = OLD.id) BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'departments';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_stats_version_insert AFTER INSERT ON department_stats BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_stats_version_update AFTER UPDATE ON department_stats BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_stats_version_delete AFTER DELETE ON department_stats BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_days_version_insert AFTER INSERT ON department_appointment_days BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_days_version_update AFTER UPDATE ON department_appointment_days BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS department_days_version_delete AFTER DELETE ON department_appointment_days BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'department_stats';
+        END''',
+    ]),
+    (8, 'Index for notification broadcasts by appointment day', [
+        # broadcast_notification: patients booked in a date range, covering
+        'CREATE INDEX IF NOT EXISTS idx_appointments_date_patient ON appointments (appointment_date, patient_id, status)',
+    ]),
+    (9, 'Background job queue', [
+        # Finished jobs are deleted, so the table holds only queued, running
+        # and dead jobs; run_after and leased_until are Unix seconds
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'dead')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_after REAL NOT NULL,
+            leased_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (run_after) WHERE status = \'queued\'',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_leases ON jobs (leased_until) WHERE status = \'running\'',
+    ]),
+    (10, 'Appointment reminders', [
+        # Set when the patient's reminder is sent; the reminder scheduler
+        # finds its appointments through idx_appointments_date_patient
+        'ALTER TABLE appointments ADD COLUMN reminded_at TIMESTAMP',
+    ]),
+    (11, 'Notification retention', [
+        # delete_expired walks read notifications by age
+        'CREATE INDEX IF NOT EXISTS idx_notifications_read_created ON notifications (created_at) WHERE is_read = 1',
+        # First run of the retention job, which re-enqueues itself from then on
+        '''INSERT INTO jobs (kind, payload, max_attempts, run_after)
+        VALUES ('notification_retention', '{}', 5, 0)''',
+    ]),
+]
+
+def migrate_db(conn):
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    
+    cursor.execute('SELECT version FROM schema_version')
+    done = {row[0] for row in cursor.fetchall()}
+    
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version in done:
+            continue
+        # BEGIN IMMEDIATE serialises concurrent starters; re-check inside the lock
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,))
+            if cursor.fetchone():
+                conn.rollback()
+                continue
+            if callable(step):
+                step(cursor)
+            else:
+                for statement in step:
+                    cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                           (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = init_db()
+    if applied:
+        print(f"Applied migrations: {', '.join(map(str, applied))}")
+    else:
+        print('Database schema is up to date')
+
+# Unread notification counters, kept exact by the triggers from migration 4
+def repair_notification_counters(conn):
+    """Recompute every unread counter from the notifications table.
+
+    Returns the number of users whose stored counter was wrong.
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT user_id, SUM(unread) AS unread FROM (
+                    SELECT user_id, unread FROM notification_counters
+                    UNION ALL
+                    SELECT user_id, -COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id
+                )
+                GROUP BY user_id
+                HAVING SUM(unread) != 0
+            )
+        ''')
+        wrong = cursor.fetchone()[0]
+        cursor.execute('DELETE FROM notification_counters')
+        cursor.execute('''
+            INSERT INTO notification_counters (user_id, unread)
+            SELECT user_id, COUNT(*) FROM notifications WHERE is_read = 0 GROUP BY user_id
+        ''')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return wrong
+
+# Department statistics, kept current by the triggers from migration 6
+def department_stats_drift(cursor):
+    """Compare the stored department statistics with a live recount.
+
+    Returns ``(name, appointment_date, stored, live)`` for every figure that
+    differs; ``appointment_date`` is None for doctor counts.
+    """
+    cursor.execute(DEPARTMENT_DOCTOR_COUNTS_SQL)
+    live_doctors = dict(cursor.fetchall())
+    cursor.execute('SELECT name, doctor_count FROM department_stats WHERE doctor_count != 0')
+    stored_doctors = dict(cursor.fetchall())
+    cursor.execute(DEPARTMENT_APPOINTMENT_DAYS_SQL)
+    live_days = {(name, day): count for name, day, count in cursor.fetchall()}
+    cursor.execute('''
+        SELECT name, appointment_date, appointments FROM department_appointment_days
+        WHERE appointments != 0
+    ''')
+    stored_days = {(name, day): count for name, day, count in cursor.fetchall()}
+    
+    drift = [(name, None, stored_doctors.get(name, 0), live_doctors.get(name, 0))
+             for name in sorted(live_doctors.keys() | stored_doctors.keys())
+             if stored_doctors.get(name, 0) != live_doctors.get(name, 0)]
+    drift += [(name, day, stored_days.get((name, day), 0), live_days.get((name, day), 0))
+              for name, day in sorted(live_days.keys() | stored_days.keys())
+              if stored_days.get((name, day), 0) != live_days.get((name, day), 0)]
+    return drift
+
+def rebuild_department_stats(conn):
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('DELETE FROM department_stats')
+        cursor.execute('DELETE FROM department_appointment_days')
+        cursor.execute('INSERT INTO department_stats (name, doctor_count) ' + DEPARTMENT_DOCTOR_COUNTS_SQL)
+        cursor.execute('INSERT INTO department_appointment_days (name, appointment_date, appointments) '
+                       + DEPARTMENT_APPOINTMENT_DAYS_SQL)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+@app.cli.command('verify-department-stats')
+@click.option('--repair', is_flag=True, help='Rebuild the statistics when they have drifted.')
+def verify_department_stats_command(repair):
+    """Check department statistics against a live recount."""
+    conn = connect_db()
+    drift = department_stats_drift(conn.cursor())
+    for name, day, stored, live in drift:
+        figure = f'appointments on {day}' if day else 'doctors'
+        print(f'{name}: {figure} stored {stored}, live {live}')
+    if drift and repair:
+        rebuild_department_stats(conn)
+        print(f'Department statistics rebuilt; {len(drift)} figure(s) were wrong')
+    conn.close()
+    if not drift:
+        print('Department statistics match the live counts')
+    elif not repair:
+        raise SystemExit(1)
+
+@app.cli.command('repair-notification-counters')
+def repair_notification_counters_command():
+    """Rebuild the unread notification counters from scratch."""
+    conn = connect_db()
+    wrong = repair_notification_counters(conn)
+    conn.close()
+    print(f'Unread counters rebuilt; {wrong} user(s) had a wrong count')
+
+# Medical record archive. Records from before the last ARCHIVE_HOT_YEARS
+# calendar years are moved by ``flask archive-records`` into one SQLite file
+# per year, in ARCHIVE_DIR or else next to the database. Dashboards read the
+# main database only; ``?history=all`` attaches the archives to the request's
+# connection and reads every partition. medical_records uses AUTOINCREMENT,
+# so an id is never reused and stays unique across the partitions.
+ARCHIVE_FILE = re.compile(r'medical_records_(\d{4})\.db$')
+ARCHIVE_SCHEMA = (
+    '''
+        CREATE TABLE IF NOT EXISTS medical_records (
+            id INTEGER PRIMARY KEY,
+            appointment_id INTEGER NOT NULL,
+            patient_id INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL,
+            diagnosis TEXT,
+            prescription TEXT,
+            notes TEXT,
+            created_at TIMESTAMP
+        )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_medical_records_doctor_created ON medical_records (doctor_id, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_medical_records_patient_created ON medical_records (patient_id, created_at)',
+)
+MEDICAL_RECORD_COLUMNS = 'id, appointment_id, patient_id, doctor_id, diagnosis, prescription, notes, created_at'
+
+def archive_dir(database=None):
+    database = os.path.abspath(database or app.config['DATABASE'])
+    return app.config['ARCHIVE_DIR'] or os.path.splitext(database)[0] + '_archive'
+
+def archive_path(year, database=None):
+    return os.path.join(archive_dir(database), f'medical_records_{year}.db')
+
+def archive_years(database=None):
+    """Years that have an archive file, newest first."""
+    try:
+        names = os.listdir(archive_dir(database))
+    except FileNotFoundError:
+        return []
+    return sorted((int(match.group(1)) for match in map(ARCHIVE_FILE.match, names) if match), reverse=True)
+
+def create_archive(path):
+    # Built under a temporary name and renamed once complete, so a reader
+    # never attaches a file without the table
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    building = path + '.new'
+    conn = sqlite3.connect(building)
+    conn.execute('PRAGMA journal_mode = WAL')
+    for statement in ARCHIVE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+    os.replace(building, path)
+
+def attach_archives(conn):
+    """Attach every archive file to ``conn``; returns their schema names, newest first.
+
+    Attachments stay with the pooled connection, so later history requests
+    only attach years archived since. SQLite caps attached databases
+    (SQLITE_LIMIT_ATTACHED, 10 by default); the oldest years past the cap
+    are left out.
+    """
+    attached = {row[1] for row in conn.execute('PRAGMA database_list').fetchall()}
+    schemas = []
+    for year in archive_years(conn.database):
+        schema = f'archive_{year}'
+        if schema not in attached:
+            if len(attached - {'main', 'temp'}) >= conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED):
+                app.logger.warning('Archives before %s not attached: too many attached databases', year + 1)
+                break
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(year, conn.database),))
+            attached.add(schema)
+        schemas.append(schema)
+    return schemas
+
+def archive_record_batch(conn, year, ids):
+    """Move the records ``ids`` from ``year`` to its archive; returns how many moved.
+
+    The copy is committed before the originals are deleted. With WAL a
+    transaction spanning attached files is not atomic across them, so a
+    crash in between leaves duplicates for the next run to overwrite rather
+    than records that are in neither file.
+    """
+    path = archive_path(year, conn.database)
+    if not os.path.exists(path):
+        create_archive(path)
+    schema = f'archive_{year}'
+    batch = json.dumps(ids)
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+    try:
+        # Only the archive is written here, so writers to the main database
+        # are not held up by the copy
+        conn.execute('BEGIN')
+        try:
+            conn.execute(f'''
+                INSERT OR REPLACE INTO {schema}.medical_records ({MEDICAL_RECORD_COLUMNS})
+                SELECT {MEDICAL_RECORD_COLUMNS} FROM main.medical_records
+                WHERE id IN (SELECT value FROM json_each(?))
+            ''', (batch,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # A record deleted since the copy must not live on in the archive
+            conn.execute(f'''
+                DELETE FROM {schema}.medical_records
+                WHERE id IN (SELECT value FROM json_each(?))
+                  AND id NOT IN (SELECT id FROM main.medical_records WHERE id IN (SELECT value FROM json_each(?)))
+            ''', (batch, batch))
+            moved = conn.execute(f'''
+                DELETE FROM main.medical_records
+                WHERE id IN (SELECT id FROM {schema}.medical_records WHERE id IN (SELECT value FROM json_each(?)))
+            ''', (batch,)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute(f'DETACH DATABASE {schema}')
+    return moved
+
+def archive_medical_records(conn, before, batch_size=500, pause=0.05):
+    """Move every record created before ``before`` (an ISO date) to the archives.
+
+    The table is walked in id order, ``batch_size`` rows at a time, and each
+    batch is moved in two short transactions with ``pause`` seconds between
+    batches, so the app keeps writing while this runs. Returns
+    ``{year: records moved}``.
+    """
+    moved = {}
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, created_at FROM medical_records WHERE id > ? ORDER BY id LIMIT ?
+        ''', (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        by_year = {}
+        for record_id, created_at in rows:
+            if created_at and created_at < before:
+                by_year.setdefault(int(created_at[:4]), []).append(record_id)
+        for year, ids in sorted(by_year.items()):
+            moved[year] = moved.get(year, 0) + archive_record_batch(conn, year, ids)
+        if by_year and pause:
+            time.sleep(pause)
+    return moved
+
+@app.cli.command('archive-records')
+@click.option('--keep-years', type=click.IntRange(min=0),
+              help='Calendar years to keep in the main database (default ARCHIVE_HOT_YEARS; '
+                   '0 archives everything).')
+@click.option('--batch-size', type=int, default=500, show_default=True)
+@click.option('--pause', type=float, default=0.05, show_default=True,
+              help='Seconds to wait between batches.')
+def archive_records_command(keep_years, batch_size, pause):
+    """Move old medical records into per-year archive files."""
+    if keep_years is None:
+        keep_years = app.config['ARCHIVE_HOT_YEARS']
+    before = f'{date.today().year - keep_years + 1}-01-01'
+    conn = connect_db()
+    moved = archive_medical_records(conn, before, batch_size, pause)
     conn.close()
+    for year, count in sorted(moved.items()):
+        print(f'{year}: {count} record(s) moved to {archive_path(year)}')
+    print(f'Archived {sum(moved.values())} record(s) created before {before}')
+
+# Password hashing. Hashes are made and checked in a process pool so a burst
+# of logins does not hold the GIL and stall every other request thread.
+# PASSWORD_HASH_METHOD is the current policy; a stored hash made with other
+# parameters is replaced on the owner's next successful login.
+def hash_process_context():
+    # By the time a pool starts this process runs request, job and reminder
+    # threads; a forked child could inherit a lock one of them held
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+class PasswordHasherBusy(Exception):
+    """Raised when PASSWORD_HASH_MAX_PENDING hash jobs are already queued."""
+
+class PasswordHasher:
+    """Runs werkzeug's hash functions on ``workers`` processes, or inline if 0.
+
+    At most ``max_pending`` calls may be queued or running at once; callers
+    beyond that get PasswordHasherBusy instead of piling up behind them.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._prefixes = {}
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=hash_process_context())
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            if self.workers < 1:
+                return fn(*args)
+            pool = self._executor()
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool and retry once
+                with self._lock:
+                    if self._pool is pool:
+                        self._pool = None
+                return self._executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password, method):
+        return self._run(generate_password_hash, password, method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash, method):
+        """True when ``password_hash`` was not made with ``method``'s parameters."""
+        if method not in self._prefixes:
+            # werkzeug fills in defaults ('scrypt' -> 'scrypt:32768:8:1'), so
+            # take the prefix it actually writes rather than parsing ``method``
+            self._prefixes[method] = generate_password_hash('', method).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefixes[method]
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+_hasher_lock = threading.Lock()
+
+def get_password_hasher():
+    with _hasher_lock:
+        hasher = app.extensions.get('password_hasher')
+        if hasher is None:
+            hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'],
+                                    app.config['PASSWORD_HASH_MAX_PENDING'])
+            app.extensions['password_hasher'] = hasher
+        return hasher
 
 # Authentication decorators
 def login_required(f):
@@ -165,179 +1070,1729 @@ def patient_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Routes
-@app.route('/')
-def index():
-    if 'user_id' in session:
-        if session['user_type'] == 'doctor':
-            return redirect(url_for('doctor_dashboard'))
-        else:
-            return redirect(url_for('patient_dashboard'))
-    return redirect(url_for('login'))
+# Keyset pagination. Lists are ordered newest first on a unique key and each
+# page continues strictly after the key of the previous page's last row, so a
+# page costs an index seek plus ``limit`` rows no matter how deep it is.
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        email = request.form['email']
-        password = request.form['password']
-        
-        conn = sqlite3.connect('hospital.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, password_hash, name, user_type FROM users WHERE email = ?', (email,))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if user and check_password_hash(user[1], password):
-            session['user_id'] = user[0]
-            session['user_name'] = user[2]
-            session['user_type'] = user[3]
-            
-            if user[3] == 'doctor':
-                return redirect(url_for('doctor_dashboard'))
-            else:
-                return redirect(url_for('patient_dashboard'))
-        else:
-            flash('Invalid email or password')
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        abort(400, 'Invalid page cursor')
+    # Only values SQLite can bind; anything else would fail inside the query
+    if not isinstance(key, list) or not all(
+            isinstance(value, (str, float)) or (isinstance(value, int) and -2 ** 63 <= value < 2 ** 63)
+            for value in key):
+        abort(400, 'Invalid page cursor')
+    return key
+
+def get_page_size(args):
+    limit = args.get('limit', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+def fetch_page(query, owner_id, token, limit):
+    """Run a repository keyset query from a page token; returns ``(rows, next_token)``."""
+    try:
+        rows, next_key = query(owner_id, decode_cursor(token), limit)
+    except InvalidCursor:
+        abort(400, 'Invalid page cursor')
+    return rows, next_key and encode_cursor(next_key)
+
+@app.template_global()
+def page_url(param, cursor):
+    """URL of the current view with ``param`` advanced to ``cursor``."""
+    args = request.args.to_dict()
+    args[param] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def rows_json(rows):
+    return [row.as_dict() for row in rows]
+
+# Read views. Each loads everything one page needs from a connection and the
+# request arguments, so the Flask routes below and the async app in asgi.py
+# run exactly the same queries.
+def medical_record_repo(conn, args):
+    """Records from the main database, or from every partition with ?history=all."""
+    if args.get('history') == 'all':
+        return MedicalRecordRepo(conn, attach_archives(conn))
+    return MedicalRecordRepo(conn)
+
+def patient_history(conn, user_id, args):
+    limit = get_page_size(args)
+    appointments, next_appointments = fetch_page(
+        AppointmentRepo(conn).for_patient, user_id, args.get('appointments_after'), limit)
+    medical_records, next_records = fetch_page(
+        medical_record_repo(conn, args).for_patient, user_id, args.get('records_after'), limit)
+    return {'appointments': appointments, 'next_appointments': next_appointments,
+            'medical_records': medical_records, 'next_records': next_records,
+            'record_history': args.get('history') == 'all', 'archive_years': archive_years(conn.database)}
+
+def patient_dashboard_context(conn, user_id, args):
+    context = patient_history(conn, user_id, args)
+    context['doctors'] = UserRepo(conn).doctors()
+    context['unread_notifications'] = NotificationRepo(conn).unread_count(user_id)
+    return context
+
+def doctor_history(conn, user_id, args):
+    limit = get_page_size(args)
+    appointments, next_appointments = fetch_page(
+        AppointmentRepo(conn).for_doctor, user_id, args.get('appointments_after'), limit)
+    medical_records, next_records = fetch_page(
+        medical_record_repo(conn, args).for_doctor, user_id, args.get('records_after'), limit)
+    return {'appointments': appointments, 'next_appointments': next_appointments,
+            'medical_records': medical_records, 'next_records': next_records,
+            'record_history': args.get('history') == 'all', 'archive_years': archive_years(conn.database)}
+
+def history_json(history):
+    return {
+        'appointments': rows_json(history['appointments']),
+        'next_appointments': history['next_appointments'],
+        'medical_records': rows_json(history['medical_records']),
+        'next_records': history['next_records']
+    }
+
+def notifications_context(conn, user_id, args):
+    notifications, next_notifications = fetch_page(
+        NotificationRepo(conn).for_user, user_id, args.get('after'), get_page_size(args))
+    return {'notifications': notifications, 'next_notifications': next_notifications}
+
+def notifications_json(context):
+    return {
+        'notifications': rows_json(context['notifications']),
+        'next': context['next_notifications']
+    }
+
+def departments_context(conn):
+    return {'departments': CatalogRepo(conn).departments(date.today().isoformat())}
+
+def medications_context(conn):
+    if app.config['MEDICATION_CACHE']:
+        return {'medications': medication_catalog.snapshot(conn).rows}
+    return {'medications': CatalogRepo(conn).medications()}
+
+def medication_search_json(conn, query):
+    if app.config['MEDICATION_CACHE']:
+        medications = medication_catalog.snapshot(conn).search(query)
+    else:
+        medications = search_medication_catalog(conn, query)
+    return rows_json(medications)
+
+# Appointment availability. A doctor works the ranges in doctor_working_hours
+# for each weekday (0 = Monday), or DEFAULT_WORKING_HOURS every day when they
+# have no rows. Ranges are cut into SLOT_MINUTES slots; a slot is free when no
+# appointment that still holds its time starts less than SLOT_MINUTES away.
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+def to_minutes(hhmm):
+    hours, minutes = hhmm.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def to_hhmm(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+def working_hours(conn, doctor_id):
+    """Working ranges per weekday as ``{weekday: [(start, end), ...]}``."""
+    rows = UserRepo(conn).working_hours(doctor_id)
+    if not rows:
+        default = list(app.config['DEFAULT_WORKING_HOURS'])
+        return {weekday: default for weekday in range(7)}
+    hours = {weekday: [] for weekday in range(7)}
+    for row in rows:
+        hours[row.weekday].append((row.start_time, row.end_time))
+    return hours
+
+def slot_times(ranges):
+    length = app.config['SLOT_MINUTES']
+    slots = []
+    for start_time, end_time in ranges:
+        minute, end = to_minutes(start_time), to_minutes(end_time)
+        while minute + length <= end:
+            slots.append(minute)
+            minute += length
+    return slots
+
+def booked_times(conn, doctor_id, start, end):
+    """Start minutes of held appointments per date, from one index range scan."""
+    booked = {}
+    for slot in AppointmentRepo(conn).booked(doctor_id, start.isoformat(), end.isoformat()):
+        booked.setdefault(slot.appointment_date, []).append(to_minutes(slot.appointment_time))
+    return booked
+
+def free_slots(conn, doctor_id, start, end, now=None):
+    """Free slot times per ISO date for ``start``..``end`` inclusive."""
+    now = now or datetime.now()
+    length = app.config['SLOT_MINUTES']
+    hours = working_hours(conn, doctor_id)
+    slots_by_weekday = {weekday: slot_times(ranges) for weekday, ranges in hours.items()}
+    start = max(start, now.date())
+    booked = booked_times(conn, doctor_id, start, end) if start <= end else {}
+    
+    result = {}
+    day = start
+    while day <= end:
+        taken = booked.get(day.isoformat(), ())
+        earliest = now.hour * 60 + now.minute if day == now.date() else -1
+        result[day.isoformat()] = [
+            to_hhmm(slot) for slot in slots_by_weekday[day.weekday()]
+            if slot > earliest and all(abs(slot - t) >= length for t in taken)
+        ]
+        day += timedelta(days=1)
+    return result
+
+def slot_conflict(conn, doctor_id, appointment_date, appointment_time):
+    """Whether a held appointment overlaps the slot starting at appointment_time."""
+    length = app.config['SLOT_MINUTES']
+    minute = to_minutes(appointment_time)
+    # Zero-padded HH:MM strings order like the times they represent
+    lower = to_hhmm(minute - length) if minute >= length else ''
+    upper = to_hhmm(minute + length)
+    return AppointmentRepo(conn).held_between(doctor_id, appointment_date, lower, upper)
+
+def parse_weekdays(spec):
+    """'mon-fri', 'sat' or 'mon,wed,fri' to weekday numbers."""
+    days = set()
+    for part in spec.lower().split(','):
+        first, _, last = part.partition('-')
+        start = WEEKDAYS.index(first)
+        end = WEEKDAYS.index(last) if last else start
+        days.update(range(start, end + 1))
+    return sorted(days)
+
+@app.cli.command('set-working-hours')
+@click.argument('doctor_id', type=int)
+@click.argument('days')
+@click.argument('ranges', nargs=-1)
+@click.option('--reset', is_flag=True, help='Drop the schedule and use the default hours again.')
+def set_working_hours_command(doctor_id, days, ranges, reset):
+    """Set a doctor's hours, e.g. ``3 mon-fri 09:00-12:00 14:00-17:00``.
+
+    DAYS without RANGES makes those days off.
+    """
+    try:
+        weekdays = parse_weekdays(days)
+        ranges = [tuple(r.split('-')) for r in ranges]
+        for start_time, end_time in ranges:
+            if to_minutes(start_time) >= to_minutes(end_time):
+                raise ValueError(f'{start_time}-{end_time} is empty')
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    
+    conn = connect_db()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    if reset:
+        cursor.execute('DELETE FROM doctor_working_hours WHERE doctor_id = ?', (doctor_id,))
+    else:
+        # The first explicit schedule starts from the defaults for the other days
+        cursor.execute('SELECT 1 FROM doctor_working_hours WHERE doctor_id = ? LIMIT 1', (doctor_id,))
+        if cursor.fetchone() is None:
+            cursor.executemany('''
+                INSERT INTO doctor_working_hours (doctor_id, weekday, start_time, end_time)
+                VALUES (?, ?, ?, ?)
+            ''', [(doctor_id, weekday, start_time, end_time)
+                  for weekday in range(7)
+                  for start_time, end_time in app.config['DEFAULT_WORKING_HOURS']])
+        cursor.executemany('DELETE FROM doctor_working_hours WHERE doctor_id = ? AND weekday = ?',
+                           [(doctor_id, weekday) for weekday in weekdays])
+        # A day off is stored as an empty range so it is not mistaken for
+        # "no schedule" and given the default hours
+        cursor.executemany('''
+            INSERT INTO doctor_working_hours (doctor_id, weekday, start_time, end_time)
+            VALUES (?, ?, ?, ?)
+        ''', [(doctor_id, weekday, start_time, end_time)
+              for weekday in weekdays for start_time, end_time in ranges or [('00:00', '00:00')]])
+    conn.commit()
     
-    return render_template('login.html')
+    for weekday, day_ranges in working_hours(conn, doctor_id).items():
+        day_ranges = [f'{s}-{e}' for s, e in day_ranges if s != e]
+        print(f"{WEEKDAYS[weekday]}: {', '.join(day_ranges) or 'off'}")
+    conn.close()
 
-@app.route('/register', methods=['GET', 'POST'])
-def register():
-    if request.method == 'POST':
-        name = request.form['name']
-        email = request.form['email']
-        password = request.form['password']
-        user_type = request.form['user_type']
-        phone = request.form['phone']
-        specialization = request.form.get('specialization', '')
+# Bulk import. Rows are streamed from CSV or NDJSON, validated one by one and
+# written in executemany batches, one transaction per batch. Invalid rows are
+# written to a reject file with the reason instead of stopping the load.
+USER_TYPES = ('patient', 'doctor')
+
+def read_import_rows(stream, fmt):
+    """Yield ``(line_number, row_dict)`` without loading the whole file."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = {'_raw': line.rstrip('\n')}
+                yield line_number, row
+
+def required(row, field):
+    value = row.get(field)
+    if value is None or str(value).strip() == '':
+        raise ValueError(f'{field} is required')
+    return str(value).strip()
+
+def optional(row, field, default=''):
+    value = row.get(field)
+    return default if value is None else str(value).strip()
+
+def validate_user(row):
+    user_type = required(row, 'user_type').lower()
+    if user_type not in USER_TYPES:
+        raise ValueError(f'user_type must be one of {", ".join(USER_TYPES)}')
+    email = required(row, 'email').lower()
+    if '@' not in email:
+        raise ValueError('email is not valid')
+    password_hash = optional(row, 'password_hash')
+    password = None if password_hash else required(row, 'password')
+    return {'name': required(row, 'name'), 'email': email, 'password': password,
+            'password_hash': password_hash, 'user_type': user_type,
+            'phone': optional(row, 'phone'), 'specialization': optional(row, 'specialization')}
+
+def validate_appointment(row):
+    appointment_date = date.fromisoformat(required(row, 'appointment_date')).isoformat()
+    time_of_day = re.fullmatch(r'(\d{1,2}):(\d{2})', required(row, 'appointment_time'))
+    if not time_of_day or int(time_of_day[1]) >= 24 or int(time_of_day[2]) >= 60:
+        raise ValueError('appointment_time must be an HH:MM time of day')
+    # Stored zero-padded, like every other time: slot checks compare strings
+    appointment_time = f'{int(time_of_day[1]):02d}:{time_of_day[2]}'
+    status = optional(row, 'status', 'pending').lower() or 'pending'
+    if status not in APPOINTMENT_STATUSES:
+        raise ValueError(f'status must be one of {", ".join(APPOINTMENT_STATUSES)}')
+    return {'patient': optional(row, 'patient_id') or required(row, 'patient_email').lower(),
+            'doctor': optional(row, 'doctor_id') or required(row, 'doctor_email').lower(),
+            'appointment_date': appointment_date, 'appointment_time': appointment_time,
+            'status': status, 'notes': optional(row, 'notes')}
+
+def validate_medication(row):
+    price = float(required(row, 'price'))
+    stock_quantity = int(optional(row, 'stock_quantity', '0') or 0)
+    if price < 0 or stock_quantity < 0:
+        raise ValueError('price and stock_quantity must not be negative')
+    return (required(row, 'name'), optional(row, 'generic_name'), optional(row, 'description'),
+            optional(row, 'dosage'), optional(row, 'side_effects'), price, stock_quantity,
+            optional(row, 'manufacturer'))
+
+class BulkImporter:
+    """Writes validated rows of one kind in batches; see ``flask import-data``."""
+
+    def __init__(self, conn, kind, reject, hash_pool=None, hash_workers=1):
+        self.conn = conn
+        self.kind = kind
+        self.reject = reject
+        self.hash_pool = hash_pool
+        self.hash_workers = hash_workers
+        self.imported = 0
+        self.rejected = 0
+
+    def flush(self, batch):
+        if batch:
+            getattr(self, f'_write_{self.kind}')(batch)
+
+    def reject_row(self, line_number, row, error):
+        self.rejected += 1
+        self.reject(line_number, row, error)
+
+    def _write_users(self, batch):
+        cursor = self.conn.cursor()
+        emails = [user['email'] for _, _, user in batch]
+        placeholders = ', '.join('?' * len(emails))
+        cursor.execute(f'SELECT email FROM users WHERE email IN ({placeholders})', emails)
+        taken = {row[0] for row in cursor.fetchall()}
+        accepted = []
+        for line_number, row, user in batch:
+            if user['email'] in taken:
+                self.reject_row(line_number, row, 'email already exists')
+            else:
+                taken.add(user['email'])
+                accepted.append((line_number, row, user))
         
-        password_hash = generate_password_hash(password)
+        to_hash = [user for _, _, user in accepted if not user['password_hash']]
+        passwords = [user['password'] for user in to_hash]
+        hash_password = partial(generate_password_hash, method=app.config['PASSWORD_HASH_METHOD'])
+        if self.hash_pool and len(passwords) > 1:
+            chunksize = max(1, len(passwords) // (self.hash_workers * 4))
+            hashes = self.hash_pool.map(hash_password, passwords, chunksize=chunksize)
+        else:
+            hashes = map(hash_password, passwords)
+        for user, password_hash in zip(to_hash, hashes):
+            user['password_hash'] = password_hash
         
+        insert = '''
+            INSERT INTO users (name, email, password_hash, user_type, phone, specialization)
+            VALUES (:name, :email, :password_hash, :user_type, :phone, :specialization)
+        '''
         try:
-            conn = sqlite3.connect('hospital.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO users (name, email, password_hash, user_type, phone, specialization)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (name, email, password_hash, user_type, phone, specialization))
-            conn.commit()
-            conn.close()
-            
-            flash('Registration successful! Please login.')
-            return redirect(url_for('login'))
+            cursor.executemany(insert, [user for _, _, user in accepted])
+            self.conn.commit()
+            self.imported += len(accepted)
         except sqlite3.IntegrityError:
-            flash('Email already exists')
-    
-    return render_template('register.html')
+            # Someone registered one of these emails since the check above
+            self.conn.rollback()
+            for line_number, row, user in accepted:
+                try:
+                    cursor.execute(insert, user)
+                    self.imported += 1
+                except sqlite3.IntegrityError:
+                    self.reject_row(line_number, row, 'email already exists')
+            self.conn.commit()
 
-@app.route('/patient/dashboard')
-@patient_required
-def patient_dashboard():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Get available doctors
-    cursor.execute('SELECT id, name, specialization FROM users WHERE user_type = "doctor"')
-    doctors = cursor.fetchall()
-    
-    # Get patient's appointments
-    cursor.execute('''
-        SELECT a.id, d.name, a.appointment_date, a.appointment_time, a.status, a.notes
-        FROM appointments a
-        JOIN users d ON a.doctor_id = d.id
-        WHERE a.patient_id = ?
-        ORDER BY a.appointment_date DESC, a.appointment_time DESC
-    ''', (session['user_id'],))
-    appointments = cursor.fetchall()
-    
-    # Get medical records
-    cursor.execute('''
-        SELECT m.id, d.name, m.diagnosis, m.prescription, m.notes, m.created_at
-        FROM medical_records m
-        JOIN users d ON m.doctor_id = d.id
-        WHERE m.patient_id = ?
-        ORDER BY m.created_at DESC
-    ''', (session['user_id'],))
-    medical_records = cursor.fetchall()
-    
-    # Get unread notifications count
-    cursor.execute('SELECT COUNT(*) FROM notifications WHERE user_id = ? AND is_read = 0', (session['user_id'],))
-    unread_notifications = cursor.fetchone()[0]
-    
-    conn.close()
-    
-    return render_template('patient_dashboard.html', 
-                         doctors=doctors, 
-                         appointments=appointments, 
-                         medical_records=medical_records,
-                         unread_notifications=unread_notifications)
+    def _resolve_users(self, cursor, keys, user_type):
+        ids = {key for key in keys if key.isdigit()}
+        emails = set(keys) - ids
+        resolved = {}
+        for column, values in (('id', ids), ('email', emails)):
+            if values:
+                placeholders = ', '.join('?' * len(values))
+                cursor.execute(f'''
+                    SELECT id, {column} FROM users WHERE user_type = ? AND {column} IN ({placeholders})
+                ''', [user_type, *values])
+                resolved.update((str(key), user_id) for user_id, key in cursor.fetchall())
+        return resolved
 
-@app.route('/doctor/dashboard')
-@doctor_required
-def doctor_dashboard():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    # Get doctor's appointments
-    cursor.execute('''
-        SELECT a.id, p.name, a.appointment_date, a.appointment_time, a.status, a.notes, p.phone
-        FROM appointments a
-        JOIN users p ON a.patient_id = p.id
-        WHERE a.doctor_id = ?
-        ORDER BY a.appointment_date DESC, a.appointment_time DESC
-    ''', (session['user_id'],))
-    appointments = cursor.fetchall()
-    
-    # Get doctor's medical records
-    cursor.execute('''
-        SELECT mr.id, p.name, mr.diagnosis, mr.prescription, mr.notes, mr.created_at, p.phone
-        FROM medical_records mr
-        JOIN users p ON mr.patient_id = p.id
-        WHERE mr.doctor_id = ?
-        ORDER BY mr.created_at DESC
-    ''', (session['user_id'],))
-    medical_records = cursor.fetchall()
-    
-    conn.close()
-    
-    return render_template('doctor_dashboard.html', appointments=appointments, medical_records=medical_records)
+    def _write_appointments(self, batch):
+        cursor = self.conn.cursor()
+        patients = self._resolve_users(cursor, [a['patient'] for _, _, a in batch], 'patient')
+        doctors = self._resolve_users(cursor, [a['doctor'] for _, _, a in batch], 'doctor')
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        accepted = []
+        # Start minutes of the slots this batch holds, per (doctor, date), so
+        # rows of one file are checked against each other like slot_conflict
+        held = {}
+        length = app.config['SLOT_MINUTES']
+        for line_number, row, appointment in batch:
+            patient_id = patients.get(appointment['patient'])
+            doctor_id = doctors.get(appointment['doctor'])
+            slot = (doctor_id, appointment['appointment_date'], appointment['appointment_time'])
+            minute = to_minutes(appointment['appointment_time'])
+            batch_slots = held.setdefault(slot[:2], [])
+            if patient_id is None:
+                self.reject_row(line_number, row, 'unknown patient')
+            elif doctor_id is None:
+                self.reject_row(line_number, row, 'unknown doctor')
+            elif appointment['status'] not in SLOT_RELEASING_STATUSES and (
+                    any(abs(minute - other) < length for other in batch_slots)
+                    or slot_conflict(self.conn, *slot)):
+                self.reject_row(line_number, row, 'doctor is already booked at that time')
+            else:
+                if appointment['status'] not in SLOT_RELEASING_STATUSES:
+                    batch_slots.append(minute)
+                accepted.append((patient_id, doctor_id, appointment['appointment_date'],
+                                 appointment['appointment_time'], appointment['status'],
+                                 appointment['notes']))
+        cursor.executemany('''
+            INSERT INTO appointments (patient_id, doctor_id, appointment_date, appointment_time, status, notes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', accepted)
+        self.conn.commit()
+        self.imported += len(accepted)
 
-@app.route('/schedule-appointment', methods=['POST'])
-@patient_required
-def schedule_appointment():
-    doctor_id = request.form['doctor_id']
-    appointment_date = request.form['appointment_date']
-    appointment_time = request.form['appointment_time']
-    notes = request.form['notes']
+    def _write_medications(self, batch):
+        self.conn.executemany('''
+            INSERT INTO medications (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [medication for _, _, medication in batch])
+        self.conn.commit()
+        self.imported += len(batch)
+        medication_catalog.invalidate()
+
+IMPORT_VALIDATORS = {
+    'users': validate_user,
+    'appointments': validate_appointment,
+    'medications': validate_medication,
+}
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_VALIDATORS)))
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              help='Input format; guessed from the file extension by default.')
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000, show_default=True,
+              help='Rows per transaction.')
+@click.option('--reject-file', type=click.Path(dir_okay=False), help='Where to write rejected rows.')
+@click.option('--hash-workers', default=os.cpu_count() or 1, show_default=True,
+              help='Processes hashing plain-text passwords (users only).')
+def import_data_command(kind, source, fmt, batch_size, reject_file, hash_workers):
+    """Bulk-load users, appointments or medications from CSV or NDJSON.
+
+    Users need name, email, user_type and either password or a pre-computed
+    password_hash. Appointments name the patient and doctor by *_id or
+    *_email. Medications use the columns of the medications table.
+    """
+    fmt = fmt or ('ndjson' if source.name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    reject_file = reject_file or f'{source.name}.rejects.{fmt}'
+    validate = IMPORT_VALIDATORS[kind]
     
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO appointments (patient_id, doctor_id, appointment_date, appointment_time, notes)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session['user_id'], doctor_id, appointment_date, appointment_time, notes))
-    conn.commit()
-    conn.close()
+    init_db()
+    conn = connect_db()
+    hash_pool = ProcessPoolExecutor(hash_workers, mp_context=hash_process_context()) if kind == 'users' and hash_workers > 1 else None
+    rejects = open(reject_file, 'w', encoding='utf-8', newline='')
+    reject_writer = None
+    
+    def reject(line_number, row, error):
+        nonlocal reject_writer
+        if fmt == 'ndjson':
+            rejects.write(json.dumps({'line': line_number, 'error': error, 'row': row}) + '\n')
+            return
+        if reject_writer is None:
+            reject_writer = csv.DictWriter(rejects, ['line', 'error', *row], extrasaction='ignore')
+            reject_writer.writeheader()
+        reject_writer.writerow({**row, 'line': line_number, 'error': error})
+    
+    importer = BulkImporter(conn, kind, reject, hash_pool, hash_workers)
+    started = time.perf_counter()
+    batch = []
+    try:
+        for line_number, row in read_import_rows(source, fmt):
+            try:
+                if not isinstance(row, dict) or '_raw' in row:
+                    raise ValueError('not a JSON object')
+                batch.append((line_number, row, validate(row)))
+            except (ValueError, TypeError) as e:
+                importer.reject_row(line_number, row, str(e))
+            if len(batch) >= batch_size:
+                importer.flush(batch)
+                batch = []
+                elapsed = time.perf_counter() - started
+                click.echo(f'{importer.imported} rows imported ({importer.imported / elapsed:.0f} rows/s)', err=True)
+        importer.flush(batch)
+    finally:
+        rejects.close()
+        if hash_pool:
+            hash_pool.shutdown()
+        conn.close()
     
-    flash('Appointment scheduled successfully!')
-    return redirect(url_for('patient_dashboard'))
+    elapsed = time.perf_counter() - started
+    print(f'Imported {importer.imported} {kind} in {elapsed:.2f}s '
+          f'({importer.imported / elapsed if elapsed else 0:.0f} rows/s), rejected {importer.rejected}')
+    if importer.rejected:
+        print(f'Rejected rows written to {reject_file}')
+    else:
+        os.remove(reject_file)
 
-@app.route('/doctor/update-appointment', methods=['POST'])
-@doctor_required
+# Server-sent events. Routes publish after committing; every open /events
+# stream of the affected user receives the event. The broker lives in this
+# process, so all workers serving a user's streams must share it (run a
+# single threaded process, or pin /events to the process that writes).
+class EventBroker:
+    """Fans events out to per-stream queues, keyed by user id."""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, subscription=None):
+        """Register ``subscription``, or a new queue.Queue, for the user's events.
+
+        A subscription only needs ``put_nowait``, raising queue.Full when its
+        reader has fallen behind.
+        """
+        if subscription is None:
+            subscription = queue.Queue(self.max_queue)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscribers.pop(user_id, None)
+
+    def user_ids(self):
+        """Users with at least one open stream."""
+        with self._lock:
+            return list(self._subscribers)
+
+    def publish(self, user_id, event, data):
+        with self._lock:
+            subscriptions = list(self._subscribers.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.put_nowait((event, data))
+            except queue.Full:
+                # A stalled client loses events rather than blocking the writer
+                pass
+
+event_broker = EventBroker()
+
+def notification_event(conn, user_id, notification_id):
+    notifications = NotificationRepo(conn)
+    data = notifications.get(notification_id).as_dict()
+    data['unread'] = notifications.unread_count(user_id)
+    return data
+
+@app.route('/events')
+@login_required
+def events():
+    user_id = session['user_id']
+    subscription = event_broker.subscribe(user_id)
+    keepalive = app.config['SSE_KEEPALIVE']
+    
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event, data = subscription.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+        finally:
+            event_broker.unsubscribe(user_id, subscription)
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Notification broadcast. The patients of a cohort are staged once in a
+# temporary table and notified with one INSERT ... SELECT per chunk of
+# BROADCAST_CHUNK users. A cohort that fits in one chunk is a single
+# statement in a single transaction; larger ones commit after each chunk so
+# other writers get the lock in between.
+NOTIFICATION_TYPES = ('info', 'success', 'warning', 'danger')
+
+def broadcast_notification(conn, cohort, message, notification_type='info', value=None,
+                           start=None, end=None, chunk_size=None, progress=None):
+    """Notify every patient in ``cohort``; returns ``{'recipients', 'sent', 'seconds'}``.
+
+    ``value`` is the doctor id or department name the cohort needs ('day'
+    needs none). Only appointments from ``start`` to ``end`` (ISO dates)
+    that still hold their slot count; both are optional except that 'day'
+    needs ``start``, and its ``end`` defaults to ``start``. ``progress(sent,
+    recipients)`` is called after every chunk. Raises ValueError for a bad
+    argument.
+    """
+    # JSON callers can send any type; check them before anything is looked up
+    if not isinstance(cohort, str) or cohort not in BROADCAST_COHORTS:
+        raise ValueError(f'cohort must be one of {", ".join(BROADCAST_COHORTS)}')
+    if not isinstance(notification_type, str) or notification_type not in NOTIFICATION_TYPES:
+        raise ValueError(f'type must be one of {", ".join(NOTIFICATION_TYPES)}')
+    if not isinstance(message, str) or not message.strip():
+        raise ValueError('message is required')
+    if BROADCAST_COHORTS[cohort] and value in (None, ''):
+        raise ValueError(f'the {cohort} cohort needs a value')
+    if cohort == 'department' and not isinstance(value, str):
+        raise ValueError('the department cohort needs a department name')
+    if cohort == 'day':
+        # Without a date the cohort would be everybody who ever booked
+        if not start:
+            raise ValueError('the day cohort needs a start date')
+        end = end or start
+    if cohort == 'doctor':
+        try:
+            if isinstance(value, bool) or not isinstance(value, (str, int)):
+                raise ValueError
+            value = int(value)
+        except ValueError:
+            raise ValueError('the doctor cohort needs a doctor id') from None
+        if not -2**63 <= value < 2**63:
+            raise ValueError('the doctor cohort needs a doctor id')
+    if not all(isinstance(day, (str, type(None))) for day in (start, end)):
+        raise ValueError('start and end must be YYYY-MM-DD dates')
+    start = date.fromisoformat(start).isoformat() if start else '0000-01-01'
+    end = date.fromisoformat(end).isoformat() if end else '9999-12-31'
+    chunk_size = chunk_size or app.config['BROADCAST_CHUNK']
+    
+    started = time.perf_counter()
+    notifications = NotificationRepo(conn)
+    recipients = notifications.stage_broadcast(cohort, value, start, end)
+    conn.commit()
+    sent = 0
+    after = 0
+    try:
+        while True:
+            through = notifications.broadcast_chunk_end(after, chunk_size)
+            if through is None:
+                break
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                count, last_id = notifications.insert_broadcast(message, notification_type, after, through)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            publish_broadcast(conn, last_id - count + 1, last_id)
+            sent += count
+            after = through
+            if progress:
+                progress(sent, recipients)
+    finally:
+        notifications.clear_broadcast()
+        conn.commit()
+    return {'recipients': recipients, 'sent': sent, 'seconds': round(time.perf_counter() - started, 3)}
+
+def publish_broadcast(conn, first_id, last_id):
+    # Only users with an open stream are looked up, not the whole cohort
+    user_ids = event_broker.user_ids()
+    if not user_ids:
+        return
+    for row in NotificationRepo(conn).events(first_id, last_id, user_ids):
+        data = row.as_dict()
+        event_broker.publish(data.pop('user_id'), 'notification', data)
+
+@app.route('/admin/notifications/broadcast', methods=['POST'])
+@doctor_required
+def broadcast():
+    """Notify a cohort: ``{"cohort", "value", "start", "end", "message", "type"}``.
+
+    Progress is sent to the caller's event streams as ``broadcast`` events.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'expected a JSON object'}), 400
+    user_id = session['user_id']
+    
+    def progress(sent, recipients):
+        event_broker.publish(user_id, 'broadcast', {'sent': sent, 'recipients': recipients})
+    
+    try:
+        result = broadcast_notification(get_db(), data.get('cohort'), data.get('message'),
+                                        data.get('type', 'info'), data.get('value'),
+                                        data.get('start'), data.get('end'), progress=progress)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **result})
+
+@app.cli.command('broadcast')
+@click.argument('cohort', type=click.Choice(sorted(BROADCAST_COHORTS)))
+@click.argument('message')
+@click.option('--value', help='Doctor id or department name the cohort is for.')
+@click.option('--start', help='First appointment date (YYYY-MM-DD) of the cohort; required for day.')
+@click.option('--end', help='Last appointment date (YYYY-MM-DD) of the cohort; day defaults to --start.')
+@click.option('--type', 'notification_type', type=click.Choice(NOTIFICATION_TYPES), default='info',
+              show_default=True)
+@click.option('--chunk-size', type=int, help='Recipients per transaction (default BROADCAST_CHUNK).')
+def broadcast_command(cohort, message, value, start, end, notification_type, chunk_size):
+    """Send MESSAGE to every patient in COHORT, e.g. ``day "Clinic closed" --start 2025-03-01``."""
+    def progress(sent, recipients):
+        click.echo(f'\r{sent}/{recipients} notified', nl=False)
+    
+    conn = connect_db()
+    try:
+        result = broadcast_notification(conn, cohort, message, notification_type, value, start, end,
+                                        chunk_size, progress)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    finally:
+        conn.close()
+    if result['sent']:
+        click.echo()
+    click.echo(f"Notified {result['sent']} patient(s) in {result['seconds']}s")
+
+# Background jobs. Follow-up work a route need not wait for is added to the
+# jobs table by enqueue_job inside the route's own transaction, so a job
+# exists exactly when the change that caused it does. JOB_WORKERS threads per
+# process lease the oldest ready job for JOB_LEASE_SECONDS and run its
+# handler; the handler's writes and the removal of the job commit together,
+# so database effects happen once. A failing job is retried after
+# JOB_RETRY_DELAY seconds, doubling each time, and is kept as 'dead' once
+# JOB_MAX_ATTEMPTS are used up. A job whose worker died is requeued when its
+# lease runs out. ``flask jobs``, ``run-jobs`` and ``retry-jobs`` manage the
+# queue from the shell.
+job_handlers = {}
+
+def job_handler(kind):
+    """Register ``fn(conn, payload)`` as the handler of ``kind`` jobs.
+
+    The handler runs inside the transaction that completes its job and must
+    not commit. It may return a callable to run once that has committed,
+    e.g. to publish events.
+    """
+    def register(fn):
+        job_handlers[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(conn, kind, payload, delay=0, max_attempts=None):
+    """Add a job in ``conn``'s open transaction; workers see it once that commits."""
+    if kind not in job_handlers:
+        raise ValueError(f'no handler for job kind {kind!r}')
+    return JobRepo(conn).enqueue(kind, payload, time.time() + delay,
+                                 max_attempts or app.config['JOB_MAX_ATTEMPTS'])
+
+def run_next_job(conn, lease=None):
+    """Claim and run one ready job; returns False when there is none."""
+    jobs = JobRepo(conn)
+    now = time.time()
+    # Both lookups are reads, so an idle worker never takes the write lock
+    if jobs.has_expired_leases(now):
+        jobs.release_expired(now)
+        conn.commit()
+    job_id = jobs.next_ready(now)
+    if job_id is None:
+        return False
+    job = jobs.claim(job_id, now + (lease or app.config['JOB_LEASE_SECONDS']))
+    conn.commit()
+    if job is None:
+        # Another worker got there first
+        return True
+    
+    try:
+        handler = job_handlers.get(job.kind)
+        if handler is None:
+            raise LookupError(f'no handler for job kind {job.kind!r}')
+        after_commit = handler(conn, json.loads(job.payload))
+        if not jobs.complete(job.id, job.attempts):
+            # The lease ran out and the job was handed to another worker
+            conn.rollback()
+            return True
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        job_log.warning('job %d (%s) failed on attempt %d of %d', job.id, job.kind,
+                        job.attempts, job.max_attempts, exc_info=True)
+        retry_at = time.time() + app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+        jobs.fail(job.id, job.attempts, f'{type(e).__name__}: {e}', retry_at)
+        conn.commit()
+        return True
+    if after_commit:
+        after_commit()
+    return True
+
+class JobQueue:
+    """Runs jobs on ``workers`` daemon threads, each with its own connection.
+
+    Idle workers look for work every ``poll`` seconds; ``wake`` lets a route
+    that has just committed a job skip the wait.
+    """
+
+    def __init__(self, database, workers, poll):
+        self.database = database
+        self.workers = workers
+        self.poll = poll
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def _work(self):
+        conn = connect_db(self.database)
+        try:
+            while not self._stopping.is_set():
+                self._wake.clear()
+                wait = self.poll
+                try:
+                    if run_next_job(conn):
+                        continue
+                    # Jobs re-enqueued with a short delay are not left waiting a whole poll
+                    run_after = JobRepo(conn).next_run_after()
+                    if run_after is not None:
+                        wait = min(wait, max(0, run_after - time.time()))
+                except Exception:
+                    # e.g. the database stayed locked past busy_timeout
+                    job_log.exception('job worker error')
+                    if conn.in_transaction:
+                        conn.rollback()
+                self._wake.wait(wait)
+        finally:
+            conn.close()
+
+    def stop(self, timeout=None):
+        """Stop the workers after the jobs they are running."""
+        self._stopping.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    # The pool creates the schema, so workers never start before the jobs table
+    get_pool()
+    with _job_queue_lock:
+        jobs = app.extensions.get('job_queue')
+        if jobs is None or jobs.database != app.config['DATABASE']:
+            if jobs is not None:
+                jobs.stop()
+            jobs = JobQueue(app.config['DATABASE'], app.config['JOB_WORKERS'], app.config['JOB_POLL_SECONDS'])
+            jobs.start()
+            app.extensions['job_queue'] = jobs
+        return jobs
+
+@app.before_request
+def start_job_workers():
+    # Jobs left by a previous process run without waiting for a new one
+    get_job_queue()
+
+@job_handler('medical_record_deleted')
+def notify_medical_record_deleted(conn, payload):
+    patient_id = payload['patient_id']
+    message = (f"Your medical record from {payload['created_at'].split()[0]} (Diagnosis: {payload['diagnosis']}) "
+               f"has been deleted by Dr. {payload['doctor_name']}")
+    notification_id = NotificationRepo(conn).create(patient_id, message, 'warning')
+    event = notification_event(conn, patient_id, notification_id)
+    return partial(event_broker.publish, patient_id, 'notification', event)
+
+@app.cli.command('jobs')
+@click.option('--dead', 'show_dead', is_flag=True, help='Also list dead jobs with their last error.')
+def jobs_command(show_dead):
+    """Show queued, running and dead jobs by kind."""
+    init_db()
+    conn = connect_db()
+    jobs = JobRepo(conn)
+    rows = jobs.status()
+    dead = jobs.dead() if show_dead else []
+    conn.close()
+    if not rows:
+        print('No jobs')
+    for row in rows:
+        print(f'{row.kind:<28} {row.status:<8} {row.jobs:>7}  oldest {row.oldest}')
+    for job in dead:
+        print(f'#{job.id} {job.kind} {job.payload} after {job.attempts} attempt(s): {job.last_error}')
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=int, default=1, show_default=True, help='Worker threads.')
+@click.option('--wait', is_flag=True, help='Keep running and wait for new jobs instead of exiting.')
+def run_jobs_command(workers, wait):
+    """Run ready jobs until the queue is drained, or for good with --wait.
+
+    Without --wait, jobs queued to run within JOB_POLL_SECONDS (such as the
+    next step of a retention run) are waited for; later ones, like retries
+    backing off, are left for the next run.
+    """
+    init_db()
+    if wait:
+        jobs = JobQueue(app.config['DATABASE'], workers, app.config['JOB_POLL_SECONDS'])
+        jobs.start()
+        print(f'Running jobs on {workers} thread(s); Ctrl+C to stop')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            jobs.stop()
+        return
+    
+    counts = []
+    
+    def drain():
+        conn = connect_db()
+        ran = 0
+        try:
+            while True:
+                if run_next_job(conn):
+                    ran += 1
+                    continue
+                run_after = JobRepo(conn).next_run_after()
+                delay = run_after - time.time() if run_after is not None else None
+                if delay is None or delay > app.config['JOB_POLL_SECONDS']:
+                    break
+                time.sleep(max(delay, 0))
+        finally:
+            conn.close()
+        counts.append(ran)
+    
+    threads = [threading.Thread(target=drain) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f'Processed {sum(counts)} job(s)')
+    conn = connect_db()
+    for row in JobRepo(conn).status():
+        print(f'{row.kind:<28} {row.status:<8} {row.jobs:>7}')
+    conn.close()
+
+@app.cli.command('retry-jobs')
+@click.argument('job_ids', nargs=-1, type=int)
+def retry_jobs_command(job_ids):
+    """Requeue the dead jobs JOB_IDS, or every dead job if none are given."""
+    init_db()
+    conn = connect_db()
+    count = JobRepo(conn).retry(job_ids or None, time.time())
+    conn.commit()
+    conn.close()
+    print(f'Requeued {count} job(s)')
+
+# Appointment reminders. A patient is notified REMINDER_LEAD_HOURS before each
+# pending or accepted appointment. One scheduler thread per process keeps the
+# appointments starting in the next REMINDER_LEAD_HOURS + REMINDER_WINDOW_HOURS
+# in a heap keyed by reminder time. It reads the appointments table only to
+# extend that window, a day at a time, and to pick up appointments booked by
+# other processes (by id, past the last id it has seen); bookings and status
+# changes made in this process update the heap directly. Due reminders are
+# sent REMINDER_BATCH at a time with one UPDATE and one INSERT ... SELECT, and
+# reminded_at makes sure each goes out once however many processes run this.
+REMINDER_MESSAGE = 'Reminder: you have an appointment with Dr. %s on %s at %s'
+
+class ReminderScheduler:
+    """Sends appointment reminders from an in-memory heap, on one thread."""
+
+    def __init__(self, database, lead, window, batch, tick):
+        self.database = database
+        self.lead = lead
+        self.window = window
+        self.batch = batch
+        self.tick = tick
+        self._heap = []
+        # appointment id -> reminder time of its live heap entry; entries
+        # that no longer match are stale and skipped when popped
+        self._due = {}
+        self._loaded_through = None
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='reminder-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _push(self, appointment_id, appointment_date, appointment_time, now):
+        try:
+            starts = datetime.fromisoformat(f'{appointment_date} {appointment_time}')
+        except ValueError:
+            return False
+        if starts <= now:
+            return False
+        remind_at = starts - self.lead
+        self._due[appointment_id] = remind_at
+        heapq.heappush(self._heap, (remind_at, appointment_id))
+        return self._heap[0][1] == appointment_id
+
+    def schedule(self, appointment_id, appointment_date, appointment_time, status):
+        """Add, move or drop one appointment's reminder after a committed change."""
+        with self._lock:
+            if self._loaded_through is None or appointment_date > self._loaded_through.isoformat():
+                # Not loaded yet; the window picks it up from the table
+                return
+            self._due.pop(appointment_id, None)
+            earliest = (status in REMINDER_STATUSES
+                        and self._push(appointment_id, appointment_date, appointment_time, datetime.now()))
+        if earliest:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._due)
+
+    def refresh(self, conn, now):
+        """Extend the window to ``now`` and add appointments booked elsewhere."""
+        reminders = ReminderRepo(conn)
+        last_day = (now + self.lead + self.window).date()
+        last_id = reminders.last_appointment_id()
+        rows = []
+        if self._loaded_through is None:
+            rows = reminders.upcoming(now.date().isoformat(), last_day.isoformat())
+        else:
+            if last_id > self._last_id:
+                rows = reminders.created_between(self._last_id, last_id, now.date().isoformat(),
+                                                 self._loaded_through.isoformat())
+            if last_day > self._loaded_through:
+                rows += reminders.upcoming((self._loaded_through + timedelta(days=1)).isoformat(),
+                                           last_day.isoformat())
+        with self._lock:
+            for row in rows:
+                self._push(row.id, row.appointment_date, row.appointment_time, now)
+            self._loaded_through = max(last_day, self._loaded_through or last_day)
+            self._last_id = last_id
+
+    def send_due(self, conn, now):
+        """Send every reminder due by ``now``; returns how many were sent."""
+        reminders = ReminderRepo(conn)
+        sent = 0
+        while True:
+            batch = []
+            with self._lock:
+                while self._heap and self._heap[0][0] <= now and len(batch) < self.batch:
+                    remind_at, appointment_id = heapq.heappop(self._heap)
+                    if self._due.get(appointment_id) != remind_at:
+                        continue
+                    del self._due[appointment_id]
+                    # Not worth sending once the appointment has started
+                    if remind_at + self.lead > now:
+                        batch.append((remind_at, appointment_id))
+            if not batch:
+                return sent
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                count, last_id = reminders.send([appointment_id for _, appointment_id in batch],
+                                                REMINDER_MESSAGE, now.strftime('%Y-%m-%d %H:%M:%S'))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                with self._lock:
+                    for remind_at, appointment_id in batch:
+                        if appointment_id not in self._due:
+                            self._due[appointment_id] = remind_at
+                            heapq.heappush(self._heap, (remind_at, appointment_id))
+                raise
+            if count:
+                publish_broadcast(conn, last_id - count + 1, last_id)
+            sent += count
+
+    def _sleep_time(self):
+        with self._lock:
+            if not self._heap:
+                return self.tick
+            return min(self.tick, max(0, (self._heap[0][0] - datetime.now()).total_seconds()))
+
+    def _run(self):
+        conn = connect_db(self.database)
+        try:
+            while not self._stopping.is_set():
+                self._wake.clear()
+                try:
+                    now = datetime.now()
+                    self.refresh(conn, now)
+                    sent = self.send_due(conn, now)
+                    if sent:
+                        reminder_log.info('sent %d appointment reminder(s)', sent)
+                except Exception:
+                    reminder_log.exception('reminder scheduler error')
+                    if conn.in_transaction:
+                        conn.rollback()
+                self._wake.wait(self._sleep_time())
+        finally:
+            conn.close()
+
+_reminder_lock = threading.Lock()
+
+def get_reminder_scheduler():
+    get_pool()
+    with _reminder_lock:
+        scheduler = app.extensions.get('reminder_scheduler')
+        if scheduler is None or scheduler.database != app.config['DATABASE']:
+            if scheduler is not None:
+                scheduler.stop()
+            scheduler = ReminderScheduler(app.config['DATABASE'],
+                                          timedelta(hours=app.config['REMINDER_LEAD_HOURS']),
+                                          timedelta(hours=app.config['REMINDER_WINDOW_HOURS']),
+                                          app.config['REMINDER_BATCH'], app.config['REMINDER_TICK_SECONDS'])
+            # A scheduler that is never started loads nothing and ignores updates
+            if app.config['REMINDERS_ENABLED']:
+                scheduler.start()
+            app.extensions['reminder_scheduler'] = scheduler
+        return scheduler
+
+@app.before_request
+def start_reminder_scheduler():
+    get_reminder_scheduler()
+
+# Notification retention. Read notifications older than
+# NOTIFICATION_RETENTION_DAYS are deleted, as are a user's read notifications
+# beyond their newest NOTIFICATION_HISTORY_CAP; unread ones are never removed.
+# A run is a chain of 'notification_retention' jobs, each deleting one chunk
+# of RETENTION_CHUNK rows in the transaction that completes it and carrying
+# the run's state to the next, so locks are held briefly and an interrupted
+# run resumes where it stopped. The last step hands freed pages back to the
+# file system with PRAGMA incremental_vacuum, VACUUM_PAGES at a time, logs
+# what the run reclaimed and schedules the next run RETENTION_INTERVAL_HOURS
+# later. Migration 11 queues the first run.
+def database_bytes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return page_size * page_count, page_size * free_pages
+
+def incremental_vacuum(conn, pages):
+    """Release up to ``pages`` free pages; returns the bytes released.
+
+    Only does anything with auto_vacuum=INCREMENTAL. Must be called outside
+    a transaction.
+    """
+    before, _ = database_bytes(conn)
+    # The pragma frees one page per step and sqlite3's execute() steps a
+    # statement without result columns only once; executescript() runs it
+    # to completion
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+    after, _ = database_bytes(conn)
+    return before - after
+
+def notification_retention_step(conn, state, retention_days, history_cap, chunk_size, vacuum_pages):
+    """Do one chunk of a retention run; returns the next state, or None when done.
+
+    ``state`` is the JSON-able dict returned by the previous step ({} to
+    start) and is updated in place. A deleting step leaves its transaction
+    open for the caller to commit; the vacuum step runs outside one. A
+    policy set to 0 or None is skipped.
+    """
+    notifications = NotificationRepo(conn)
+    if 'phase' not in state:
+        state.update(phase='expire', started=time.time(), expired=0, capped=0, reclaimed_bytes=0,
+                     database_bytes=database_bytes(conn)[0])
+    
+    if state['phase'] == 'expire':
+        deleted = notifications.delete_expired(f'-{int(retention_days)} days', chunk_size) if retention_days else 0
+        state['expired'] += deleted
+        if deleted < chunk_size:
+            state.update(phase='cap' if history_cap else 'vacuum', after_user=0, cap_user=None)
+        return state
+    
+    if state['phase'] == 'cap':
+        if state['cap_user'] is None:
+            # A read-only step: look through the next chunk_size users, in
+            # user id order, for one over the cap; only the cursor is kept
+            user_id, last_user = notifications.next_over_cap(state['after_user'], history_cap, chunk_size)
+            if last_user is None:
+                state['phase'] = 'vacuum'
+            else:
+                state['cap_user'] = user_id
+                state['after_user'] = last_user if user_id is None else user_id
+            return state
+        deleted = notifications.delete_over_cap(state['cap_user'], history_cap, chunk_size)
+        state['capped'] += deleted
+        if deleted < chunk_size:
+            state['cap_user'] = None
+        return state
+    
+    released = incremental_vacuum(conn, vacuum_pages) if vacuum_pages else 0
+    state['reclaimed_bytes'] += released
+    if released and database_bytes(conn)[1]:
+        return state
+    return None
+
+def retention_report(conn, state):
+    size, free = database_bytes(conn)
+    return {
+        'expired': state['expired'],
+        'capped': state['capped'],
+        'reclaimed_bytes': state['reclaimed_bytes'],
+        'database_bytes_before': state['database_bytes'],
+        'database_bytes_after': size,
+        'free_bytes': free,
+        'auto_vacuum': conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2,
+        'seconds': round(time.time() - state['started'], 1),
+    }
+
+@job_handler('notification_retention')
+def run_notification_retention(conn, payload):
+    state = notification_retention_step(conn, payload, app.config['NOTIFICATION_RETENTION_DAYS'],
+                                        app.config['NOTIFICATION_HISTORY_CAP'], app.config['RETENTION_CHUNK'],
+                                        app.config['VACUUM_PAGES'])
+    if state is not None:
+        enqueue_job(conn, 'notification_retention', state, delay=app.config['RETENTION_PAUSE'])
+        return None
+    report = retention_report(conn, payload)
+    job_log.info('notification retention: %d expired and %d over the cap deleted, %d bytes reclaimed',
+                 report['expired'], report['capped'], report['reclaimed_bytes'])
+    if not report['auto_vacuum']:
+        job_log.info('free pages stay in the database file until `flask enable-incremental-vacuum` is run')
+    enqueue_job(conn, 'notification_retention', {'last_report': report},
+                delay=app.config['RETENTION_INTERVAL_HOURS'] * 3600)
+    return None
+
+@app.cli.command('compact-notifications')
+@click.option('--retention-days', type=int, help='Delete read notifications older than this '
+              '(default NOTIFICATION_RETENTION_DAYS, 0 to skip).')
+@click.option('--cap', type=int, help="Keep at most this many of each user's read notifications; unread "
+              'ones are never deleted (default NOTIFICATION_HISTORY_CAP, 0 to skip).')
+@click.option('--vacuum-pages', type=int, help='Free pages released per step (default VACUUM_PAGES, 0 to skip).')
+def compact_notifications_command(retention_days, cap, vacuum_pages):
+    """Apply the notification retention policies now and report what was reclaimed."""
+    init_db()
+    conn = connect_db()
+    state = {}
+    try:
+        while True:
+            step = notification_retention_step(
+                conn, state,
+                app.config['NOTIFICATION_RETENTION_DAYS'] if retention_days is None else retention_days,
+                app.config['NOTIFICATION_HISTORY_CAP'] if cap is None else cap,
+                app.config['RETENTION_CHUNK'],
+                app.config['VACUUM_PAGES'] if vacuum_pages is None else vacuum_pages)
+            conn.commit()
+            if step is None:
+                break
+            time.sleep(app.config['RETENTION_PAUSE'])
+        report = retention_report(conn, state)
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+
+@app.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+    """Switch the database to auto_vacuum=INCREMENTAL; rewrites the file with VACUUM."""
+    init_db()
+    conn = connect_db()
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            print('auto_vacuum is already INCREMENTAL')
+            return
+        before, _ = database_bytes(conn)
+        # The new mode is only applied by a VACUUM, which needs the write lock
+        # for the whole rewrite and cannot run inside a transaction
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        after, _ = database_bytes(conn)
+    finally:
+        conn.close()
+    print(f'auto_vacuum is now INCREMENTAL; database went from {before} to {after} bytes')
+
+# Request metrics, served at /metrics in the Prometheus text format. Each
+# request adds to a few in-memory counters; the text is only built when
+# /metrics is scraped.
+HTTP_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {cumulative}'
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.sql_statements = {}
+        self.sql_seconds = {}
+        self.slow_queries = 0
+
+    def observe_request(self, endpoint, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if endpoint not in self.durations:
+                self.durations[endpoint] = Histogram(HTTP_DURATION_BUCKETS)
+                self.sql_statements[endpoint] = Histogram(SQL_STATEMENT_BUCKETS)
+                self.sql_seconds[endpoint] = 0.0
+            self.durations[endpoint].observe(seconds)
+            self.sql_statements[endpoint].observe(statements)
+            self.sql_seconds[endpoint] += sql_seconds
+
+    def slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP hms_http_requests_total Requests handled, by endpoint, method and status.',
+                     '# TYPE hms_http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'hms_http_requests_total{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {count}')
+            lines += ['# HELP hms_http_request_duration_seconds Time to build the response.',
+                      '# TYPE hms_http_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.durations.items()):
+                lines.extend(histogram.lines('hms_http_request_duration_seconds', f'endpoint="{endpoint}"'))
+            lines += ['# HELP hms_sql_statements_per_request SQL statements run by one request.',
+                      '# TYPE hms_sql_statements_per_request histogram']
+            for endpoint, histogram in sorted(self.sql_statements.items()):
+                lines.extend(histogram.lines('hms_sql_statements_per_request', f'endpoint="{endpoint}"'))
+            lines += ['# HELP hms_sql_seconds_total Time spent in SQLite, by endpoint.',
+                      '# TYPE hms_sql_seconds_total counter']
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                lines.append(f'hms_sql_seconds_total{{endpoint="{endpoint}"}} {seconds}')
+            lines += ['# HELP hms_slow_queries_total Statements slower than SLOW_QUERY_MS.',
+                      '# TYPE hms_slow_queries_total counter',
+                      f'hms_slow_queries_total {self.slow_queries}']
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is None or not app.config['METRICS_ENABLED']:
+        return response
+    conn = g.get('db')
+    statements, sql_seconds = (conn.statements, conn.sql_seconds) if conn is not None else (0, 0.0)
+    # Unmatched URLs share one label so scanners cannot grow the label set
+    metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                            time.perf_counter() - started, statements, sql_seconds)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Conditional GET for the catalogue pages. The ETag covers the table_versions
+# counters a page reads plus everything else its template depends on: the
+# viewer's name and type, and the date for pages with daily figures. The
+# rendered HTML is shared by every viewer of the same type: it is rendered
+# with VIEWER_NAME_SLOT in place of the name in the nav bar, which is filled
+# in per response. An unchanged page is neither queried nor rendered again.
+CATALOG_PAGES = {
+    'view_departments': (('departments', 'department_stats'), True),
+    'view_medications': (('medications',), False),
+}
+# base.html writes this when g.shared_page is set. Escaped template output
+# never contains '<', so page content cannot forge it.
+VIEWER_NAME_SLOT = '<!--viewer-name-->'
+
+def catalog_etag(conn, page, user_name, user_type):
+    """Returns ``(etag, page_key)``; ``page_key`` leaves out the viewer's name."""
+    tables, daily = CATALOG_PAGES[page]
+    versions = CatalogRepo(conn).versions(tables)
+    key = (page, versions, date.today().isoformat() if daily else None, user_type)
+    page_key = hashlib.sha1(repr(key).encode()).hexdigest()
+    return hashlib.sha1(repr((page_key, user_name)).encode()).hexdigest(), page_key
+
+def fill_viewer_name(html, user_name):
+    return html.replace(VIEWER_NAME_SLOT, str(escape(user_name or '')), 1)
+
+class PageCache:
+    """Rendered pages by key, least recently used dropped first.
+
+    Holds at most ``max_bytes`` of HTML, counted as UTF-8; a page larger
+    than that is not kept at all.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._pages.get(key)
+            if entry is None:
+                return None
+            self._pages.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, html):
+        size = len(html.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._pages[key] = (html, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, dropped) = self._pages.popitem(last=False)
+                self.bytes -= dropped
+
+page_cache = PageCache(app.config['PAGE_CACHE_BYTES'])
+
+def conditional_page(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Flashed messages are shown once, so those responses are never reused
+        if session.get('_flashes'):
+            return f(*args, **kwargs)
+        etag, page_key = catalog_etag(get_db(), request.endpoint,
+                                      session.get('user_name'), session.get('user_type'))
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            html = page_cache.get(page_key)
+            if html is None:
+                g.shared_page = True
+                html = f(*args, **kwargs)
+                page_cache.put(page_key, html)
+            response = Response(fill_viewer_name(html, session.get('user_name')), mimetype='text/html')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return decorated_function
+
+# Routes
+@app.route('/')
+def index():
+    if 'user_id' in session:
+        if session['user_type'] == 'doctor':
+            return redirect(url_for('doctor_dashboard'))
+        else:
+            return redirect(url_for('patient_dashboard'))
+    return redirect(url_for('login'))
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        
+        conn = get_db()
+        users = UserRepo(conn)
+        user = users.credentials(email)
+        
+        hasher = get_password_hasher()
+        method = app.config['PASSWORD_HASH_METHOD']
+        try:
+            valid = user is not None and hasher.verify(user.password_hash, password)
+        except PasswordHasherBusy:
+            flash('Too many sign-ins at once. Please try again in a moment.')
+            return render_template('login.html'), 503
+        
+        if valid and hasher.needs_rehash(user.password_hash, method):
+            # Upgrade to the current hash policy; a busy hasher just leaves
+            # it for the next login
+            try:
+                users.replace_password_hash(user.id, user.password_hash, hasher.hash(password, method))
+                conn.commit()
+            except PasswordHasherBusy:
+                pass
+        
+        if valid:
+            session['user_id'] = user.id
+            session['user_name'] = user.name
+            session['user_type'] = user.user_type
+            
+            if user.user_type == 'doctor':
+                return redirect(url_for('doctor_dashboard'))
+            else:
+                return redirect(url_for('patient_dashboard'))
+        else:
+            flash('Invalid email or password')
+    
+    return render_template('login.html')
+
+@app.route('/register', methods=['GET', 'POST'])
+def register():
+    if request.method == 'POST':
+        name = request.form['name']
+        email = request.form['email']
+        password = request.form['password']
+        user_type = request.form['user_type']
+        phone = request.form['phone']
+        specialization = request.form.get('specialization', '')
+        
+        try:
+            password_hash = get_password_hasher().hash(password, app.config['PASSWORD_HASH_METHOD'])
+        except PasswordHasherBusy:
+            flash('Too many requests at once. Please try again in a moment.')
+            return render_template('register.html'), 503
+        
+        try:
+            conn = get_db()
+            UserRepo(conn).create(name, email, password_hash, user_type, phone, specialization)
+            conn.commit()
+            
+            flash('Registration successful! Please login.')
+            return redirect(url_for('login'))
+        except sqlite3.IntegrityError:
+            flash('Email already exists')
+    
+    return render_template('register.html')
+
+@app.route('/patient/dashboard')
+@patient_required
+def patient_dashboard():
+    context = patient_dashboard_context(get_db(), session['user_id'], request.args)
+    return render_template('patient_dashboard.html', **context)
+
+@app.route('/api/patient/dashboard')
+@patient_required
+def patient_dashboard_json():
+    history = patient_history(get_db(), session['user_id'], request.args)
+    return jsonify(history_json(history))
+
+@app.route('/doctor/dashboard')
+@doctor_required
+def doctor_dashboard():
+    context = doctor_history(get_db(), session['user_id'], request.args)
+    return render_template('doctor_dashboard.html', **context)
+
+@app.route('/api/doctor/dashboard')
+@doctor_required
+def doctor_dashboard_json():
+    history = doctor_history(get_db(), session['user_id'], request.args)
+    return jsonify(history_json(history))
+
+@app.route('/schedule-appointment', methods=['POST'])
+@patient_required
+def schedule_appointment():
+    doctor_id = request.form['doctor_id']
+    appointment_date = request.form['appointment_date']
+    appointment_time = request.form['appointment_time']
+    notes = request.form['notes']
+    
+    try:
+        day = date.fromisoformat(appointment_date)
+        to_minutes(appointment_time)
+    except ValueError:
+        flash('Invalid appointment date or time.')
+        return redirect(url_for('patient_dashboard'))
+    
+    conn = get_db()
+    
+    if not UserRepo(conn).is_doctor(doctor_id):
+        flash('Please choose a doctor from the list.')
+        return redirect(url_for('patient_dashboard'))
+    
+    if appointment_time not in free_slots(conn, doctor_id, day, day).get(appointment_date, ()):
+        flash('That time slot is not available. Please choose another.')
+        return redirect(url_for('patient_dashboard'))
+    
+    # Re-check and insert under the write lock so two patients racing for the
+    # same slot cannot both get it
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if slot_conflict(conn, doctor_id, appointment_date, appointment_time):
+            conn.rollback()
+            flash('That time slot was just booked. Please choose another.')
+            return redirect(url_for('patient_dashboard'))
+        appointment_id = AppointmentRepo(conn).create(session['user_id'], doctor_id, appointment_date,
+                                                      appointment_time, notes)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    get_reminder_scheduler().schedule(appointment_id, appointment_date, appointment_time, 'pending')
+    
+    flash('Appointment scheduled successfully!')
+    return redirect(url_for('patient_dashboard'))
+
+@app.route('/api/doctors/<int:doctor_id>/free-slots')
+@login_required
+def doctor_free_slots(doctor_id):
+    try:
+        start = date.fromisoformat(request.args.get('start') or date.today().isoformat())
+        end = date.fromisoformat(request.args.get('end') or start.isoformat())
+    except ValueError:
+        abort(400, 'start and end must be YYYY-MM-DD dates')
+    if (end - start).days >= app.config['MAX_SLOT_RANGE_DAYS']:
+        abort(400, f"At most {app.config['MAX_SLOT_RANGE_DAYS']} days per request")
+    
+    conn = get_db()
+    if not UserRepo(conn).is_doctor(doctor_id):
+        abort(404)
+    
+    return jsonify({'doctor_id': doctor_id, 'slots': free_slots(conn, doctor_id, start, end)})
+
+@app.route('/doctor/update-appointment', methods=['POST'])
+@doctor_required
 def update_appointment():
     data = request.get_json()
     appointment_id = data['appointment_id']
     status = data['status']
-    
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE appointments SET status = ? WHERE id = ? AND doctor_id = ?
-    ''', (status, appointment_id, session['user_id']))
+    if status not in APPOINTMENT_STATUSES:
+        return jsonify({'success': False, 'error': 'invalid status'}), 400
+    
+    conn = get_db()
+    appointments = AppointmentRepo(conn)
+    updated = appointments.set_status(session['user_id'], appointment_id, status)
+    patient_id = appointments.patient_id(session['user_id'], appointment_id)
+    appointment = appointments.doctor_appointment(session['user_id'], appointment_id)
     conn.commit()
-    conn.close()
     
-    return jsonify({'success': True})
+    if not (updated and patient_id is not None):
+        return jsonify({'success': False})
+    
+    get_reminder_scheduler().schedule(appointment.id, appointment.appointment_date,
+                                      appointment.appointment_time, appointment.status)
+    event = {'id': appointment_id, 'status': status}
+    event_broker.publish(patient_id, 'appointment', event)
+    event_broker.publish(session['user_id'], 'appointment', event)
+    
+    # Hand back the changed row so the dashboard can patch it in place
+    return jsonify({
+        'success': True,
+        'appointment': appointment.as_dict(),
+        'html': render_template('_doctor_appointment_row.html', appointment=appointment)
+    })
+
+@app.route('/doctor/update-appointments', methods=['POST'])
+@doctor_required
+def update_appointments():
+    """Apply ``{"updates": [{"appointment_id", "status"}, ...]}`` at once.
+
+    Ownership is checked for every item, then each status group is written
+    with one UPDATE, all in a single transaction. The changed rows are read
+    back and rendered after the commit, with the write lock released. The
+    response lists one result per item, in request order.
+    """
+    updates = (request.get_json(silent=True) or {}).get('updates')
+    if not isinstance(updates, list) or not updates:
+        return jsonify({'success': False, 'error': 'updates must be a non-empty list'}), 400
+    if len(updates) > app.config['MAX_BATCH_UPDATE']:
+        return jsonify({'success': False,
+                        'error': f"at most {app.config['MAX_BATCH_UPDATE']} updates per request"}), 400
+    
+    results = []
+    wanted = {}
+    for item in updates:
+        item = item if isinstance(item, dict) else {}
+        appointment_id = item.get('appointment_id')
+        status = item.get('status')
+        result = {'appointment_id': appointment_id, 'status': status, 'success': False}
+        results.append(result)
+        if not isinstance(appointment_id, int) or isinstance(appointment_id, bool):
+            result['error'] = 'invalid appointment_id'
+        elif status not in APPOINTMENT_STATUSES:
+            result['error'] = 'invalid status'
+        elif appointment_id in wanted:
+            result['error'] = 'duplicate appointment_id'
+        else:
+            wanted[appointment_id] = result
+    
+    conn = get_db()
+    appointments = AppointmentRepo(conn)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        owned = appointments.patient_ids(session['user_id'], wanted)
+        
+        groups = {}
+        for appointment_id, result in wanted.items():
+            if appointment_id in owned:
+                groups.setdefault(result['status'], []).append(appointment_id)
+            else:
+                result['error'] = 'appointment not found'
+        
+        for status, group in groups.items():
+            appointments.set_statuses(session['user_id'], group, status)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    events = []
+    for status, group in groups.items():
+        for appointment_id in group:
+            wanted[appointment_id]['success'] = True
+            events.append((owned[appointment_id], {'id': appointment_id, 'status': status}))
+    changed = appointments.doctor_appointments(session['user_id'], owned)
+    for appointment in changed:
+        wanted[appointment.id]['html'] = render_template('_doctor_appointment_row.html', appointment=appointment)
+    
+    reminders = get_reminder_scheduler()
+    for appointment in changed:
+        reminders.schedule(appointment.id, appointment.appointment_date, appointment.appointment_time,
+                           appointment.status)
+    for patient_id, event in events:
+        event_broker.publish(patient_id, 'appointment', event)
+        event_broker.publish(session['user_id'], 'appointment', event)
+    
+    return jsonify({'success': all(result['success'] for result in results), 'results': results})
 
 @app.route('/doctor/medical-record', methods=['POST'])
 @doctor_required
@@ -348,96 +2803,75 @@ def create_medical_record():
     prescription = data['prescription']
     notes = data['notes']
     
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    conn = get_db()
+    patient_id = AppointmentRepo(conn).patient_id(session['user_id'], appointment_id)
+    if patient_id is None:
+        return jsonify({'success': False})
     
-    # Get patient_id from appointment
-    cursor.execute('SELECT patient_id FROM appointments WHERE id = ? AND doctor_id = ?', 
-                   (appointment_id, session['user_id']))
-    result = cursor.fetchone()
-    
-    if result:
-        patient_id = result[0]
-        cursor.execute('''
-            INSERT INTO medical_records (appointment_id, patient_id, doctor_id, diagnosis, prescription, notes)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (appointment_id, patient_id, session['user_id'], diagnosis, prescription, notes))
-        conn.commit()
-        
-    conn.close()
+    records = MedicalRecordRepo(conn)
+    record_id = records.create(appointment_id, patient_id, session['user_id'], diagnosis, prescription, notes)
+    record = records.doctor_record(session['user_id'], record_id)
+    conn.commit()
     
-    return jsonify({'success': True})
+    return jsonify({
+        'success': True,
+        'record': record.as_dict(),
+        'html': render_template('_doctor_record_row.html', record=record)
+    })
 
 @app.route('/doctor/delete-medical-record/<int:record_id>', methods=['POST'])
 @doctor_required
 def delete_medical_record(record_id):
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
+    conn = get_db()
+    records = MedicalRecordRepo(conn)
     
     # Get record details before deletion
-    cursor.execute('''
-        SELECT mr.patient_id, u.name as patient_name, mr.diagnosis, mr.created_at
-        FROM medical_records mr
-        JOIN users u ON mr.patient_id = u.id
-        WHERE mr.id = ? AND mr.doctor_id = ?
-    ''', (record_id, session['user_id']))
-    record_info = cursor.fetchone()
+    record = records.summary(session['user_id'], record_id)
     
-    if record_info:
-        patient_id, patient_name, diagnosis, created_at = record_info
-        
-        # Delete the medical record
-        cursor.execute('DELETE FROM medical_records WHERE id = ? AND doctor_id = ?', 
-                       (record_id, session['user_id']))
+    if record:
+        records.delete(session['user_id'], record_id)
         
-        # Create notification for patient
-        notification_message = f"Your medical record from {created_at.split()[0]} (Diagnosis: {diagnosis}) has been deleted by Dr. {session['user_name']}"
-        cursor.execute('''
-            INSERT INTO notifications (user_id, message, type)
-            VALUES (?, ?, ?)
-        ''', (patient_id, notification_message, 'warning'))
+        # The patient is notified by a job that commits together with the delete
+        enqueue_job(conn, 'medical_record_deleted', {
+            'patient_id': record.patient_id,
+            'created_at': record.created_at,
+            'diagnosis': record.diagnosis,
+            'doctor_name': session['user_name'],
+        })
         
         conn.commit()
+        get_job_queue().wake()
         success = True
     else:
         success = False
     
-    conn.close()
-    
     return jsonify({'success': success})
 
 @app.route('/notifications')
 @login_required
 def get_notifications():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, message, type, is_read, created_at
-        FROM notifications
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    ''', (session['user_id'],))
-    notifications = cursor.fetchall()
-    
-    conn.close()
-    
-    return render_template('notifications.html', notifications=notifications)
+    context = notifications_context(get_db(), session['user_id'], request.args)
+    return render_template('notifications.html', **context)
+
+@app.route('/api/notifications')
+@login_required
+def get_notifications_json():
+    context = notifications_context(get_db(), session['user_id'], request.args)
+    return jsonify(notifications_json(context))
 
 @app.route('/mark-notification-read/<int:notification_id>', methods=['POST'])
 @login_required
 def mark_notification_read(notification_id):
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE notifications SET is_read = 1 
-        WHERE id = ? AND user_id = ?
-    ''', (notification_id, session['user_id']))
+    conn = get_db()
+    notifications = NotificationRepo(conn)
+    notifications.mark_read(session['user_id'], notification_id)
+    unread = notifications.unread_count(session['user_id'])
     conn.commit()
-    conn.close()
     
-    return jsonify({'success': True})
+    # Keep the badge and other open notification pages in step
+    event_broker.publish(session['user_id'], 'notification_read', {'id': notification_id, 'unread': unread})
+    
+    return jsonify({'success': True, 'unread': unread})
 
 @app.route('/logout')
 def logout():
@@ -446,47 +2880,15 @@ def logout():
 
 @app.route('/departments')
 @login_required
+@conditional_page
 def view_departments():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT d.id, d.name, d.description, d.phone, d.location, u.name as head_doctor
-        FROM departments d
-        LEFT JOIN users u ON d.head_doctor_id = u.id
-        ORDER BY d.name
-    ''')
-    departments = cursor.fetchall()
-    
-    # Get doctors for each department
-    cursor.execute('''
-        SELECT d.id, COUNT(u.id) as doctor_count
-        FROM departments d
-        LEFT JOIN users u ON u.specialization = d.name AND u.user_type = 'doctor'
-        GROUP BY d.id
-    ''')
-    doctor_counts = dict(cursor.fetchall())
-    
-    conn.close()
-    
-    return render_template('departments.html', departments=departments, doctor_counts=doctor_counts)
+    return render_template('departments.html', **departments_context(get_db()))
 
 @app.route('/medications')
 @login_required
+@conditional_page
 def view_medications():
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer
-        FROM medications
-        ORDER BY name
-    ''')
-    medications = cursor.fetchall()
-    
-    conn.close()
-    
-    return render_template('medications.html', medications=medications)
+    return render_template('medications.html', **medications_context(get_db()))
 
 @app.route('/admin/departments', methods=['GET', 'POST'])
 @doctor_required
@@ -497,18 +2899,13 @@ def manage_departments():
         phone = request.form['phone']
         location = request.form['location']
         
-        conn = sqlite3.connect('hospital.db')
-        cursor = conn.cursor()
+        conn = get_db()
         try:
-            cursor.execute('''
-                INSERT INTO departments (name, description, phone, location)
-                VALUES (?, ?, ?, ?)
-            ''', (name, description, phone, location))
+            CatalogRepo(conn).add_department(name, description, phone, location)
             conn.commit()
             flash('Department added successfully!')
         except sqlite3.IntegrityError:
             flash('Department name already exists!')
-        conn.close()
     
     return redirect(url_for('view_departments'))
 
@@ -525,1044 +2922,227 @@ def manage_medications():
         stock_quantity = int(request.form['stock_quantity'])
         manufacturer = request.form['manufacturer']
         
-        conn = sqlite3.connect('hospital.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO medications (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer))
+        conn = get_db()
+        CatalogRepo(conn).add_medication(name, generic_name, description, dosage, side_effects, price,
+                                         stock_quantity, manufacturer)
         conn.commit()
-        conn.close()
+        medication_catalog.invalidate()
         
         flash('Medication added successfully!')
     
     return redirect(url_for('view_medications'))
 
+def medication_search_terms(query):
+    # Every word of the query must match the start of a word in the name,
+    # generic name or description. Words are quoted so FTS5 syntax in user
+    # input is never interpreted.
+    words = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{word}"*' for word in words)
+
+def search_medication_catalog(conn, query, limit=10):
+    terms = medication_search_terms(query)
+    if not terms:
+        return []
+    return CatalogRepo(conn).search_medications(terms, query, limit)
+
+# Medication catalog cache. The catalogue is read on every /medications view
+# and every typeahead keystroke but only written through manage_medications,
+# so both are served from an immutable in-memory snapshot.
+def fold_words(text):
+    # Same word splitting as the FTS5 unicode61 tokenizer with diacritics removed
+    text = unicodedata.normalize('NFKD', text or '').lower()
+    return re.findall(r'\w+', ''.join(ch for ch in text if not unicodedata.combining(ch)))
+
+class CatalogSnapshot:
+    """Medication rows as of one table version plus a prefix word index."""
+
+    # Relevance weight of a word match in name, generic_name and description,
+    # mirroring the bm25 column weights of the SQL search.
+    FIELD_WEIGHTS = (10, 5, 1)
+
+    def __init__(self, version, rows):
+        self.version = version
+        # Medication rows, ordered by name
+        self.rows = rows
+        self.by_id = {row.id: row for row in rows}
+        self.fields = {}
+        postings = {}
+        for row in rows:
+            fields = tuple(frozenset(fold_words(text)) for text in (row.name, row.generic_name, row.description))
+            self.fields[row.id] = fields
+            for word in frozenset().union(*fields):
+                postings.setdefault(word, set()).add(row.id)
+        self.words = sorted(postings)
+        self.postings = postings
+
+    def _prefix_matches(self, prefix):
+        ids = set()
+        start = bisect.bisect_left(self.words, prefix)
+        for word in itertools.islice(self.words, start, None):
+            if not word.startswith(prefix):
+                break
+            ids |= self.postings[word]
+        return ids
+
+    def search(self, query, limit=10):
+        words = fold_words(query)
+        if not words:
+            return []
+        matches = None
+        for word in words:
+            ids = self._prefix_matches(word)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        
+        query = query.strip().lower()
+        def rank(med_id):
+            row = self.by_id[med_id]
+            name = row.name.lower()
+            if name == query:
+                tier = 0
+            elif name.startswith(query):
+                tier = 1
+            else:
+                tier = 2
+            score = sum(weight
+                        for word in words
+                        for weight, field in zip(self.FIELD_WEIGHTS, self.fields[med_id])
+                        if any(w.startswith(word) for w in field))
+            return (tier, -score, row.name)
+        
+        best = heapq.nsmallest(limit, matches, key=rank)
+        return [MedicationMatch(row.id, row.name, row.generic_name, row.dosage, row.price)
+                for row in map(self.by_id.get, best)]
+
+class MedicationCatalog:
+    """Process-wide medication snapshot with write-through invalidation.
+
+    Writers in this process call :meth:`invalidate` after committing. Writes
+    made elsewhere are noticed through ``PRAGMA data_version``, which changes
+    for a connection whenever another connection commits; only then is the
+    medications entry in ``table_versions`` compared with the snapshot.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+        # Keyed by the connection itself: ids are reused once the pool closes
+        # a connection, and every new connection starts at the same version
+        self._seen_data_version = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self):
+        self._snapshot = None
+        self.invalidations += 1
+
+    def _is_current(self, conn, snapshot):
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._seen_data_version.get(conn) == data_version:
+            return True
+        if CatalogRepo(conn).medications_version() != snapshot.version:
+            return False
+        self._seen_data_version[conn] = data_version
+        return True
+
+    def _load(self, conn):
+        """Returns the snapshot and the ``data_version`` it was read at."""
+        catalog = CatalogRepo(conn)
+        # One read transaction so the version and data_version match the rows
+        in_transaction = conn.in_transaction
+        if not in_transaction:
+            conn.execute('BEGIN')
+        try:
+            version = catalog.medications_version()
+            rows = tuple(catalog.medications())
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        finally:
+            if not in_transaction:
+                conn.rollback()
+        return CatalogSnapshot(version, rows), data_version
+
+    def snapshot(self, conn):
+        snapshot = self._snapshot
+        if snapshot is not None and self._is_current(conn, snapshot):
+            self.hits += 1
+            return snapshot
+        with self._lock:
+            # Another thread may have reloaded while we waited
+            snapshot = self._snapshot
+            if snapshot is not None and self._is_current(conn, snapshot):
+                self.hits += 1
+                return snapshot
+            self.misses += 1
+            self._seen_data_version.clear()
+            snapshot, self._seen_data_version[conn] = self._load(conn)
+            self._snapshot = snapshot
+            return snapshot
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'version': snapshot.version if snapshot else None,
+            'size': len(snapshot.rows) if snapshot else 0
+        }
+
+medication_catalog = MedicationCatalog()
+
 @app.route('/api/medications/search')
 @doctor_required
 def search_medications():
     query = request.args.get('q', '')
-    
-    conn = sqlite3.connect('hospital.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, name, generic_name, dosage, price
-        FROM medications
-        WHERE name LIKE ? OR generic_name LIKE ?
-        ORDER BY name
-        LIMIT 10
-    ''', (f'%{query}%', f'%{query}%'))
-    medications = cursor.fetchall()
-    conn.close()
-    
-    return jsonify([{
-        'id': med[0],
-        'name': med[1],
-        'generic_name': med[2],
-        'dosage': med[3],
-        'price': med[4]
-    } for med in medications])
-
-def create_templates():
-    """Create all template files"""
-    
-    # Base template
-    base_template = '''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>{% block title %}Hospital Management System{% endblock %}</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: #0a0a0a;
-            color: #fafafa;
-            line-height: 1.6;
-            min-height: 100vh;
-        }
-        
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 20px;
-        }
-        
-        .nav {
-            background: #111;
-            padding: 1rem 0;
-            border-bottom: 1px solid #333;
-            margin-bottom: 2rem;
-        }
-        
-        .nav-content {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 0 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        
-        .nav h1 {
-            color: #fff;
-            font-size: 1.5rem;
-        }
-        
-        .nav-links {
-            display: flex;
-            gap: 1rem;
-            align-items: center;
-        }
-        
-        .btn {
-            background: #fff;
-            color: #000;
-            border: none;
-            padding: 0.75rem 1.5rem;
-            border-radius: 8px;
-            text-decoration: none;
-            font-weight: 500;
-            cursor: pointer;
-            transition: all 0.2s ease;
-            display: inline-block;
-            font-size: 0.9rem;
-        }
-        
-        .btn:hover {
-            background: #e6e6e6;
-            transform: translateY(-1px);
-        }
-        
-        .btn-secondary {
-            background: transparent;
-            color: #fff;
-            border: 1px solid #333;
-        }
-        
-        .btn-secondary:hover {
-            background: #333;
-            color: #fff;
-        }
-        
-        .btn-danger {
-            background: #dc2626;
-            color: #fff;
-        }
-        
-        .btn-danger:hover {
-            background: #b91c1c;
-        }
-        
-        .form-container {
-            max-width: 400px;
-            margin: 2rem auto;
-            background: #111;
-            padding: 2rem;
-            border-radius: 12px;
-            border: 1px solid #333;
-        }
-        
-        .form-group {
-            margin-bottom: 1rem;
-        }
-        
-        .form-group label {
-            display: block;
-            margin-bottom: 0.5rem;
-            color: #ccc;
-            font-weight: 500;
-        }
-        
-        .form-control {
-            width: 100%;
-            padding: 0.75rem;
-            background: #1a1a1a;
-            border: 1px solid #333;
-            border-radius: 8px;
-            color: #fff;
-            font-size: 1rem;
-        }
-        
-        .form-control:focus {
-            outline: none;
-            border-color: #666;
-            background: #222;
-        }
-        
-        .card {
-            background: #111;
-            border: 1px solid #333;
-            border-radius: 12px;
-            padding: 1.5rem;
-            margin-bottom: 1rem;
-        }
-        
-        .card h3 {
-            margin-bottom: 1rem;
-            color: #fff;
-        }
-        
-        .grid {
-            display: grid;
-            gap: 1rem;
-            grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-        }
-        
-        .alert {
-            padding: 1rem;
-            border-radius: 8px;
-            margin-bottom: 1rem;
-        }
-        
-        .alert-danger {
-            background: #dc2626;
-            color: #fff;
-        }
-        
-        .alert-success {
-            background: #16a34a;
-            color: #fff;
-        }
-        
-        .table {
-            width: 100%;
-            background: #111;
-            border-radius: 8px;
-            overflow: hidden;
-            border: 1px solid #333;
-        }
-        
-        .table th,
-        .table td {
-            padding: 1rem;
-            text-align: left;
-            border-bottom: 1px solid #333;
-        }
-        
-        .table th {
-            background: #1a1a1a;
-            font-weight: 600;
-        }
-        
-        .status-pending {
-            color: #fbbf24;
-        }
-        
-        .status-accepted {
-            color: #16a34a;
-        }
-        
-        .status-rejected {
-            color: #dc2626;
-        }
-        
-        .modal {
-            display: none;
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background: rgba(0, 0, 0, 0.8);
-            z-index: 1000;
-        }
-        
-        .modal-content {
-            background: #111;
-            margin: 5% auto;
-            padding: 2rem;
-            border-radius: 12px;
-            max-width: 600px;
-            border: 1px solid #333;
-        }
-        
-        .close {
-            color: #aaa;
-            float: right;
-            font-size: 28px;
-            font-weight: bold;
-            cursor: pointer;
-        }
-        
-        .close:hover {
-            color: #fff;
-        }
-        
-        @media (max-width: 768px) {
-            .nav-content {
-                flex-direction: column;
-                gap: 1rem;
-            }
-            
-            .container {
-                padding: 10px;
-            }
-        }
-    </style>
-</head>
-<body>
-    {% if session.user_id %}
-    <nav class="nav">
-        <div class="nav-content">
-            <h1>🏥 Hospital Management</h1>
-            <div class="nav-links">
-                <span>Welcome, {{ session.user_name }}</span>
-                <a href="{{ url_for('logout') }}" class="btn btn-secondary">Logout</a>
-            </div>
-        </div>
-    </nav>
-    {% endif %}
-    
-    <div class="container">
-        {% with messages = get_flashed_messages() %}
-            {% if messages %}
-                {% for message in messages %}
-                    <div class="alert alert-danger">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        
-        {% block content %}{% endblock %}
-    </div>
-    
-    {% block scripts %}{% endblock %}
-</body>
-</html>'''
-    
-    # Login template
-    login_template = '''{% extends "base.html" %}
-
-{% block content %}
-<div class="form-container">
-    <h2 style="text-align: center; margin-bottom: 2rem; color: #fff;">Login</h2>
-    <form method="POST">
-        <div class="form-group">
-            <label for="email">Email:</label>
-            <input type="email" id="email" name="email" class="form-control" required>
-        </div>
-        <div class="form-group">
-            <label for="password">Password:</label>
-            <input type="password" id="password" name="password" class="form-control" required>
-        </div>
-        <button type="submit" class="btn" style="width: 100%; margin-bottom: 1rem;">Login</button>
-    </form>
-    <div style="text-align: center;">
-        <p style="color: #ccc;">Don't have an account?</p>
-        <a href="{{ url_for('register') }}" class="btn btn-secondary">Sign Up</a>
-    </div>
-</div>
-{% endblock %}'''
-
-    # Register template
-    register_template = '''{% extends "base.html" %}
-
-{% block content %}
-<div class="form-container">
-    <h2 style="text-align: center; margin-bottom: 2rem; color: #fff;">Sign Up</h2>
-    <form method="POST">
-        <div class="form-group">
-            <label for="name">Full Name:</label>
-            <input type="text" id="name" name="name" class="form-control" required>
-        </div>
-        <div class="form-group">
-            <label for="email">Email:</label>
-            <input type="email" id="email" name="email" class="form-control" required>
-        </div>
-        <div class="form-group">
-            <label for="password">Password:</label>
-            <input type="password" id="password" name="password" class="form-control" required>
-        </div>
-        <div class="form-group">
-            <label for="phone">Phone:</label>
-            <input type="tel" id="phone" name="phone" class="form-control" required>
-        </div>
-        <div class="form-group">
-            <label for="user_type">I am a:</label>
-            <select id="user_type" name="user_type" class="form-control" onchange="toggleSpecialization()" required>
-                <option value="">Select...</option>
-                <option value="patient">Patient</option>
-                <option value="doctor">Doctor</option>
-            </select>
-        </div>
-        <div class="form-group" id="specialization-group" style="display: none;">
-            <label for="specialization">Specialization:</label>
-            <select id="specialization" name="specialization" class="form-control">
-                <option value="">Select specialization...</option>
-                <option value="Cardiology">Cardiology</option>
-                <option value="Neurology">Neurology</option>
-                <option value="Orthopedics">Orthopedics</option>
-                <option value="Pediatrics">Pediatrics</option>
-                <option value="Dermatology">Dermatology</option>
-                <option value="General Medicine">General Medicine</option>
-            </select>
-        </div>
-        <button type="submit" class="btn" style="width: 100%; margin-bottom: 1rem;">Sign Up</button>
-    </form>
-    <div style="text-align: center;">
-        <a href="{{ url_for('login') }}" class="btn btn-secondary">Back to Login</a>
-    </div>
-</div>
-{% endblock %}
-
-{% block scripts %}
-<script>
-    function toggleSpecialization() {
-        const userType = document.getElementById('user_type').value;
-        const specializationGroup = document.getElementById('specialization-group');
-        const specializationSelect = document.getElementById('specialization');
-        
-        if (userType === 'doctor') {
-            specializationGroup.style.display = 'block';
-            specializationSelect.required = true;
-        } else {
-            specializationGroup.style.display = 'none';
-            specializationSelect.required = false;
-        }
-    }
-</script>
-{% endblock %}'''
-
-    # Patient dashboard template
-    patient_dashboard_template = '''{% extends "base.html" %}
-
-{% block content %}
-<h2 style="margin-bottom: 2rem; color: #fff;">Patient Dashboard</h2>
-
-<div style="display: flex; gap: 1rem; margin-bottom: 2rem;">
-    <a href="{{ url_for('view_departments') }}" class="btn btn-secondary">🏢 Browse Departments</a>
-    <a href="{{ url_for('view_medications') }}" class="btn btn-secondary">💊 Medications</a>
-    <a href="{{ url_for('get_notifications') }}" class="btn btn-secondary" style="position: relative;">
-        🔔 Notifications
-        {% if unread_notifications > 0 %}
-        <span style="position: absolute; top: -5px; right: -5px; background: #dc2626; color: white; border-radius: 50%; width: 20px; height: 20px; font-size: 12px; display: flex; align-items: center; justify-content: center;">{{ unread_notifications }}</span>
-        {% endif %}
-    </a>
-</div>
-
-<div class="grid">
-    <!-- Schedule Appointment -->
-    <div class="card">
-        <h3>Schedule New Appointment</h3>
-        <form method="POST" action="{{ url_for('schedule_appointment') }}">
-            <div class="form-group">
-                <label for="doctor_id">Select Doctor:</label>
-                <select id="doctor_id" name="doctor_id" class="form-control" required>
-                    <option value="">Choose a doctor...</option>
-                    {% for doctor in doctors %}
-                    <option value="{{ doctor[0] }}">Dr. {{ doctor[1] }} - {{ doctor[2] }}</option>
-                    {% endfor %}
-                </select>
-            </div>
-            <div class="form-group">
-                <label for="appointment_date">Date:</label>
-                <input type="date" id="appointment_date" name="appointment_date" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="appointment_time">Time:</label>
-                <select id="appointment_time" name="appointment_time" class="form-control" required>
-                    <option value="">Select time...</option>
-                    <option value="09:00">09:00 AM</option>
-                    <option value="10:00">10:00 AM</option>
-                    <option value="11:00">11:00 AM</option>
-                    <option value="14:00">02:00 PM</option>
-                    <option value="15:00">03:00 PM</option>
-                    <option value="16:00">04:00 PM</option>
-                </select>
-            </div>
-            <div class="form-group">
-                <label for="notes">Notes (optional):</label>
-                <textarea id="notes" name="notes" class="form-control" rows="3" placeholder="Describe your symptoms or reason for visit..."></textarea>
-            </div>
-            <button type="submit" class="btn">Schedule Appointment</button>
-        </form>
-    </div>
-</div>
-
-<!-- My Appointments -->
-<div class="card" style="margin-top: 2rem;">
-    <h3>My Appointments</h3>
-    {% if appointments %}
-    <div style="overflow-x: auto;">
-        <table class="table">
-            <thead>
-                <tr>
-                    <th>Doctor</th>
-                    <th>Date</th>
-                    <th>Time</th>
-                    <th>Status</th>
-                    <th>Notes</th>
-                </tr>
-            </thead>
-            <tbody>
-                {% for appointment in appointments %}
-                <tr>
-                    <td>Dr. {{ appointment[1] }}</td>
-                    <td>{{ appointment[2] }}</td>
-                    <td>{{ appointment[3] }}</td>
-                    <td><span class="status-{{ appointment[4] }}">{{ appointment[4].title() }}</span></td>
-                    <td>{{ appointment[5] or '-' }}</td>
-                </tr>
-                {% endfor %}
-            </tbody>
-        </table>
-    </div>
-    {% else %}
-    <p style="color: #ccc;">No appointments scheduled yet.</p>
-    {% endif %}
-</div>
-
-<!-- Medical Records -->
-<div class="card" style="margin-top: 2rem;">
-    <h3>Medical Records</h3>
-    {% if medical_records %}
-    <div style="overflow-x: auto;">
-        <table class="table">
-            <thead>
-                <tr>
-                    <th>Doctor</th>
-                    <th>Date</th>
-                    <th>Diagnosis</th>
-                    <th>Prescription</th>
-                    <th>Notes</th>
-                </tr>
-            </thead>
-            <tbody>
-                {% for record in medical_records %}
-                <tr>
-                    <td>Dr. {{ record[1] }}</td>
-                    <td>{{ record[5].split()[0] }}</td>
-                    <td>{{ record[2] or '-' }}</td>
-                    <td>{{ record[3] or '-' }}</td>
-                    <td>{{ record[4] or '-' }}</td>
-                </tr>
-                {% endfor %}
-            </tbody>
-        </table>
-    </div>
-    {% else %}
-    <p style="color: #ccc;">No medical records yet.</p>
-    {% endif %}
-</div>
-{% endblock %}
-
-{% block scripts %}
-<script>
-    // Set minimum date to today
-    document.getElementById('appointment_date').min = new Date().toISOString().split('T')[0];
-</script>
-{% endblock %}'''
-
-    # Doctor dashboard template
-    doctor_dashboard_template = '''{% extends "base.html" %}
-
-{% block content %}
-<h2 style="margin-bottom: 2rem; color: #fff;">Doctor Dashboard</h2>
-
-<div style="display: flex; gap: 1rem; margin-bottom: 2rem;">
-    <a href="{{ url_for('view_departments') }}" class="btn btn-secondary">🏢 Departments</a>
-    <a href="{{ url_for('view_medications') }}" class="btn btn-secondary">💊 Medications</a>
-</div>
-
-<!-- Pending Appointments -->
-<div class="card">
-    <h3>Patient Appointments</h3>
-    {% if appointments %}
-    <div style="overflow-x: auto;">
-        <table class="table">
-            <thead>
-                <tr>
-                    <th>Patient</th>
-                    <th>Phone</th>
-                    <th>Date</th>
-                    <th>Time</th>
-                    <th>Status</th>
-                    <th>Notes</th>
-                    <th>Actions</th>
-                </tr>
-            </thead>
-            <tbody>
-                {% for appointment in appointments %}
-                <tr>
-                    <td>{{ appointment[1] }}</td>
-                    <td>{{ appointment[6] }}</td>
-                    <td>{{ appointment[2] }}</td>
-                    <td>{{ appointment[3] }}</td>
-                    <td><span class="status-{{ appointment[4] }}">{{ appointment[4].title() }}</span></td>
-                    <td>{{ appointment[5] or '-' }}</td>
-                    <td>
-                        {% if appointment[4] == 'pending' %}
-                        <button onclick="updateAppointment({{ appointment[0] }}, 'accepted')" class="btn" style="margin-right: 0.5rem; padding: 0.5rem;">Accept</button>
-                        <button onclick="updateAppointment({{ appointment[0] }}, 'rejected')" class="btn btn-danger" style="padding: 0.5rem;">Reject</button>
-                        {% elif appointment[4] == 'accepted' %}
-                        <button onclick="openMedicalRecord({{ appointment[0] }}, '{{ appointment[1] }}')" class="btn" style="padding: 0.5rem;">Medical Record</button>
-                        {% endif %}
-                    </td>
-                </tr>
-                {% endfor %}
-            </tbody>
-        </table>
-    </div>
-    {% else %}
-    <p style="color: #ccc;">No appointments yet.</p>
-    {% endif %}
-</div>
-
-<!-- Medical Record Modal -->
-<div id="medicalRecordModal" class="modal">
-    <div class="modal-content">
-        <span class="close" onclick="closeMedicalRecord()">&times;</span>
-        <h3 id="modalTitle">Medical Record</h3>
-        <form id="medicalRecordForm">
-            <input type="hidden" id="appointmentId" name="appointment_id">
-            <div class="form-group">
-                <label for="diagnosis">Diagnosis:</label>
-                <textarea id="diagnosis" name="diagnosis" class="form-control" rows="3" required></textarea>
-            </div>
-            <div class="form-group">
-                <label for="prescription">Prescription:</label>
-                <div style="position: relative;">
-                    <input type="text" id="medicationSearch" class="form-control" placeholder="Search medications..." autocomplete="off">
-                    <div id="medicationResults" style="position: absolute; top: 100%; left: 0; right: 0; background: #222; border: 1px solid #333; border-radius: 8px; max-height: 200px; overflow-y: auto; z-index: 1001; display: none;"></div>
-                </div>
-                <textarea id="prescription" name="prescription" class="form-control" rows="3" style="margin-top: 0.5rem;" placeholder="Selected medications will appear here..."></textarea>
-            </div>
-            <div class="form-group">
-                <label for="medical_notes">Notes:</label>
-                <textarea id="medical_notes" name="notes" class="form-control" rows="3"></textarea>
-            </div>
-            <button type="submit" class="btn">Save Medical Record</button>
-        </form>
-    </div>
-</div>
-{% endblock %}
-
-{% block scripts %}
-<script>
-    let selectedMedications = [];
-    
-    function updateAppointment(appointmentId, status) {
-        fetch('/doctor/update-appointment', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                appointment_id: appointmentId,
-                status: status
-            })
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                location.reload();
-            } else {
-                alert('Error updating appointment');
-            }
-        });
-    }
-    
-    function openMedicalRecord(appointmentId, patientName) {
-        document.getElementById('appointmentId').value = appointmentId;
-        document.getElementById('modalTitle').textContent = 'Medical Record for ' + patientName;
-        document.getElementById('medicalRecordModal').style.display = 'block';
-        selectedMedications = [];
-        updatePrescriptionDisplay();
-    }
-    
-    function closeMedicalRecord() {
-        document.getElementById('medicalRecordModal').style.display = 'none';
-        document.getElementById('medicationResults').style.display = 'none';
-    }
-    
-    // Medication search functionality
-    document.getElementById('medicationSearch').addEventListener('input', function(e) {
-        const query = e.target.value.trim();
-        if (query.length < 2) {
-            document.getElementById('medicationResults').style.display = 'none';
-            return;
-        }
-        
-        fetch(`/api/medications/search?q=${encodeURIComponent(query)}`)
-            .then(response => response.json())
-            .then(medications => {
-                const resultsDiv = document.getElementById('medicationResults');
-                resultsDiv.innerHTML = '';
-                
-                if (medications.length > 0) {
-                    medications.forEach(med => {
-                        const div = document.createElement('div');
-                        div.style.cssText = 'padding: 0.75rem; cursor: pointer; border-bottom: 1px solid #333;';
-                        div.innerHTML = `
-                            <strong>${med.name}</strong> (${med.generic_name})<br>
-                            <small style="color: #ccc;">${med.dosage} - ${med.price}</small>
-                        `;
-                        div.addEventListener('click', () => addMedication(med));
-                        div.addEventListener('mouseenter', () => div.style.background = '#333');
-                        div.addEventListener('mouseleave', () => div.style.background = 'transparent');
-                        resultsDiv.appendChild(div);
-                    });
-                    resultsDiv.style.display = 'block';
-                } else {
-                    resultsDiv.style.display = 'none';
-                }
-            });
-    });
-    
-    function addMedication(medication) {
-        // Check if medication already selected
-        if (!selectedMedications.find(med => med.id === medication.id)) {
-            selectedMedications.push(medication);
-            updatePrescriptionDisplay();
-        }
-        document.getElementById('medicationSearch').value = '';
-        document.getElementById('medicationResults').style.display = 'none';
-    }
-    
-    function updatePrescriptionDisplay() {
-        const prescriptionText = selectedMedications.map(med => 
-            `${med.name} (${med.generic_name}) - ${med.dosage}`
-        ).join('\\n');
-        document.getElementById('prescription').value = prescriptionText;
-    }
-    
-    function removeMedication(index) {
-        selectedMedications.splice(index, 1);
-        updatePrescriptionDisplay();
-    }
-    
-    document.getElementById('medicalRecordForm').addEventListener('submit', function(e) {
-        e.preventDefault();
-        
-        const formData = new FormData(this);
-        const data = Object.fromEntries(formData);
-        
-        fetch('/doctor/medical-record', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(data)
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                alert('Medical record saved successfully');
-                closeMedicalRecord();
-                location.reload();
-            } else {
-                alert('Error saving medical record');
-            }
-        });
-    });
-    
-    // Close modal when clicking outside
-    window.onclick = function(event) {
-        const modal = document.getElementById('medicalRecordModal');
-        if (event.target == modal) {
-            closeMedicalRecord();
-        }
-    }
-    
-    // Hide medication results when clicking outside
-    document.addEventListener('click', function(e) {
-        if (!e.target.closest('#medicationSearch') && !e.target.closest('#medicationResults')) {
-            document.getElementById('medicationResults').style.display = 'none';
-        }
-    });
-</script>
-{% endblock %}'''
-    
-    # Write template files with UTF-8 encoding
-    with open('templates/base.html', 'w', encoding='utf-8') as f:
-        f.write(base_template)
-    
-    with open('templates/login.html', 'w', encoding='utf-8') as f:
-        f.write(login_template)
-    
-    with open('templates/register.html', 'w', encoding='utf-8') as f:
-        f.write(register_template)
-    
-    with open('templates/patient_dashboard.html', 'w', encoding='utf-8') as f:
-        f.write(patient_dashboard_template)
-    
-    with open('templates/doctor_dashboard.html', 'w', encoding='utf-8') as f:
-        f.write(doctor_dashboard_template)
-    
-    # Departments template
-    departments_template = '''{% extends "base.html" %}
-
-{% block content %}
-<h2 style="margin-bottom: 2rem; color: #fff;">Hospital Departments</h2>
-
-{% if session.user_type == 'doctor' %}
-<div class="card" style="margin-bottom: 2rem;">
-    <h3>Add New Department</h3>
-    <form method="POST" action="{{ url_for('manage_departments') }}">
-        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 1rem;">
-            <div class="form-group">
-                <label for="name">Department Name:</label>
-                <input type="text" id="name" name="name" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="phone">Phone:</label>
-                <input type="tel" id="phone" name="phone" class="form-control" required>
-            </div>
-        </div>
-        <div class="form-group">
-            <label for="description">Description:</label>
-            <textarea id="description" name="description" class="form-control" rows="2" required></textarea>
-        </div>
-        <div class="form-group">
-            <label for="location">Location:</label>
-            <input type="text" id="location" name="location" class="form-control" required>
-        </div>
-        <button type="submit" class="btn">Add Department</button>
-    </form>
-</div>
-{% endif %}
-
-<div class="grid">
-    {% for department in departments %}
-    <div class="card">
-        <h3 style="color: #fff; margin-bottom: 0.5rem;">{{ department[1] }}</h3>
-        <p style="color: #ccc; margin-bottom: 1rem;">{{ department[2] }}</p>
-        
-        <div style="margin-bottom: 1rem;">
-            <div style="display: flex; justify-content: space-between; margin-bottom: 0.5rem;">
-                <span style="color: #aaa;">📍 Location:</span>
-                <span>{{ department[4] }}</span>
-            </div>
-            <div style="display: flex; justify-content: space-between; margin-bottom: 0.5rem;">
-                <span style="color: #aaa;">📞 Phone:</span>
-                <span>{{ department[3] }}</span>
-            </div>
-            <div style="display: flex; justify-content: space-between; margin-bottom: 0.5rem;">
-                <span style="color: #aaa;">👨‍⚕️ Doctors:</span>
-                <span>{{ doctor_counts.get(department[0], 0) }}</span>
-            </div>
-            {% if department[5] %}
-            <div style="display: flex; justify-content: space-between;">
-                <span style="color: #aaa;">🏥 Head:</span>
-                <span>Dr. {{ department[5] }}</span>
-            </div>
-            {% endif %}
-        </div>
-        
-        {% if session.user_type == 'patient' %}
-        <a href="{{ url_for('patient_dashboard') }}" class="btn" style="width: 100%;">Book Appointment</a>
-        {% endif %}
-    </div>
-    {% endfor %}
-</div>
-{% endblock %}'''
-    
-    # Medications template
-    medications_template = '''{% extends "base.html" %}
-
-{% block content %}
-<h2 style="margin-bottom: 2rem; color: #fff;">Hospital Medications</h2>
-
-{% if session.user_type == 'doctor' %}
-<div class="card" style="margin-bottom: 2rem;">
-    <h3>Add New Medication</h3>
-    <form method="POST" action="{{ url_for('manage_medications') }}">
-        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 1rem;">
-            <div class="form-group">
-                <label for="name">Brand Name:</label>
-                <input type="text" id="name" name="name" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="generic_name">Generic Name:</label>
-                <input type="text" id="generic_name" name="generic_name" class="form-control" required>
-            </div>
-        </div>
-        <div class="form-group">
-            <label for="description">Description:</label>
-            <textarea id="description" name="description" class="form-control" rows="2" required></textarea>
-        </div>
-        <div style="display: grid; grid-template-columns: 1fr 1fr 1fr; gap: 1rem;">
-            <div class="form-group">
-                <label for="dosage">Dosage:</label>
-                <input type="text" id="dosage" name="dosage" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="price">Price ($):</label>
-                <input type="number" step="0.01" id="price" name="price" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="stock_quantity">Stock Quantity:</label>
-                <input type="number" id="stock_quantity" name="stock_quantity" class="form-control" required>
-            </div>
-        </div>
-        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 1rem;">
-            <div class="form-group">
-                <label for="manufacturer">Manufacturer:</label>
-                <input type="text" id="manufacturer" name="manufacturer" class="form-control" required>
-            </div>
-            <div class="form-group">
-                <label for="side_effects">Side Effects:</label>
-                <input type="text" id="side_effects" name="side_effects" class="form-control">
-            </div>
-        </div>
-        <button type="submit" class="btn">Add Medication</button>
-    </form>
-</div>
-{% endif %}
-
-<div class="card">
-    <h3>Available Medications</h3>
-    <div style="margin-bottom: 1rem;">
-        <input type="text" id="searchMedications" class="form-control" placeholder="Search medications by name or generic name...">
-    </div>
-    
-    {% if medications %}
-    <div style="overflow-x: auto;">
-        <table class="table" id="medicationsTable">
-            <thead>
-                <tr>
-                    <th>Brand Name</th>
-                    <th>Generic Name</th>
-                    <th>Description</th>
-                    <th>Dosage</th>
-                    <th>Price</th>
-                    <th>Stock</th>
-                    <th>Manufacturer</th>
-                    {% if session.user_type == 'doctor' %}
-                    <th>Side Effects</th>
-                    {% endif %}
-                </tr>
-            </thead>
-            <tbody>
-                {% for medication in medications %}
-                <tr>
-                    <td><strong>{{ medication[1] }}</strong></td>
-                    <td>{{ medication[2] }}</td>
-                    <td>{{ medication[3] }}</td>
-                    <td>{{ medication[4] }}</td>
-                    <td>${{ "%.2f"|format(medication[6]) }}</td>
-                    <td>
-                        <span style="color: {% if medication[7] > 50 %}#16a34a{% elif medication[7] > 10 %}#fbbf24{% else %}#dc2626{% endif %}">
-                            {{ medication[7] }}
-                        </span>
-                    </td>
-                    <td>{{ medication[8] }}</td>
-                    {% if session.user_type == 'doctor' %}
-                    <td style="font-size: 0.9rem; color: #ccc;">{{ medication[5] or '-' }}</td>
-                    {% endif %}
-                </tr>
-                {% endfor %}
-            </tbody>
-        </table>
-    </div>
-    {% else %}
-    <p style="color: #ccc;">No medications available.</p>
-    {% endif %}
-</div>
-{% endblock %}
-
-{% block scripts %}
-<script>
-    // Search functionality
-    document.getElementById('searchMedications').addEventListener('input', function(e) {
-        const searchTerm = e.target.value.toLowerCase();
-        const table = document.getElementById('medicationsTable');
-        const rows = table.getElementsByTagName('tr');
-        
-        for (let i = 1; i < rows.length; i++) {
-            const row = rows[i];
-            const brandName = row.cells[0].textContent.toLowerCase();
-            const genericName = row.cells[1].textContent.toLowerCase();
-            
-            if (brandName.includes(searchTerm) || genericName.includes(searchTerm)) {
-                row.style.display = '';
-            } else {
-                row.style.display = 'none';
-            }
-        }
-    });
-</script>
-{% endblock %}'''
-    
-    with open('templates/departments.html', 'w', encoding='utf-8') as f:
-        f.write(departments_template)
-    
-    with open('templates/medications.html', 'w', encoding='utf-8') as f:
-        f.write(medications_template)
-    
-    # Notifications template
-    notifications_template = '''{% extends "base.html" %}
-
-{% block content %}
-<h2 style="margin-bottom: 2rem; color: #fff;">Notifications</h2>
-
-<div style="margin-bottom: 2rem;">
-    <a href="{{ url_for('patient_dashboard') }}" class="btn btn-secondary">← Back to Dashboard</a>
-</div>
-
-<div class="card">
-    <h3>Your Notifications</h3>
-    {% if notifications %}
-    <div style="space-y: 1rem;">
-        {% for notification in notifications %}
-        <div class="alert alert-{{ notification[2] }}" style="position: relative; margin-bottom: 1rem; padding-right: 3rem;">
-            <div style="margin-bottom: 0.5rem;">
-                <strong>{{ notification[1] }}</strong>
-            </div>
-            <div style="font-size: 0.9rem; color: #ccc;">
-                {{ notification[4] }}
-            </div>
-            {% if notification[3] == 0 %}
-            <button onclick="markAsRead({{ notification[0] }})" 
-                    style="position: absolute; top: 0.5rem; right: 0.5rem; background: none; border: none; color: #ccc; cursor: pointer; font-size: 1.2rem;"
-                    title="Mark as read">
-                ✕
-            </button>
-            {% endif %}
-        </div>
-        {% endfor %}
-    </div>
-    {% else %}
-    <p style="color: #ccc;">No notifications yet.</p>
-    {% endif %}
-</div>
-{% endblock %}
-
-{% block scripts %}
-<script>
-    function markAsRead(notificationId) {
-        fetch(`/mark-notification-read/${notificationId}`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            }
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                location.reload();
-            }
-        });
-    }
-</script>
-{% endblock %}'''
-    
-    with open('templates/notifications.html', 'w', encoding='utf-8') as f:
-        f.write(notifications_template)
+    return jsonify(medication_search_json(get_db(), query))
+
+@app.route('/api/medications/cache-stats')
+@doctor_required
+def medication_cache_stats():
+    return jsonify(medication_catalog.stats())
+
+# Startup
+IMPORTED_AT = time.time()
+
+def process_uptime():
+    """Seconds since this process started; since import where /proc is missing."""
+    try:
+        with open('/proc/self/stat') as f:
+            # starttime is field 22, counted in clock ticks after boot
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time() - IMPORTED_AT
+
+@app.after_request
+def record_cold_start(response):
+    if 'COLD_START_SECONDS' not in app.config:
+        app.config['COLD_START_SECONDS'] = process_uptime()
+        app.logger.info('First response %.0f ms after process start',
+                        app.config['COLD_START_SECONDS'] * 1000)
+    return response
+
+def precompile_templates():
+    """Compile every template into the bytecode cache and Jinja's memory cache."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+    """Compile all templates ahead of the first request."""
+    names = precompile_templates()
+    print(f"Compiled {len(names)} templates into {app.config['TEMPLATE_CACHE_DIR']}")
+
+# Opt-in: pay template compilation at import instead of on the first requests
+if app.config['PRECOMPILE_TEMPLATES']:
+    precompile_templates()
 
 if __name__ == '__main__':
-    # Create templates directory if it doesn't exist
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
-    
-    # Create template files
-    create_templates()
-    
     init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,337 @@
+"""Async (ASGI) deployment of the hospital app.
+
+    pip install quart hypercorn
+    hypercorn asgi:application
+
+The read-heavy pages (dashboards, notifications, departments, medications and
+medication search) are served by a Quart app whose queries run on a bounded
+pool of SQLite connections, so a slow query holds a pool slot rather than a
+request thread and one process can keep many more sessions open. Every other
+route is handed to the Flask app in app.py on a worker thread. Both apps use
+the same session cookie, templates and read views.
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from jinja2 import FileSystemBytecodeCache
+from quart import (Quart, Response, flash, g, has_request_context, jsonify, redirect, render_template, request,
+                   session, url_for)
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import app as hospital
+
+flask_app = hospital.app
+flask_app.config.setdefault('ASYNC_DB_POOL_SIZE', 8)
+
+
+class AsyncDatabase:
+    """Runs read views on a bounded pool of SQLite connections.
+
+    At most ``size`` connections are opened, each used by one worker thread
+    at a time. Callers beyond that wait on the event loop for a free one.
+    The statements each call runs, and their time, are added to the
+    request's ``g.sql_statements`` and ``g.sql_seconds``.
+    """
+
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix='sqlite')
+        self._idle = asyncio.LifoQueue()
+        self._opened = 0
+
+    async def _acquire(self):
+        if self._idle.empty() and self._opened < self.size:
+            self._opened += 1
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._executor, hospital.connect_db, self.database)
+            except BaseException:
+                # Give the slot back, or enough failed opens would leave
+                # every caller waiting for a connection that never comes
+                self._opened -= 1
+                raise
+        return await self._idle.get()
+
+    @staticmethod
+    def _call(conn, fn, args):
+        try:
+            return fn(conn, *args)
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+    async def run(self, fn, *args):
+        """Await ``fn(conn, *args)`` run on a pooled connection."""
+        conn = await self._acquire()
+        statements, sql_seconds = conn.statements, conn.sql_seconds
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self._call, conn, fn, args)
+        finally:
+            if has_request_context():
+                g.sql_statements = g.get('sql_statements', 0) + conn.statements - statements
+                g.sql_seconds = g.get('sql_seconds', 0.0) + conn.sql_seconds - sql_seconds
+            self._idle.put_nowait(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+        self._executor.shutdown()
+
+
+application = Quart(__name__, root_path=flask_app.root_path)
+application.secret_key = flask_app.secret_key
+# Quart compiles templates in async mode, so its bytecode is kept apart
+template_cache_dir = os.path.join(flask_app.config['TEMPLATE_CACHE_DIR'], 'async')
+os.makedirs(template_cache_dir, exist_ok=True)
+application.jinja_options = {**application.jinja_options,
+                             'bytecode_cache': FileSystemBytecodeCache(template_cache_dir)}
+db = None
+
+
+@application.before_serving
+async def open_database():
+    global db
+    database = flask_app.config['DATABASE']
+    await asyncio.get_running_loop().run_in_executor(None, hospital.init_db, database)
+    db = AsyncDatabase(database, flask_app.config['ASYNC_DB_POOL_SIZE'])
+
+
+@application.after_serving
+async def close_database():
+    db.close()
+
+
+# Request metrics, as app.py records them for its own routes. Bridged
+# requests are recorded by the Flask app that serves them.
+@application.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@application.after_request
+async def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if (started is None or not flask_app.config['METRICS_ENABLED']
+            or application.view_functions.get(request.endpoint) is delegate_to_flask):
+        return response
+    hospital.metrics.observe_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                                     time.perf_counter() - started, g.get('sql_statements', 0),
+                                     g.get('sql_seconds', 0.0))
+    return response
+
+
+@application.template_global()
+def page_url(param, cursor):
+    args = request.args.to_dict()
+    args[param] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+# Authentication decorators, as in app.py
+def login_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return redirect(url_for('login'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def doctor_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session or session.get('user_type') != 'doctor':
+            await flash('Access denied. Doctor privileges required.')
+            return redirect(url_for('login'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+def patient_required(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if 'user_id' not in session or session.get('user_type') != 'patient':
+            await flash('Access denied. Patient privileges required.')
+            return redirect(url_for('login'))
+        return await f(*args, **kwargs)
+    return decorated_function
+
+
+# Async routes; endpoint names match app.py so url_for works in both apps
+@application.route('/patient/dashboard')
+@patient_required
+async def patient_dashboard():
+    context = await db.run(hospital.patient_dashboard_context, session['user_id'], request.args)
+    return await render_template('patient_dashboard.html', **context)
+
+@application.route('/api/patient/dashboard')
+@patient_required
+async def patient_dashboard_json():
+    history = await db.run(hospital.patient_history, session['user_id'], request.args)
+    return jsonify(hospital.history_json(history))
+
+@application.route('/doctor/dashboard')
+@doctor_required
+async def doctor_dashboard():
+    context = await db.run(hospital.doctor_history, session['user_id'], request.args)
+    return await render_template('doctor_dashboard.html', **context)
+
+@application.route('/api/doctor/dashboard')
+@doctor_required
+async def doctor_dashboard_json():
+    history = await db.run(hospital.doctor_history, session['user_id'], request.args)
+    return jsonify(hospital.history_json(history))
+
+@application.route('/notifications')
+@login_required
+async def get_notifications():
+    context = await db.run(hospital.notifications_context, session['user_id'], request.args)
+    return await render_template('notifications.html', **context)
+
+@application.route('/api/notifications')
+@login_required
+async def get_notifications_json():
+    context = await db.run(hospital.notifications_context, session['user_id'], request.args)
+    return jsonify(hospital.notifications_json(context))
+
+# Same ETags and rendered-page cache as hospital.conditional_page
+async def render_catalog_page(template, load_context):
+    if session.get('_flashes'):
+        return await render_template(template, **await db.run(load_context))
+    etag, page_key = await db.run(hospital.catalog_etag, request.endpoint,
+                                  session.get('user_name'), session.get('user_type'))
+    if etag in request.if_none_match:
+        response = Response('', status=304)
+    else:
+        html = hospital.page_cache.get(page_key)
+        if html is None:
+            g.shared_page = True
+            html = await render_template(template, **await db.run(load_context))
+            hospital.page_cache.put(page_key, html)
+        response = Response(hospital.fill_viewer_name(html, session.get('user_name')), mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@application.route('/departments')
+@login_required
+async def view_departments():
+    return await render_catalog_page('departments.html', hospital.departments_context)
+
+@application.route('/medications')
+@login_required
+async def view_medications():
+    return await render_catalog_page('medications.html', hospital.medications_context)
+
+@application.route('/api/medications/search')
+@doctor_required
+async def search_medications():
+    results = await db.run(hospital.medication_search_json, request.args.get('q', ''))
+    return jsonify(results)
+
+
+# Server-sent events. Each open stream waits on the event loop, not on a
+# thread, so open tabs cannot use up the bridge pool below. Routes publish on
+# worker threads; events cross to the loop through call_soon_threadsafe.
+class StreamSubscription:
+    """An EventBroker subscription that feeds an asyncio.Queue."""
+
+    def __init__(self, loop, max_queue):
+        self.loop = loop
+        self.queue = asyncio.Queue(max_queue)
+
+    def put_nowait(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self._deliver, item)
+        except RuntimeError:
+            # The loop has closed; the stream is gone with it
+            pass
+
+    def _deliver(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # A stalled client loses events rather than piling them up
+            pass
+
+@application.route('/events')
+@login_required
+async def events():
+    user_id = session['user_id']
+    broker = hospital.event_broker
+    subscription = broker.subscribe(user_id, StreamSubscription(asyncio.get_running_loop(), broker.max_queue))
+    keepalive = flask_app.config['SSE_KEEPALIVE']
+
+    async def stream():
+        try:
+            yield b'retry: 5000\n\n'
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(subscription.queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield b': keep-alive\n\n'
+                    continue
+                yield f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+        finally:
+            broker.unsubscribe(user_id, subscription)
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.timeout = None
+    return response
+
+
+# Everything else runs in the Flask app on a worker thread. Responses are
+# short, so a bridge thread is only held while one is produced; long-lived
+# streams such as /events are served natively above.
+bridge_executor = ThreadPoolExecutor(thread_name_prefix='wsgi')
+
+async def delegate_to_flask(**_):
+    loop = asyncio.get_running_loop()
+    environ = EnvironBuilder(
+        path=request.path,
+        base_url=f'{request.scheme}://{request.host}{request.root_path}',
+        query_string=request.query_string.decode('latin-1'),
+        method=request.method,
+        headers=list(request.headers.items()),
+        data=await request.get_data(),
+    ).get_environ()
+    environ['REMOTE_ADDR'] = request.remote_addr or ''
+    app_iter, status, headers = await loop.run_in_executor(bridge_executor, run_wsgi_app, flask_app,
+                                                           environ)
+    chunks = iter(app_iter)
+
+    def close(_=None):
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+    async def body():
+        pending = None
+        try:
+            while True:
+                pending = bridge_executor.submit(next, chunks, None)
+                chunk = await asyncio.wrap_future(pending)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # A client that disconnects mid-stream leaves next() blocked in
+            # the worker (e.g. /events waiting for its keepalive), and the
+            # generator can only be closed once that call returns.
+            if pending is not None and pending.running():
+                pending.add_done_callback(close)
+            else:
+                await loop.run_in_executor(bridge_executor, close)
+
+    response = Response(body(), status=int(status.split()[0]), headers=list(headers.items()))
+    if response.mimetype == 'text/event-stream':
+        response.timeout = None
+    return response
+
+for rule in flask_app.url_map.iter_rules():
+    if rule.endpoint not in application.view_functions:
+        application.add_url_rule(rule.rule, endpoint=rule.endpoint, view_func=delegate_to_flask,
+                                 methods=rule.methods)
@@ -0,0 +1,90 @@
+"""Measure cold start: wall time from spawning the server to its first response.
+
+    python bench/cold_start.py --runs 5 --output cold_start.json
+
+Each run starts ``flask run`` on a copy of hospital.db and polls /login until
+it answers. The first run starts with an empty template bytecode cache unless
+--keep-cache is given, so it shows the compile cost the later runs avoid.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure(env, timeout):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise RuntimeError('server did not answer within %ss' % timeout)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--precompile', action='store_true',
+                        help='set HOSPITAL_PRECOMPILE_TEMPLATES=1 for the server')
+    parser.add_argument('--keep-cache', action='store_true',
+                        help='do not clear the template bytecode cache before the first run')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hms-cold-start-')
+    env = dict(os.environ,
+               HOSPITAL_DB=os.path.join(workdir, 'hospital.db'),
+               HOSPITAL_TEMPLATE_CACHE=os.path.join(workdir, 'jinja_cache'))
+    if args.precompile:
+        env['HOSPITAL_PRECOMPILE_TEMPLATES'] = '1'
+    shutil.copy(os.path.join(ROOT, 'hospital.db'), env['HOSPITAL_DB'])
+    if args.keep_cache:
+        env.pop('HOSPITAL_TEMPLATE_CACHE')
+
+    try:
+        timings = [measure(env, args.timeout) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'runs_ms': [round(t * 1000, 1) for t in timings],
+        'first_ms': round(timings[0] * 1000, 1),
+        'median_ms': round(statistics.median(timings) * 1000, 1),
+        'min_ms': round(min(timings) * 1000, 1),
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
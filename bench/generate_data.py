@@ -0,0 +1,215 @@
+"""Generate a synthetic hospital database for benchmarks.
+
+    python bench/generate_data.py bench.db --patients 20000 --appointments 200000
+
+The schema comes from app.init_db, so every index, trigger and derived table
+the app relies on is in place. Load is skewed the way a real hospital's is: a
+few doctors and frequent patients account for most appointments,
+notifications pile up on the busiest patients, and most appointments are in
+the past. The same --seed always produces the same database. Every account
+has the password given by --password.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_COUNTS = {
+    'doctors': 100,
+    'patients': 10000,
+    'appointments': 100000,
+    'medical_records': 40000,
+    'notifications': 50000,
+    'medications': 2000,
+}
+SPECIALIZATIONS = ('Cardiology', 'Neurology', 'Orthopedics', 'Pediatrics', 'Emergency', 'General Medicine')
+SLOT_TIMES = ('09:00', '10:00', '11:00', '14:00', '15:00', '16:00')
+FIRST_NAMES = ('Ana', 'Ben', 'Chen', 'Dara', 'Eli', 'Fatima', 'Grace', 'Hugo', 'Ines', 'Jonas',
+               'Kemal', 'Lena', 'Maya', 'Noah', 'Olu', 'Priya', 'Quinn', 'Rosa', 'Sami', 'Tara')
+LAST_NAMES = ('Adams', 'Baker', 'Costa', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Haddad', 'Ito',
+              'Jensen', 'Khan', 'Lopez', 'Moreau', 'Nowak', 'Okafor', 'Patel', 'Rossi', 'Silva')
+DIAGNOSES = ('Hypertension', 'Type 2 diabetes', 'Migraine', 'Seasonal allergies', 'Bronchitis',
+             'Lower back pain', 'Sprained ankle', 'Gastritis', 'Anxiety', 'Otitis media',
+             'Influenza', 'Osteoarthritis', 'Asthma', 'Urinary tract infection')
+DRUG_STEMS = ('Cardio', 'Neuro', 'Gastro', 'Derma', 'Pulmo', 'Hepa', 'Nephro', 'Osteo', 'Immuno', 'Myo')
+DRUG_SUFFIXES = ('zole', 'pril', 'statin', 'mab', 'cillin', 'olol', 'sartan', 'dronate', 'vir', 'xetine')
+DRUG_FORMS = ('tablets', 'capsules', 'oral suspension', 'injection', 'cream')
+DRUG_USES = ('pain relief', 'blood pressure', 'infection', 'inflammation', 'cholesterol',
+             'acid reflux', 'allergy', 'asthma', 'depression', 'diabetes')
+NOTIFICATION_MESSAGES = (
+    ('info', 'Your appointment on {day} is coming up'),
+    ('success', 'Your appointment on {day} was accepted'),
+    ('warning', 'Your appointment on {day} was rejected'),
+    ('info', 'New lab results from {day} are available'),
+)
+
+
+def zipf_weights(n, s=1.1):
+    """Cumulative weights where rank r is picked in proportion to 1 / r**s."""
+    return list(itertools.accumulate(1 / rank ** s for rank in range(1, n + 1)))
+
+
+def timestamp(day, rng):
+    return f'{day.isoformat()} {rng.randrange(8, 18):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}'
+
+
+def generate(path, counts=None, seed=1, password='password', analyze=False):
+    """Create ``path`` and fill it; returns the row count of every table."""
+    from werkzeug.security import generate_password_hash
+
+    import app as hospital
+
+    counts = {**DEFAULT_COUNTS, **(counts or {})}
+    rng = random.Random(seed)
+    today = date.today()
+    if os.path.exists(path):
+        raise SystemExit(f'{path} already exists')
+    hospital.init_db(path)
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous = OFF')
+    cursor = conn.cursor()
+    cursor.execute('BEGIN')
+
+    # One hash for everybody: real cost at login, no cost here
+    password_hash = generate_password_hash(password, hospital.app.config['PASSWORD_HASH_METHOD'])
+    doctors = []
+    for i in range(counts['doctors']):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        # General Medicine and Emergency are staffed more heavily
+        specialization = rng.choices(SPECIALIZATIONS, weights=(3, 2, 2, 2, 4, 6))[0]
+        cursor.execute('''
+            INSERT INTO users (email, password_hash, name, user_type, phone, specialization, created_at)
+            VALUES (?, ?, ?, 'doctor', ?, ?, ?)
+        ''', (f'doctor{i}@bench.test', password_hash, name, f'+1-555-{2000 + i:04d}',
+              specialization, timestamp(today - timedelta(days=rng.randrange(365, 3650)), rng)))
+        doctors.append(cursor.lastrowid)
+
+    cursor.executemany('''
+        INSERT INTO users (email, password_hash, name, user_type, phone, created_at)
+        VALUES (?, ?, ?, 'patient', ?, ?)
+    ''', ((f'patient{i}@bench.test', password_hash,
+           f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}', f'+1-555-{i % 10000:04d}',
+           timestamp(today - timedelta(days=rng.randrange(1, 1500)), rng))
+          for i in range(counts['patients'])))
+    cursor.execute("SELECT id FROM users WHERE user_type = 'patient' ORDER BY id")
+    patients = [row[0] for row in cursor.fetchall()]
+
+    # Heads of department, so the departments page joins a real doctor
+    cursor.execute('SELECT id, name FROM departments')
+    for department_id, name in cursor.fetchall():
+        cursor.execute('''
+            UPDATE departments SET head_doctor_id = (
+                SELECT id FROM users WHERE user_type = 'doctor' AND specialization = ? ORDER BY id LIMIT 1
+            ) WHERE id = ?
+        ''', (name, department_id))
+
+    # Rank order is shuffled so the busiest doctor is not simply the first
+    doctor_ranks = rng.sample(doctors, len(doctors))
+    patient_ranks = rng.sample(patients, len(patients))
+    doctor_weights = zipf_weights(len(doctors))
+    patient_weights = zipf_weights(len(patients), 0.8)
+
+    def appointment_rows():
+        for _ in range(counts['appointments']):
+            # Three quarters in the past year, the rest over the next two months
+            if rng.random() < 0.75:
+                day = today - timedelta(days=rng.randrange(1, 366))
+                status = rng.choices(('completed', 'no-show', 'rejected', 'accepted'), weights=(70, 8, 10, 12))[0]
+            else:
+                day = today + timedelta(days=rng.randrange(0, 61))
+                status = rng.choices(('pending', 'accepted', 'rejected'), weights=(50, 40, 10))[0]
+            yield (rng.choices(patient_ranks, cum_weights=patient_weights)[0],
+                   rng.choices(doctor_ranks, cum_weights=doctor_weights)[0],
+                   day.isoformat(), rng.choice(SLOT_TIMES), status,
+                   rng.choice(('', '', 'Follow-up', 'First visit', 'Referral')),
+                   timestamp(min(day, today) - timedelta(days=rng.randrange(0, 30)), rng))
+
+    cursor.executemany('''
+        INSERT INTO appointments (patient_id, doctor_id, appointment_date, appointment_time, status, notes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', appointment_rows())
+
+    medication_names = []
+    for i in range(counts['medications']):
+        name = f'{DRUG_STEMS[i % len(DRUG_STEMS)]}{DRUG_SUFFIXES[i // len(DRUG_STEMS) % len(DRUG_SUFFIXES)]}'
+        if i >= len(DRUG_STEMS) * len(DRUG_SUFFIXES):
+            name += f' {i // (len(DRUG_STEMS) * len(DRUG_SUFFIXES)) * 5}'
+        medication_names.append(name)
+    cursor.executemany('''
+        INSERT OR IGNORE INTO medications
+            (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', ((name, name.split()[0].lower() + 'ine', f'Used for {rng.choice(DRUG_USES)}',
+           f'{rng.choice((5, 10, 20, 50, 100, 250, 500))}mg {rng.choice(DRUG_FORMS)}',
+           rng.choice(('Nausea', 'Dizziness', 'Headache', 'Drowsiness', 'Rash')),
+           round(rng.uniform(2, 120), 2), rng.randrange(0, 500),
+           f'{rng.choice(LAST_NAMES)} Pharma') for name in medication_names))
+
+    cursor.execute('''
+        SELECT id, patient_id, doctor_id, appointment_date FROM appointments
+        WHERE status = 'completed'
+    ''')
+    completed = cursor.fetchall()
+    records = rng.sample(completed, min(counts['medical_records'], len(completed)))
+    cursor.executemany('''
+        INSERT INTO medical_records (appointment_id, patient_id, doctor_id, diagnosis, prescription, notes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', ((appointment_id, patient_id, doctor_id, rng.choice(DIAGNOSES),
+           ', '.join(rng.sample(medication_names, rng.randrange(1, 4))),
+           rng.choice(('', 'Review in two weeks', 'Refer to specialist')),
+           timestamp(date.fromisoformat(day), rng))
+          for appointment_id, patient_id, doctor_id, day in records))
+
+    def notification_rows():
+        for _ in range(counts['notifications']):
+            age = int(rng.expovariate(1 / 60))
+            kind, message = rng.choice(NOTIFICATION_MESSAGES)
+            day = today - timedelta(days=min(age, 730))
+            # Recent notifications are more often still unread
+            is_read = int(rng.random() < (0.5 if age < 7 else 0.95))
+            yield (rng.choices(patient_ranks, cum_weights=patient_weights)[0],
+                   message.format(day=day.isoformat()), kind, is_read, timestamp(day, rng))
+
+    cursor.executemany('''
+        INSERT INTO notifications (user_id, message, type, is_read, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', notification_rows())
+    conn.commit()
+    if analyze:
+        conn.execute('ANALYZE')
+        conn.commit()
+
+    tables = ('users', 'appointments', 'medical_records', 'notifications', 'medications', 'departments')
+    result = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in tables}
+    conn.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database', help='path of the database to create')
+    for table, count in DEFAULT_COUNTS.items():
+        parser.add_argument(f"--{table.replace('_', '-')}", type=int, default=count, dest=table)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--password', default='password', help='password of every generated account')
+    parser.add_argument('--analyze', action='store_true', help='run ANALYZE after loading')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = generate(args.database, {table: getattr(args, table) for table in DEFAULT_COUNTS},
+                      args.seed, args.password, args.analyze)
+    result['seconds'] = round(time.perf_counter() - started, 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Measure login throughput with password hashing inline and in the process pool.
+
+    python bench/login.py --clients 8 --duration 10 --output login.json
+
+For each setting of HOSPITAL_PASSWORD_HASH_WORKERS (0 = hash on the request
+thread, the old behaviour) the script starts ``flask run`` on a copy of
+hospital.db, has --clients threads log in as fast as they can for --duration
+seconds, and meanwhile times GET /login from one more thread to show how much
+the logins slow down everything else.
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'bench-password'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def seed_users(database, count, method):
+    password_hash = generate_password_hash(PASSWORD, method)
+    conn = sqlite3.connect(database)
+    conn.executemany('''
+        INSERT OR REPLACE INTO users (name, email, password_hash, user_type, phone)
+        VALUES (?, ?, ?, 'patient', '')
+    ''', [(f'Bench {i}', f'bench{i}@example.com', password_hash) for i in range(count)])
+    conn.commit()
+    conn.close()
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+    started = time.perf_counter()
+    conn.request(method, path, body, headers)
+    status = conn.getresponse().status
+    conn.close()
+    return status, time.perf_counter() - started
+
+
+def wait_ready(port, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            request(port, 'GET', '/login')
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not answer within %ss' % timeout)
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+
+def measure(env, workers, args):
+    port = free_port()
+    env = dict(env, HOSPITAL_PASSWORD_HASH_WORKERS=str(workers))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    logins, probes, statuses = [], [], {}
+    lock = threading.Lock()
+    try:
+        wait_ready(port, args.timeout)
+        # One login first so the hash pool is running before the clock starts
+        request(port, 'POST', '/login', urllib.parse.urlencode(
+            {'email': 'bench0@example.com', 'password': PASSWORD}))
+        deadline = time.perf_counter() + args.duration
+
+        def client(n):
+            body = urllib.parse.urlencode(
+                {'email': f'bench{n % args.users}@example.com', 'password': PASSWORD})
+            while time.perf_counter() < deadline:
+                status, elapsed = request(port, 'POST', '/login', body)
+                with lock:
+                    statuses[status] = statuses.get(status, 0) + 1
+                    if status == 302:
+                        logins.append(elapsed)
+
+        def probe():
+            while time.perf_counter() < deadline:
+                probes.append(request(port, 'GET', '/login')[1])
+                time.sleep(0.05)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+        threads.append(threading.Thread(target=probe))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'hash_workers': workers,
+        'logins_per_s': round(len(logins) / args.duration, 1),
+        'login_p50_ms': percentile(logins, 0.5),
+        'login_p95_ms': percentile(logins, 0.95),
+        'other_request_p50_ms': percentile(probes, 0.5),
+        'other_request_p95_ms': percentile(probes, 0.95),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--users', type=int, default=8, help='distinct accounts to log in as')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count() or 1],
+                        help='HOSPITAL_PASSWORD_HASH_WORKERS values to compare')
+    parser.add_argument('--method', default='scrypt:32768:8:1',
+                        help='hash policy for the server and the seeded accounts')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hms-login-')
+    env = dict(os.environ,
+               HOSPITAL_DB=os.path.join(workdir, 'hospital.db'),
+               HOSPITAL_PASSWORD_HASH_METHOD=args.method)
+    shutil.copy(os.path.join(ROOT, 'hospital.db'), env['HOSPITAL_DB'])
+    seed_users(env['HOSPITAL_DB'], args.users, args.method)
+
+    try:
+        results = [measure(env, workers, args) for workers in args.workers]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Check the query plan of every SQL statement the routes run.
+
+    python bench/query_plans.py --database /tmp/bench.db
+
+Every route recipe from run.py is called through the Flask test client with
+a trace callback on the request's connection, once with the medication
+cache on and once with it off so both search paths are seen. Each distinct
+statement is then run through EXPLAIN QUERY PLAN against the same data. A
+plan fails when it scans a table with at least --min-rows rows or sorts
+through a temporary B-tree for ORDER BY. Exits with status 1 on any failure;
+run.py runs this in a separate process before timing anything.
+
+Before that, last year's medical records are moved to an archive file so
+the ``?history=all`` recipes read a real archive partition. Work the routes
+hand to background threads is traced too: the queued jobs are run to the
+end under the label "job_worker", and a reminder scheduler loads, extends
+and sends its window under "reminder_scheduler". The app's own worker and
+scheduler threads are kept off while this runs.
+
+Statements run inside triggers do not appear in the plan of the statement
+that fires them and are not checked.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+import run
+
+# Full scans that are the point of the statement, by (endpoint, table)
+ALLOWED_SCANS = {
+    # The medications page lists the whole catalogue, in name order
+    ('view_medications', 'medications'): 'lists the whole catalogue',
+    # The in-memory catalogue snapshot is built from every medication
+    ('search_medications', 'medications'): 'builds the catalogue snapshot',
+}
+# Sorts that cannot come from an index, by endpoint
+ALLOWED_SORTS = {
+    # bm25 rank is computed per match, and only the matching rows are sorted
+    'search_medications': 'orders full-text matches by rank',
+}
+# ?history=all merges one page per archive partition; each page is at most
+# limit + 1 rows, so sorting them is bounded whatever the archive size
+MERGED_PARTITIONS = re.compile(r'\barchive_\d{4}\.')
+SKIPPED_PREFIXES = ('ATTACH', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'PRAGMA', '--')
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+TABLE_REFERENCES = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+NOT_ALIASES = {'WHERE', 'ON', 'JOIN', 'LEFT', 'INNER', 'CROSS', 'NATURAL', 'ORDER', 'GROUP',
+               'LIMIT', 'USING', 'SET', 'VALUES', 'UNION', 'AND', 'OR'}
+
+
+def statement_shape(sql):
+    """The statement with its literals replaced, so repeated calls group together."""
+    return LITERALS.sub('?', ' '.join(sql.split()))
+
+
+def table_aliases(sql):
+    """Map the aliases in ``sql`` to table names; plans name tables by alias."""
+    aliases = {}
+    for table, alias in TABLE_REFERENCES.findall(sql):
+        aliases[table] = table
+        if alias and alias.upper() not in NOT_ALIASES:
+            aliases[alias] = table
+    return aliases
+
+
+def collect_statements(database):
+    """Call every route and return ``{(endpoint, shape): sql}`` of what it ran."""
+    from flask import request
+
+    sys.path.insert(0, run.ROOT)
+    import app as hospital
+
+    statements = {}
+
+    def recorder(endpoint):
+        def record(sql):
+            sql = ' '.join(sql.split())
+            if not sql.upper().startswith(SKIPPED_PREFIXES):
+                statements.setdefault((endpoint, statement_shape(sql)), sql)
+        return record
+
+    def trace_request():
+        hospital.get_db().set_trace_callback(recorder(request.endpoint))
+
+    # Jobs and reminders are run below, on traced connections
+    hospital.app.config.update(JOB_WORKERS=0, REMINDERS_ENABLED=False, RETENTION_PAUSE=0)
+    conn = hospital.connect_db(database)
+    hospital.archive_medical_records(conn, f'{date.today().year}-01-01', pause=0)
+    conn.close()
+
+    hospital.app.before_request(trace_request)
+    clients = run.test_clients(database)
+    routes = run.recipes(run.load_fixture(database))
+    config = hospital.app.config
+    scheduler = hospital.ReminderScheduler(database, timedelta(hours=config['REMINDER_LEAD_HOURS']),
+                                           timedelta(hours=config['REMINDER_WINDOW_HOURS']),
+                                           config['REMINDER_BATCH'], config['REMINDER_TICK_SECONDS'])
+    conn = hospital.connect_db(database)
+    conn.set_trace_callback(recorder('reminder_scheduler'))
+    scheduler.refresh(conn, datetime.now())
+    for medication_cache in (True, False):
+        hospital.app.config['MEDICATION_CACHE'] = medication_cache
+        hospital.medication_catalog.invalidate()
+        for recipe in routes.values():
+            for i in range(2):
+                run.call(clients, recipe, i)
+
+    # A day later: picks up the bookings made above and extends the window
+    tomorrow = datetime.now() + timedelta(days=1)
+    scheduler.refresh(conn, tomorrow)
+    scheduler.send_due(conn, tomorrow)
+    conn.set_trace_callback(recorder('job_worker'))
+    while hospital.run_next_job(conn):
+        pass
+    conn.close()
+    return statements
+
+
+def table_sizes(conn):
+    cursor = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {name: conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0]
+            for (name,) in cursor.fetchall()}
+
+
+def plan_problems(sql, plan, endpoint, sizes, min_rows):
+    aliases = table_aliases(sql)
+    problems = []
+    for detail in plan:
+        scan = re.match(r'SCAN (?:\w+\.)?(\w+)', detail)
+        table = scan and aliases.get(scan.group(1), scan.group(1))
+        if (scan and sizes.get(table, 0) >= min_rows and 'VIRTUAL TABLE' not in detail
+                and (endpoint, table) not in ALLOWED_SCANS):
+            problems.append(f'{detail} ({table}: {sizes[table]} rows)')
+        if ('TEMP B-TREE' in detail and 'ORDER BY' in detail and endpoint not in ALLOWED_SORTS
+                and not MERGED_PARTITIONS.search(sql)):
+            problems.append(detail)
+    return problems
+
+
+def check(database, min_rows=1000):
+    """Returns ``{'checked': n, 'failures': [...]}`` for the routes run on ``database``."""
+    statements = collect_statements(database)
+    import app as hospital
+
+    # Archive partitions are named by their schema in the statements
+    conn = hospital.connect_db(database)
+    hospital.attach_archives(conn)
+    sizes = table_sizes(conn)
+    failures = []
+    # Statements against a route's temp tables need those tables to exist
+    for sql in set(statements.values()):
+        if sql.upper().startswith('CREATE TEMP'):
+            conn.execute(sql)
+    for (endpoint, _), sql in sorted(statements.items()):
+        plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+        problems = plan_problems(sql, plan, endpoint, sizes, min_rows)
+        if problems:
+            failures.append({'endpoint': endpoint, 'sql': sql, 'problems': problems, 'plan': plan})
+    conn.close()
+    return {'checked': len(statements), 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='database from generate_data.py; one is generated if omitted')
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help='tables with at least this many rows must not be scanned')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='hms-plans-')
+    try:
+        database = os.path.join(workdir, 'plans.db')
+        if args.database:
+            shutil.copy(args.database, database)
+        else:
+            run.generate_data.generate(database)
+        result = check(database, args.min_rows)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for failure in result['failures']:
+        print(f"{failure['endpoint']}: {failure['sql']}")
+        for problem in failure['problems']:
+            print(f'    {problem}')
+    print(f"{result['checked']} statements checked, {len(result['failures'])} with bad plans")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if result['failures']:
+        print(json.dumps(result['failures'], indent=2), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
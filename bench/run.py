@@ -0,0 +1,405 @@
+"""Benchmark every route, in process and over HTTP, and write the results as JSON.
+
+    python bench/generate_data.py /tmp/bench.db
+    python bench/run.py --database /tmp/bench.db --output bench-$(git rev-parse --short HEAD).json
+    python bench/run.py --database /tmp/bench.db --compare bench-abc1234.json
+
+Each run works on a copy of --database (a small one is generated when it is
+left out), so write routes never touch the original. In "client" mode every
+route is called --requests times through the Flask test client, which leaves
+out the server and network. In "http" mode ``flask run`` serves the copy and
+--concurrency threads share the same number of requests. Each route gets
+p50/p95/p99 latency in milliseconds, requests per second and its status
+codes. --compare prints how p50 and p95 moved against an earlier result file.
+Both modes run the app without its background job workers and reminder
+scheduler, so their writes do not land in the middle of timed requests.
+
+Before any timing, query_plans.py checks the plan of every statement the
+routes run; its result is stored under "query_plans" and a bad plan makes
+the run exit with status 1 once the results are written.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import date, datetime, timedelta
+
+import generate_data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'password'
+# Streams never finish, so they cannot be timed per request
+SKIPPED = {'events': 'server-sent event stream'}
+
+
+def load_fixture(database):
+    """Pick the accounts and ids the route recipes work with."""
+    conn = sqlite3.connect(database)
+    cursor = conn.cursor()
+    # The busiest doctor and patient: the worst case for their dashboards
+    cursor.execute('''
+        SELECT doctor_id, u.email FROM appointments a JOIN users u ON u.id = a.doctor_id
+        GROUP BY doctor_id ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    doctor_id, doctor_email = cursor.fetchone()
+    cursor.execute('''
+        SELECT patient_id, u.email FROM appointments a JOIN users u ON u.id = a.patient_id
+        GROUP BY patient_id ORDER BY COUNT(*) DESC LIMIT 1
+    ''')
+    patient_id, patient_email = cursor.fetchone()
+    cursor.execute('SELECT id FROM appointments WHERE doctor_id = ? ORDER BY id DESC LIMIT 1000', (doctor_id,))
+    appointments = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT id FROM medical_records WHERE doctor_id = ? ORDER BY id DESC', (doctor_id,))
+    records = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT id FROM notifications WHERE user_id = ? ORDER BY id DESC', (patient_id,))
+    notifications = [row[0] for row in cursor.fetchall()] or [0]
+    cursor.execute('SELECT name FROM medications ORDER BY id LIMIT 50')
+    terms = sorted({name[:4] for (name,) in cursor.fetchall()})
+    conn.close()
+    return {
+        'doctor_id': doctor_id, 'doctor_email': doctor_email,
+        'patient_id': patient_id, 'patient_email': patient_email,
+        'appointments': appointments, 'records': records,
+        'notifications': notifications, 'terms': terms,
+        'run': datetime.now().strftime('%H%M%S%f'),
+    }
+
+
+def recipes(fx):
+    """Per endpoint, a function of the call number giving (role, method, path, options).
+
+    Options are ``form`` or ``json`` request bodies. Write routes use fresh
+    values on every call so that they keep doing real work.
+    """
+    today = date.today()
+    records = iter(fx['records'])
+
+    def cycle(values, i):
+        return values[i % len(values)]
+
+    def future_slot(i):
+        # Far enough ahead to be free, one of the default working hour slots
+        day = today + timedelta(days=400 + i // 6)
+        return day.isoformat(), ('09:00', '10:00', '11:00', '14:00', '15:00', '16:00')[i % 6]
+
+    def schedule(i):
+        day, slot = future_slot(i)
+        return ('patient', 'POST', '/schedule-appointment',
+                {'form': {'doctor_id': fx['doctor_id'], 'appointment_date': day,
+                          'appointment_time': slot, 'notes': 'bench'}})
+
+    def batch_update(i):
+        start = i * 20 % len(fx['appointments'])
+        ids = (fx['appointments'] * 2)[start:start + 20]
+        return ('doctor', 'POST', '/doctor/update-appointments',
+                {'json': {'updates': [{'appointment_id': a, 'status': 'completed'} for a in ids]}})
+
+    return {
+        'index': lambda i: ('anon', 'GET', '/', {}),
+        # The POSTs hash a password and the form renders do not, so they are
+        # timed apart; *_form are GETs of the same endpoints
+        'login': lambda i: ('anon', 'POST', '/login',
+                            {'form': {'email': fx['patient_email'], 'password': PASSWORD}}),
+        'login_form': lambda i: ('anon', 'GET', '/login', {}),
+        'register': lambda i: ('anon', 'POST', '/register',
+                               {'form': {'name': 'Bench User', 'email': f"bench-{fx['run']}-{i}@bench.test",
+                                         'password': PASSWORD, 'user_type': 'patient', 'phone': '1'}}),
+        'register_form': lambda i: ('anon', 'GET', '/register', {}),
+        'logout': lambda i: ('anon', 'GET', '/logout', {}),
+        'patient_dashboard': lambda i: ('patient', 'GET', '/patient/dashboard', {}),
+        'patient_dashboard_json': lambda i: ('patient', 'GET', '/api/patient/dashboard', {}),
+        'doctor_dashboard': lambda i: ('doctor', 'GET', '/doctor/dashboard', {}),
+        'doctor_dashboard_json': lambda i: ('doctor', 'GET', '/api/doctor/dashboard', {}),
+        # ?history=all attaches the record archives and reads every partition
+        'patient_dashboard_all_history': lambda i: ('patient', 'GET', '/api/patient/dashboard?history=all', {}),
+        'doctor_dashboard_all_history': lambda i: ('doctor', 'GET', '/api/doctor/dashboard?history=all', {}),
+        'schedule_appointment': schedule,
+        'doctor_free_slots': lambda i: ('patient', 'GET',
+                                        f"/api/doctors/{fx['doctor_id']}/free-slots?start={today}"
+                                        f"&end={today + timedelta(days=13)}", {}),
+        'update_appointment': lambda i: ('doctor', 'POST', '/doctor/update-appointment',
+                                         {'json': {'appointment_id': cycle(fx['appointments'], i),
+                                                   'status': 'accepted'}}),
+        'update_appointments': batch_update,
+        'create_medical_record': lambda i: ('doctor', 'POST', '/doctor/medical-record',
+                                            {'json': {'appointment_id': cycle(fx['appointments'], i),
+                                                      'diagnosis': 'Bench diagnosis',
+                                                      'prescription': 'Bench prescription', 'notes': ''}}),
+        # Once the doctor's records run out the route still looks them up
+        'delete_medical_record': lambda i: ('doctor', 'POST',
+                                            f'/doctor/delete-medical-record/{next(records, 0)}', {}),
+        'get_notifications': lambda i: ('patient', 'GET', '/notifications', {}),
+        'get_notifications_json': lambda i: ('patient', 'GET', '/api/notifications', {}),
+        'mark_notification_read': lambda i: ('patient', 'POST',
+                                             f"/mark-notification-read/{cycle(fx['notifications'], i)}", {}),
+        'view_departments': lambda i: ('patient', 'GET', '/departments', {}),
+        'view_medications': lambda i: ('patient', 'GET', '/medications', {}),
+        'manage_departments': lambda i: ('doctor', 'POST', '/admin/departments',
+                                         {'form': {'name': f"Bench {fx['run']} {i}", 'description': 'bench',
+                                                   'phone': '1', 'location': 'bench'}}),
+        'manage_medications': lambda i: ('doctor', 'POST', '/admin/medications',
+                                         {'form': {'name': f"Benchamol {fx['run']} {i}",
+                                                   'generic_name': 'benchamol', 'description': 'bench',
+                                                   'dosage': '1mg', 'side_effects': '', 'price': '1',
+                                                   'stock_quantity': '1', 'manufacturer': 'bench'}}),
+        'search_medications': lambda i: ('doctor', 'GET',
+                                         f"/api/medications/search?q={cycle(fx['terms'], i)}", {}),
+        'medication_cache_stats': lambda i: ('doctor', 'GET', '/api/medications/cache-stats', {}),
+        'metrics_endpoint': lambda i: ('anon', 'GET', '/metrics', {}),
+        'broadcast': lambda i: ('doctor', 'POST', '/admin/notifications/broadcast',
+                                {'json': {'cohort': 'day', 'start': (today + timedelta(days=i % 60)).isoformat(),
+                                          'end': (today + timedelta(days=i % 60)).isoformat(),
+                                          'message': 'bench'}}),
+    }
+
+
+def summarize(latencies, statuses, wall):
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {
+        'requests': len(ordered),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'rps': round(len(ordered) / wall, 1),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def test_clients(database):
+    """Point the app at ``database`` and log a test client in for every role."""
+    sys.path.insert(0, ROOT)
+    import app as hospital
+
+    logging.getLogger('hospital.slow_queries').setLevel(logging.ERROR)
+    hospital.app.config.update(DATABASE=database, JOB_WORKERS=0, REMINDERS_ENABLED=False)
+    fx = load_fixture(database)
+    clients = {'anon': hospital.app.test_client(use_cookies=False)}
+    for role in ('patient', 'doctor'):
+        clients[role] = hospital.app.test_client()
+        clients[role].post('/login', data={'email': fx[f'{role}_email'], 'password': PASSWORD})
+    return clients
+
+
+def call(clients, recipe, i):
+    role, method, path, options = recipe(i)
+    response = clients[role].open(path, method=method, data=options.get('form'), json=options.get('json'))
+    response.close()
+    return response
+
+
+def run_client(database, routes, args):
+    clients = test_clients(database)
+    results = {}
+    for endpoint, recipe in routes.items():
+        calls = itertools.count()
+        latencies, statuses = [], {}
+        for n in range(args.warmup + args.requests):
+            started = time.perf_counter()
+            response = call(clients, recipe, next(calls))
+            elapsed = time.perf_counter() - started
+            if n >= args.warmup:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        results[endpoint] = summarize(latencies, statuses, sum(latencies))
+        print(f"client {endpoint:28} p50 {results[endpoint]['p50_ms']:8.2f} ms", file=sys.stderr)
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http_request(port, method, path, options, cookie=None):
+    headers = {'Cookie': cookie} if cookie else {}
+    body = None
+    if 'form' in options:
+        body = urllib.parse.urlencode(options['form'])
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    elif 'json' in options:
+        body = json.dumps(options['json'])
+        headers['Content-Type'] = 'application/json'
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    try:
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        response.read()
+        return response
+    finally:
+        conn.close()
+
+
+def run_http(database, routes, args):
+    fx = load_fixture(database)
+    port = free_port()
+    env = dict(os.environ, HOSPITAL_DB=database, HOSPITAL_JOB_WORKERS='0', HOSPITAL_REMINDERS='0')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.perf_counter() + args.timeout
+        while True:
+            try:
+                http_request(port, 'GET', '/login', {})
+                break
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise RuntimeError('server did not answer within %ss' % args.timeout)
+                time.sleep(0.05)
+
+        cookies = {'anon': None}
+        for role in ('patient', 'doctor'):
+            response = http_request(port, 'POST', '/login',
+                                    {'form': {'email': fx[f'{role}_email'], 'password': PASSWORD}})
+            cookies[role] = response.getheader('Set-Cookie').split(';', 1)[0]
+
+        results = {}
+        for endpoint, recipe in routes.items():
+            calls = itertools.count()
+            for _ in range(args.warmup):
+                role, method, path, options = recipe(next(calls))
+                http_request(port, method, path, options, cookies[role])
+
+            latencies, statuses = [], {}
+            lock = threading.Lock()
+            remaining = itertools.count()
+
+            def worker():
+                while next(remaining) < args.requests:
+                    role, method, path, options = recipe(next(calls))
+                    started = time.perf_counter()
+                    try:
+                        status = http_request(port, method, path, options, cookies[role]).status
+                    except OSError:
+                        status = 'error'
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        statuses[status] = statuses.get(status, 0) + 1
+
+            threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results[endpoint] = summarize(latencies, statuses, time.perf_counter() - started)
+            print(f"http   {endpoint:28} p50 {results[endpoint]['p50_ms']:8.2f} ms", file=sys.stderr)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(result, previous):
+    for mode in ('client', 'http'):
+        if mode not in result or mode not in previous:
+            continue
+        print(f'\n{mode:6} {"endpoint":28} {"p50 ms":>18} {"p95 ms":>18}')
+        for endpoint, now in result[mode].items():
+            before = previous[mode].get(endpoint)
+            if before is None:
+                continue
+            cells = []
+            for key in ('p50_ms', 'p95_ms'):
+                change = (now[key] - before[key]) / before[key] * 100 if before[key] else 0
+                cells.append(f'{before[key]:7.2f} -> {now[key]:7.2f} {change:+5.0f}%')
+            print(f'{"":6} {endpoint:28} ' + '  '.join(cells))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', help='database from generate_data.py; a small one is generated if omitted')
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed requests per route first')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads in http mode')
+    parser.add_argument('--routes', nargs='+', help='only these endpoints')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    parser.add_argument('--skip-plans', action='store_true', help='do not check query plans first')
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from app import app as flask_app
+
+    workdir = tempfile.mkdtemp(prefix='hms-bench-')
+    try:
+        source = args.database
+        if source is None:
+            source = os.path.join(workdir, 'generated.db')
+            generate_data.generate(source, {'patients': 2000, 'appointments': 20000, 'medical_records': 8000,
+                                            'notifications': 10000, 'medications': 500})
+        conn = sqlite3.connect(source)
+        dataset = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                   for table in ('users', 'appointments', 'medical_records', 'notifications', 'medications')}
+        conn.close()
+
+        endpoints = {rule.endpoint for rule in flask_app.url_map.iter_rules()} - {'static'}
+        all_routes = recipes(load_fixture(source))
+        skipped = dict(SKIPPED)
+        skipped.update({endpoint: 'no benchmark recipe' for endpoint in endpoints - all_routes.keys() - SKIPPED.keys()})
+        chosen = args.routes or sorted(all_routes)
+
+        result = {
+            'commit': git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'dataset': dataset,
+            'settings': {'requests': args.requests, 'warmup': args.warmup, 'concurrency': args.concurrency},
+            'skipped': skipped,
+        }
+        if not args.skip_plans:
+            # In its own process, so its tracing does not slow down the timed runs
+            plans_output = os.path.join(workdir, 'query_plans.json')
+            subprocess.run([sys.executable, os.path.join(ROOT, 'bench', 'query_plans.py'),
+                            '--database', source, '--output', plans_output], stdout=sys.stderr)
+            with open(plans_output) as f:
+                result['query_plans'] = json.load(f)
+        # Every mode starts from a fresh copy, so write routes see the same data
+        for mode, runner in (('client', run_client), ('http', run_http)):
+            if args.mode in (mode, 'both'):
+                database = os.path.join(workdir, f'{mode}.db')
+                shutil.copy(source, database)
+                routes = recipes(load_fixture(database))
+                result[mode] = runner(database, {endpoint: routes[endpoint] for endpoint in chosen}, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    if result.get('query_plans', {}).get('failures'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
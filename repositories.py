@@ -0,0 +1,720 @@
+"""Data access for the hospital app.
+
+Every query the routes run lives in one of the repositories below. A
+repository wraps one open connection and is cheap to create, so views make
+one per request on the connection they already hold. SQL text is fixed per
+method (keyset conditions and IN lists included), which lets sqlite3's
+per-connection statement cache hand back the prepared statement instead of
+compiling it again on every call.
+
+Results come back as row objects with one attribute per selected column.
+They use ``__slots__``, so a row costs little more than the tuple it was
+built from, and templates and JSON views name columns instead of indexing.
+"""
+import json
+
+# Appointment statuses. A slot is held by every appointment whose status is
+# not in SLOT_RELEASING_STATUSES.
+APPOINTMENT_STATUSES = ('pending', 'accepted', 'rejected', 'cancelled', 'completed', 'no-show')
+SLOT_RELEASING_STATUSES = ('rejected', 'cancelled')
+# Patients are reminded of appointments in these statuses
+REMINDER_STATUSES = ('pending', 'accepted')
+
+# Broadcast cohorts: patients with an appointment that holds its slot, in a
+# date range, and with one doctor, with a department's doctors (matched on
+# users.specialization) or with anyone ('day', for a whole day's bookings)
+BROADCAST_COHORTS = {
+    'doctor': 'AND a.doctor_id = ?',
+    'department': "AND a.doctor_id IN (SELECT id FROM users WHERE user_type = 'doctor' AND specialization = ?)",
+    'day': '',
+}
+
+class InvalidCursor(ValueError):
+    """A page cursor whose key does not fit the query it was passed to."""
+
+# Row types
+class Row:
+    """A result row; subclasses list their columns, in SELECT order, as slots."""
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+class Credentials(Row):
+    __slots__ = ('id', 'password_hash', 'name', 'user_type')
+
+class Doctor(Row):
+    __slots__ = ('id', 'name', 'specialization')
+
+class WorkingHours(Row):
+    __slots__ = ('weekday', 'start_time', 'end_time')
+
+class PatientAppointment(Row):
+    __slots__ = ('id', 'doctor_name', 'appointment_date', 'appointment_time', 'status', 'notes')
+
+class DoctorAppointment(Row):
+    __slots__ = ('id', 'patient_name', 'appointment_date', 'appointment_time', 'status', 'notes',
+                 'patient_phone')
+
+class UpcomingAppointment(Row):
+    __slots__ = ('id', 'appointment_date', 'appointment_time')
+
+class BookedSlot(Row):
+    __slots__ = ('appointment_date', 'appointment_time')
+
+class PatientRecord(Row):
+    __slots__ = ('id', 'doctor_name', 'diagnosis', 'prescription', 'notes', 'created_at')
+
+class DoctorRecord(Row):
+    __slots__ = ('id', 'patient_name', 'diagnosis', 'prescription', 'notes', 'created_at',
+                 'patient_phone')
+
+class RecordSummary(Row):
+    __slots__ = ('patient_id', 'patient_name', 'diagnosis', 'created_at')
+
+class Notification(Row):
+    __slots__ = ('id', 'message', 'type', 'is_read', 'created_at')
+
+class NotificationEvent(Row):
+    """A new notification with its owner's unread count, for the event stream."""
+
+    __slots__ = ('user_id', 'id', 'message', 'type', 'is_read', 'created_at', 'unread')
+
+class Job(Row):
+    __slots__ = ('id', 'kind', 'payload', 'attempts', 'max_attempts')
+
+class JobStatus(Row):
+    __slots__ = ('kind', 'status', 'jobs', 'oldest')
+
+class DeadJob(Row):
+    __slots__ = ('id', 'kind', 'payload', 'attempts', 'last_error', 'created_at')
+
+class Department(Row):
+    __slots__ = ('id', 'name', 'description', 'phone', 'location', 'head_doctor', 'doctor_count',
+                 'upcoming_appointments', 'appointments_today')
+
+class Medication(Row):
+    __slots__ = ('id', 'name', 'generic_name', 'description', 'dosage', 'side_effects', 'price',
+                 'stock_quantity', 'manufacturer')
+
+class MedicationMatch(Row):
+    """What the medication typeahead shows for one result."""
+
+    __slots__ = ('id', 'name', 'generic_name', 'dosage', 'price')
+
+# Repositories
+class Repository:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _rows(self, row_type, sql, params=()):
+        return [row_type(*row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def _row(self, row_type, sql, params=()):
+        row = self.conn.execute(sql, params).fetchone()
+        return row_type(*row) if row else None
+
+    def _value(self, sql, params=(), default=None):
+        row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def _keyset(key_columns, after):
+        """The ``{after}`` condition and its parameters for a page after ``after``."""
+        if after is None:
+            return '', []
+        if len(after) != len(key_columns):
+            raise InvalidCursor(after)
+        placeholders = ', '.join('?' * len(key_columns))
+        return f"AND ({', '.join(key_columns)}) < ({placeholders})", list(after)
+
+    @staticmethod
+    def _page_rows(row_type, rows, key_size, limit):
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = rows[-1][-key_size:]
+        size = len(row_type.__slots__)
+        return [row_type(*row[:size]) for row in rows], next_key
+
+    def _page(self, row_type, sql, params, key_columns, after, limit):
+        """Run a keyset query and return ``(rows, next_key)``.
+
+        ``sql`` selects the row type's columns followed by ``key_columns``, has
+        an ``{after}`` placeholder in its WHERE clause and ends with the
+        matching descending ORDER BY. ``after`` is the key of the previous
+        page's last row, or None for the first page.
+        """
+        condition, key_params = self._keyset(key_columns, after)
+        rows = self.conn.execute(sql.format(after=condition) + ' LIMIT ?',
+                                 list(params) + key_params + [limit + 1]).fetchall()
+        return self._page_rows(row_type, rows, len(key_columns), limit)
+
+class UserRepo(Repository):
+    def credentials(self, email):
+        return self._row(Credentials, '''
+            SELECT id, password_hash, name, user_type FROM users WHERE email = ?
+        ''', (email,))
+
+    def replace_password_hash(self, user_id, old_hash, new_hash):
+        """Store ``new_hash`` unless the hash changed since ``old_hash`` was read."""
+        cursor = self.conn.execute('''
+            UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?
+        ''', (new_hash, user_id, old_hash))
+        return cursor.rowcount == 1
+
+    def create(self, name, email, password_hash, user_type, phone, specialization):
+        """Insert a user and return its id; sqlite3.IntegrityError if the email is taken."""
+        cursor = self.conn.execute('''
+            INSERT INTO users (name, email, password_hash, user_type, phone, specialization)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (name, email, password_hash, user_type, phone, specialization))
+        return cursor.lastrowid
+
+    def doctors(self):
+        return self._rows(Doctor, '''
+            SELECT id, name, specialization FROM users WHERE user_type = 'doctor'
+        ''')
+
+    def is_doctor(self, user_id):
+        return self._value('''
+            SELECT 1 FROM users WHERE id = ? AND user_type = 'doctor'
+        ''', (user_id,)) is not None
+
+    def working_hours(self, doctor_id):
+        return self._rows(WorkingHours, '''
+            SELECT weekday, start_time, end_time FROM doctor_working_hours
+            WHERE doctor_id = ?
+            ORDER BY weekday, start_time
+        ''', (doctor_id,))
+
+class AppointmentRepo(Repository):
+    PAGE_KEY = ('a.appointment_date', 'a.appointment_time', 'a.id')
+    HELD = f"status NOT IN ({', '.join('?' * len(SLOT_RELEASING_STATUSES))})"
+
+    def for_patient(self, patient_id, after=None, limit=25):
+        return self._page(PatientAppointment, '''
+            SELECT a.id, d.name, a.appointment_date, a.appointment_time, a.status, a.notes,
+                   a.appointment_date, a.appointment_time, a.id
+            FROM appointments a
+            JOIN users d ON a.doctor_id = d.id
+            WHERE a.patient_id = ? {after}
+            ORDER BY a.appointment_date DESC, a.appointment_time DESC, a.id DESC
+        ''', (patient_id,), self.PAGE_KEY, after, limit)
+
+    def for_doctor(self, doctor_id, after=None, limit=25):
+        return self._page(DoctorAppointment, '''
+            SELECT a.id, p.name, a.appointment_date, a.appointment_time, a.status, a.notes, p.phone,
+                   a.appointment_date, a.appointment_time, a.id
+            FROM appointments a
+            JOIN users p ON a.patient_id = p.id
+            WHERE a.doctor_id = ? {after}
+            ORDER BY a.appointment_date DESC, a.appointment_time DESC, a.id DESC
+        ''', (doctor_id,), self.PAGE_KEY, after, limit)
+
+    def doctor_appointment(self, doctor_id, appointment_id):
+        """One appointment in the shape of the doctor dashboard list."""
+        return self._row(DoctorAppointment, '''
+            SELECT a.id, p.name, a.appointment_date, a.appointment_time, a.status, a.notes, p.phone
+            FROM appointments a
+            JOIN users p ON a.patient_id = p.id
+            WHERE a.id = ? AND a.doctor_id = ?
+        ''', (appointment_id, doctor_id))
+
+    def doctor_appointments(self, doctor_id, appointment_ids):
+        """Several appointments in the shape of the doctor dashboard list, by id."""
+        return self._rows(DoctorAppointment, '''
+            SELECT a.id, p.name, a.appointment_date, a.appointment_time, a.status, a.notes, p.phone
+            FROM appointments a
+            JOIN users p ON a.patient_id = p.id
+            WHERE a.doctor_id = ? AND a.id IN (SELECT value FROM json_each(?))
+        ''', (doctor_id, json.dumps(list(appointment_ids))))
+
+    def patient_id(self, doctor_id, appointment_id):
+        return self._value('''
+            SELECT patient_id FROM appointments WHERE id = ? AND doctor_id = ?
+        ''', (appointment_id, doctor_id))
+
+    def patient_ids(self, doctor_id, appointment_ids):
+        """``{appointment_id: patient_id}`` for those of the ids the doctor owns."""
+        # The ids travel as one JSON parameter so the statement text, and its
+        # cached prepared statement, is the same for every batch size
+        cursor = self.conn.execute('''
+            SELECT id, patient_id FROM appointments
+            WHERE doctor_id = ? AND id IN (SELECT value FROM json_each(?))
+        ''', (doctor_id, json.dumps(list(appointment_ids))))
+        return dict(cursor.fetchall())
+
+    def booked(self, doctor_id, start, end):
+        """Held appointments of the doctor from ``start`` to ``end`` (ISO dates)."""
+        return self._rows(BookedSlot, f'''
+            SELECT appointment_date, appointment_time FROM appointments
+            WHERE doctor_id = ? AND appointment_date BETWEEN ? AND ?
+              AND {self.HELD}
+        ''', (doctor_id, start, end) + SLOT_RELEASING_STATUSES)
+
+    def held_between(self, doctor_id, appointment_date, lower, upper):
+        """Whether a held appointment starts strictly between ``lower`` and ``upper``."""
+        return self._value(f'''
+            SELECT 1 FROM appointments
+            WHERE doctor_id = ? AND appointment_date = ?
+              AND appointment_time > ? AND appointment_time < ?
+              AND {self.HELD}
+            LIMIT 1
+        ''', (doctor_id, appointment_date, lower, upper) + SLOT_RELEASING_STATUSES) is not None
+
+    def create(self, patient_id, doctor_id, appointment_date, appointment_time, notes):
+        cursor = self.conn.execute('''
+            INSERT INTO appointments (patient_id, doctor_id, appointment_date, appointment_time, notes)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (patient_id, doctor_id, appointment_date, appointment_time, notes))
+        return cursor.lastrowid
+
+    def set_status(self, doctor_id, appointment_id, status):
+        cursor = self.conn.execute('''
+            UPDATE appointments SET status = ? WHERE id = ? AND doctor_id = ?
+        ''', (status, appointment_id, doctor_id))
+        return cursor.rowcount
+
+    def set_statuses(self, doctor_id, appointment_ids, status):
+        cursor = self.conn.execute('''
+            UPDATE appointments SET status = ?
+            WHERE doctor_id = ? AND id IN (SELECT value FROM json_each(?))
+        ''', (status, doctor_id, json.dumps(list(appointment_ids))))
+        return cursor.rowcount
+
+class MedicalRecordRepo(Repository):
+    """Medical records in the main database, plus ``archives`` when given.
+
+    ``archives`` are the schema names of attached per-year archive files.
+    With any, the paged lists read every partition: each one contributes its
+    own newest ``limit + 1`` rows after the cursor, and those are merged.
+    """
+
+    PAGE_KEY = ('m.created_at', 'm.id')
+    PARTITION = '''
+        SELECT * FROM (
+            SELECT id, patient_id, doctor_id, diagnosis, prescription, notes, created_at
+            FROM {schema}.medical_records m
+            WHERE m.{owner} = ? {after}
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT ?
+        )
+    '''
+
+    def __init__(self, conn, archives=()):
+        super().__init__(conn)
+        self.archives = tuple(archives)
+
+    def _partitioned_page(self, row_type, sql, owner, owner_id, after, limit):
+        condition, key_params = self._keyset(self.PAGE_KEY, after)
+        partitions = ' UNION ALL '.join(self.PARTITION.format(schema=schema, owner=owner, after=condition)
+                                        for schema in ('main',) + self.archives)
+        params = ([owner_id] + key_params + [limit + 1]) * (len(self.archives) + 1)
+        rows = self.conn.execute(sql.format(partitions=partitions) + ' LIMIT ?',
+                                 params + [limit + 1]).fetchall()
+        return self._page_rows(row_type, rows, len(self.PAGE_KEY), limit)
+
+    def for_patient(self, patient_id, after=None, limit=25):
+        if self.archives:
+            return self._partitioned_page(PatientRecord, '''
+                SELECT m.id, d.name, m.diagnosis, m.prescription, m.notes, m.created_at,
+                       m.created_at, m.id
+                FROM ({partitions}) m
+                JOIN users d ON m.doctor_id = d.id
+                ORDER BY m.created_at DESC, m.id DESC
+            ''', 'patient_id', patient_id, after, limit)
+        return self._page(PatientRecord, '''
+            SELECT m.id, d.name, m.diagnosis, m.prescription, m.notes, m.created_at,
+                   m.created_at, m.id
+            FROM medical_records m
+            JOIN users d ON m.doctor_id = d.id
+            WHERE m.patient_id = ? {after}
+            ORDER BY m.created_at DESC, m.id DESC
+        ''', (patient_id,), self.PAGE_KEY, after, limit)
+
+    def for_doctor(self, doctor_id, after=None, limit=25):
+        if self.archives:
+            return self._partitioned_page(DoctorRecord, '''
+                SELECT m.id, p.name, m.diagnosis, m.prescription, m.notes, m.created_at, p.phone,
+                       m.created_at, m.id
+                FROM ({partitions}) m
+                JOIN users p ON m.patient_id = p.id
+                ORDER BY m.created_at DESC, m.id DESC
+            ''', 'doctor_id', doctor_id, after, limit)
+        return self._page(DoctorRecord, '''
+            SELECT mr.id, p.name, mr.diagnosis, mr.prescription, mr.notes, mr.created_at, p.phone,
+                   mr.created_at, mr.id
+            FROM medical_records mr
+            JOIN users p ON mr.patient_id = p.id
+            WHERE mr.doctor_id = ? {after}
+            ORDER BY mr.created_at DESC, mr.id DESC
+        ''', (doctor_id,), ('mr.created_at', 'mr.id'), after, limit)
+
+    def doctor_record(self, doctor_id, record_id):
+        """One record in the shape of the doctor dashboard list."""
+        return self._row(DoctorRecord, '''
+            SELECT mr.id, p.name, mr.diagnosis, mr.prescription, mr.notes, mr.created_at, p.phone
+            FROM medical_records mr
+            JOIN users p ON mr.patient_id = p.id
+            WHERE mr.id = ? AND mr.doctor_id = ?
+        ''', (record_id, doctor_id))
+
+    def summary(self, doctor_id, record_id):
+        return self._row(RecordSummary, '''
+            SELECT mr.patient_id, u.name, mr.diagnosis, mr.created_at
+            FROM medical_records mr
+            JOIN users u ON mr.patient_id = u.id
+            WHERE mr.id = ? AND mr.doctor_id = ?
+        ''', (record_id, doctor_id))
+
+    def create(self, appointment_id, patient_id, doctor_id, diagnosis, prescription, notes):
+        cursor = self.conn.execute('''
+            INSERT INTO medical_records (appointment_id, patient_id, doctor_id, diagnosis, prescription, notes)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (appointment_id, patient_id, doctor_id, diagnosis, prescription, notes))
+        return cursor.lastrowid
+
+    def delete(self, doctor_id, record_id):
+        cursor = self.conn.execute('''
+            DELETE FROM medical_records WHERE id = ? AND doctor_id = ?
+        ''', (record_id, doctor_id))
+        return cursor.rowcount
+
+class NotificationRepo(Repository):
+    def for_user(self, user_id, after=None, limit=25):
+        return self._page(Notification, '''
+            SELECT id, message, type, is_read, created_at,
+                   created_at, id
+            FROM notifications
+            WHERE user_id = ? {after}
+            ORDER BY created_at DESC, id DESC
+        ''', (user_id,), ('created_at', 'id'), after, limit)
+
+    def get(self, notification_id):
+        return self._row(Notification, '''
+            SELECT id, message, type, is_read, created_at FROM notifications WHERE id = ?
+        ''', (notification_id,))
+
+    def unread_count(self, user_id):
+        # Kept exact by the notification_counters triggers
+        return self._value('''
+            SELECT unread FROM notification_counters WHERE user_id = ?
+        ''', (user_id,), 0)
+
+    def create(self, user_id, message, notification_type):
+        cursor = self.conn.execute('''
+            INSERT INTO notifications (user_id, message, type) VALUES (?, ?, ?)
+        ''', (user_id, message, notification_type))
+        return cursor.lastrowid
+
+    def mark_read(self, user_id, notification_id):
+        cursor = self.conn.execute('''
+            UPDATE notifications SET is_read = 1
+            WHERE id = ? AND user_id = ?
+        ''', (notification_id, user_id))
+        return cursor.rowcount
+
+    # A broadcast stages its recipients in a temporary table on this
+    # connection, then inserts them in user id order, one range per chunk
+    def stage_broadcast(self, cohort, value, start, end):
+        """Stage the recipients of a BROADCAST_COHORTS cohort; returns how many."""
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS broadcast_recipients (user_id INTEGER PRIMARY KEY)')
+        self.clear_broadcast()
+        params = [start, end, *SLOT_RELEASING_STATUSES]
+        if BROADCAST_COHORTS[cohort]:
+            params.append(value)
+        cursor = self.conn.execute(f'''
+            INSERT OR IGNORE INTO temp.broadcast_recipients (user_id)
+            SELECT a.patient_id FROM appointments a
+            WHERE a.appointment_date BETWEEN ? AND ?
+              AND a.{AppointmentRepo.HELD}
+              {BROADCAST_COHORTS[cohort]}
+        ''', params)
+        return cursor.rowcount
+
+    def broadcast_chunk_end(self, after, size):
+        """The last staged user id of the ``size`` after ``after``, or None when done."""
+        return self._value('''
+            SELECT MAX(user_id) FROM (
+                SELECT user_id FROM temp.broadcast_recipients WHERE user_id > ? ORDER BY user_id LIMIT ?
+            )
+        ''', (after, size))
+
+    def insert_broadcast(self, message, notification_type, after, through):
+        """Notify the staged users in ``(after, through]``; returns ``(count, last_id)``.
+
+        Run inside a write transaction, the new ids are the ``count`` ids
+        ending at ``last_id``.
+        """
+        cursor = self.conn.execute('''
+            INSERT INTO notifications (user_id, message, type)
+            SELECT user_id, ?, ? FROM temp.broadcast_recipients
+            WHERE user_id > ? AND user_id <= ?
+            ORDER BY user_id
+        ''', (message, notification_type, after, through))
+        return cursor.rowcount, cursor.lastrowid
+
+    def clear_broadcast(self):
+        self.conn.execute('DELETE FROM temp.broadcast_recipients')
+
+    # Retention. Only read notifications are ever deleted, in chunks of
+    # ``limit`` rows so each delete is a short transaction
+    def delete_expired(self, age, limit):
+        """Delete up to ``limit`` read notifications older than ``age`` (e.g. '-90 days')."""
+        cursor = self.conn.execute('''
+            DELETE FROM notifications WHERE id IN (
+                SELECT id FROM notifications
+                WHERE is_read = 1 AND created_at < datetime('now', ?)
+                LIMIT ?
+            )
+        ''', (age, limit))
+        return cursor.rowcount
+
+    def next_over_cap(self, after_user, cap, limit):
+        """The first of the ``limit`` users after ``after_user`` with more than
+        ``cap`` notifications, and the last user looked at; both None at the end.
+        """
+        cursor = self.conn.execute('''
+            SELECT user_id, COUNT(*) FROM notifications
+            WHERE user_id > ?
+            GROUP BY user_id ORDER BY user_id LIMIT ?
+        ''', (after_user, limit))
+        counts = cursor.fetchall()
+        over = next((user_id for user_id, count in counts if count > cap), None)
+        return over, counts[-1][0] if counts else None
+
+    def delete_over_cap(self, user_id, cap, limit):
+        """Delete up to ``limit`` of the user's read notifications beyond the newest ``cap``."""
+        cursor = self.conn.execute('''
+            DELETE FROM notifications WHERE id IN (
+                SELECT id FROM notifications
+                WHERE user_id = ? AND is_read = 1 AND (created_at, id) <= (
+                    SELECT created_at, id FROM notifications WHERE user_id = ?
+                    ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?
+                )
+                LIMIT ?
+            )
+        ''', (user_id, user_id, cap, limit))
+        return cursor.rowcount
+
+    def events(self, first_id, last_id, user_ids):
+        """Notifications ``first_id``..``last_id`` that belong to ``user_ids``."""
+        return self._rows(NotificationEvent, '''
+            SELECT n.user_id, n.id, n.message, n.type, n.is_read, n.created_at, COALESCE(c.unread, 0)
+            FROM notifications n
+            LEFT JOIN notification_counters c ON c.user_id = n.user_id
+            WHERE n.id BETWEEN ? AND ? AND n.user_id IN (SELECT value FROM json_each(?))
+        ''', (first_id, last_id, json.dumps(list(user_ids))))
+
+class ReminderRepo(Repository):
+    """Appointments still owed a reminder; ``reminded_at`` marks those sent."""
+
+    DUE = f"status IN ({', '.join('?' * len(REMINDER_STATUSES))}) AND reminded_at IS NULL"
+
+    def last_appointment_id(self):
+        return self._value('SELECT MAX(id) FROM appointments') or 0
+
+    def upcoming(self, first_day, last_day):
+        return self._rows(UpcomingAppointment, f'''
+            SELECT id, appointment_date, appointment_time FROM appointments
+            WHERE appointment_date BETWEEN ? AND ? AND {self.DUE}
+        ''', (first_day, last_day) + REMINDER_STATUSES)
+
+    def created_between(self, after_id, through_id, first_day, last_day):
+        """Like ``upcoming``, for appointments with ids in ``(after_id, through_id]`` only."""
+        # The unary + keeps the planner on the id range, not the date index
+        return self._rows(UpcomingAppointment, f'''
+            SELECT id, appointment_date, appointment_time FROM appointments
+            WHERE id > ? AND id <= ? AND +appointment_date BETWEEN ? AND ? AND {self.DUE}
+        ''', (after_id, through_id, first_day, last_day) + REMINDER_STATUSES)
+
+    def send(self, appointment_ids, message, sent_at):
+        """Mark the appointments reminded and notify their patients.
+
+        Appointments already reminded, or no longer in REMINDER_STATUSES, are
+        skipped. ``message`` is a printf format taking the doctor's name, the
+        date and the time. Returns ``(count, last_id)`` of the notifications,
+        whose ids are the ``count`` ids ending at ``last_id``.
+        """
+        claimed = self.conn.execute(f'''
+            UPDATE appointments SET reminded_at = ?
+            WHERE id IN (SELECT value FROM json_each(?)) AND {self.DUE}
+            RETURNING id
+        ''', (sent_at, json.dumps(list(appointment_ids))) + REMINDER_STATUSES).fetchall()
+        if not claimed:
+            return 0, None
+        cursor = self.conn.execute('''
+            INSERT INTO notifications (user_id, message, type)
+            SELECT a.patient_id, printf(?, d.name, a.appointment_date, a.appointment_time), 'info'
+            FROM appointments a
+            JOIN users d ON d.id = a.doctor_id
+            WHERE a.id IN (SELECT value FROM json_each(?))
+            ORDER BY a.id
+        ''', (message, json.dumps([row[0] for row in claimed])))
+        return cursor.rowcount, cursor.lastrowid
+
+class JobRepo(Repository):
+    """The jobs table. Times are Unix seconds.
+
+    A claim bumps ``attempts``, which doubles as the lease token: completing
+    or failing a job only succeeds for the attempt that still holds it, so a
+    worker whose lease ran out cannot finish a job that was handed on.
+    """
+
+    def enqueue(self, kind, payload, run_after, max_attempts):
+        cursor = self.conn.execute('''
+            INSERT INTO jobs (kind, payload, run_after, max_attempts) VALUES (?, ?, ?, ?)
+        ''', (kind, json.dumps(payload), run_after, max_attempts))
+        return cursor.lastrowid
+
+    def next_ready(self, now):
+        return self._value('''
+            SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ?
+            ORDER BY run_after LIMIT 1
+        ''', (now,))
+
+    def next_run_after(self):
+        return self._value('''
+            SELECT MIN(run_after) FROM jobs WHERE status = 'queued'
+        ''')
+
+    def has_expired_leases(self, now):
+        return self._value('''
+            SELECT 1 FROM jobs WHERE status = 'running' AND leased_until <= ? LIMIT 1
+        ''', (now,)) is not None
+
+    def release_expired(self, now):
+        """Requeue jobs whose worker went away, or bury them if out of attempts."""
+        cursor = self.conn.execute('''
+            UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                            leased_until = NULL, run_after = ?, last_error = 'lease expired'
+            WHERE status = 'running' AND leased_until <= ?
+        ''', (now, now))
+        return cursor.rowcount
+
+    def claim(self, job_id, leased_until):
+        """Lease a queued job; None if another worker got it first."""
+        return self._row(Job, '''
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, leased_until = ?
+            WHERE id = ? AND status = 'queued'
+            RETURNING id, kind, payload, attempts, max_attempts
+        ''', (leased_until, job_id))
+
+    def complete(self, job_id, attempt):
+        cursor = self.conn.execute('''
+            DELETE FROM jobs WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', (job_id, attempt))
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, attempt, error, retry_at):
+        cursor = self.conn.execute('''
+            UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                            leased_until = NULL, run_after = ?, last_error = ?
+            WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', (retry_at, error, job_id, attempt))
+        return cursor.rowcount == 1
+
+    def status(self):
+        return self._rows(JobStatus, '''
+            SELECT kind, status, COUNT(*), MIN(created_at) FROM jobs
+            GROUP BY kind, status ORDER BY kind, status
+        ''')
+
+    def dead(self, limit=50):
+        return self._rows(DeadJob, '''
+            SELECT id, kind, payload, attempts, last_error, created_at FROM jobs
+            WHERE status = 'dead' ORDER BY id LIMIT ?
+        ''', (limit,))
+
+    def retry(self, job_ids, now):
+        """Requeue dead jobs with fresh attempts; ``job_ids`` None means all of them."""
+        cursor = self.conn.execute('''
+            UPDATE jobs SET status = 'queued', attempts = 0, run_after = ?
+            WHERE status = 'dead' AND (? OR id IN (SELECT value FROM json_each(?)))
+        ''', (now, job_ids is None, json.dumps(list(job_ids or ()))))
+        return cursor.rowcount
+
+class CatalogRepo(Repository):
+    """Departments, medications and the table_versions counters behind them."""
+
+    def versions(self, tables):
+        """``[(name, version), ...]`` of the given table_versions entries, by name."""
+        cursor = self.conn.execute('''
+            SELECT name, version FROM table_versions
+            WHERE name IN (SELECT value FROM json_each(?))
+            ORDER BY name
+        ''', (json.dumps(list(tables)),))
+        return cursor.fetchall()
+
+    def departments(self, today):
+        # Doctor and appointment counts come from the trigger-maintained
+        # department_stats and department_appointment_days tables
+        return self._rows(Department, '''
+            SELECT d.id, d.name, d.description, d.phone, d.location, u.name as head_doctor,
+                   COALESCE(s.doctor_count, 0) as doctor_count,
+                   (SELECT COALESCE(SUM(appointments), 0) FROM department_appointment_days
+                    WHERE name = d.name AND appointment_date >= ?) as upcoming_appointments,
+                   (SELECT COALESCE(SUM(appointments), 0) FROM department_appointment_days
+                    WHERE name = d.name AND appointment_date = ?) as appointments_today
+            FROM departments d
+            LEFT JOIN users u ON d.head_doctor_id = u.id
+            LEFT JOIN department_stats s ON s.name = d.name
+            ORDER BY d.name
+        ''', (today, today))
+
+    def add_department(self, name, description, phone, location):
+        """Insert a department; sqlite3.IntegrityError if the name is taken."""
+        cursor = self.conn.execute('''
+            INSERT INTO departments (name, description, phone, location)
+            VALUES (?, ?, ?, ?)
+        ''', (name, description, phone, location))
+        return cursor.lastrowid
+
+    def medications_version(self):
+        return self._value("SELECT version FROM table_versions WHERE name = 'medications'")
+
+    def medications(self):
+        return self._rows(Medication, '''
+            SELECT id, name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer
+            FROM medications
+            ORDER BY name
+        ''')
+
+    def add_medication(self, name, generic_name, description, dosage, side_effects, price,
+                       stock_quantity, manufacturer):
+        cursor = self.conn.execute('''
+            INSERT INTO medications (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (name, generic_name, description, dosage, side_effects, price, stock_quantity, manufacturer))
+        return cursor.lastrowid
+
+    def search_medications(self, terms, query, limit=10):
+        """Full-text matches for the FTS5 ``terms`` built from ``query``."""
+        prefix = query.strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        # Exact brand name first, then brand names starting with the query, then
+        # everything else (generic name / description hits) by bm25 relevance,
+        # with brand name matches weighted highest.
+        return self._rows(MedicationMatch, '''
+            SELECT m.id, m.name, m.generic_name, m.dosage, m.price
+            FROM medications_fts
+            JOIN medications m ON m.id = medications_fts.rowid
+            WHERE medications_fts MATCH ?
+            ORDER BY CASE
+                         WHEN m.name = ? COLLATE NOCASE THEN 0
+                         WHEN m.name LIKE ? ESCAPE '\\' THEN 1
+                         ELSE 2
+                     END,
+                     bm25(medications_fts, 10.0, 5.0, 1.0),
+                     m.name
+            LIMIT ?
+        ''', (terms, query.strip(), prefix, limit))